@@ -0,0 +1,170 @@
+import numpy as np
+
+STANDARD_BITRATES = (1_000_000, 800_000, 500_000, 250_000, 125_000, 100_000, 83_333, 50_000, 20_000, 10_000)
+
+IDLE_BITS = 8           # a recessive stretch this many of the shortest intervals long ends in a SOF
+SOF_INTERVALS = 3       # intervals after a SOF that always end before BRS, at most 5 bits each
+
+
+class BitrateEstimator:
+    # The nominal bit time is the GCD of the edge-to-edge intervals at the start of every frame.
+    #
+    # CAN FD data phases run at another bit rate and make up most of the edges of a long FD frame, only
+    # the first intervals after a SOF are sure to be at the nominal one. A SOF is the recessive to
+    # dominant edge after a recessive stretch IDLE_BITS of the shortest intervals long (the histogram's
+    # first peak, so less than the 11 bits between two frames whatever the data bit rate) and 1.5 times
+    # as long as the dominant one before it, which rules out the BRS bit, and longer than any of the
+    # intervals after it (at most 5 bits), which rules out the ACK slot. The dominant interval before
+    # the stretch is the previous frame's ACK slot, a single nominal bit, and is kept as well. Ticks are
+    # session ticks (see SessionClock), the gap in front of a burst is never longer there than it really was.
+    # An estimate is only confirmed once it comes out the same again after min_frames more SOFs,
+    # bitrate() keeps returning it from then on
+
+    def __init__(self, tick_hz=10_000_000, max_ticks=4096, min_edges=64, peak_ratio=0.1, tolerance=0.03,
+                 min_frames=8, max_sofs=4096):
+        self.tick_hz = tick_hz
+        self.min_edges = min_edges
+        self.min_frames = min_frames
+        self.max_sofs = max_sofs
+        self.peak_ratio = peak_ratio
+        self.tolerance = tolerance
+        self.hist = np.zeros(max_ticks, dtype=np.int64)
+        self.reset()
+
+    def reset(self):
+        self.hist[:] = 0
+        self.edges = 0
+        self.sofs = 0               # SOFs seen, the ones that no longer fit into max_sofs included
+        self.locked = None          # the confirmed bitrate
+        self._tail = np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        self._gaps = np.empty(0, dtype=np.int64)     # recessive stretch in front of the last max_sofs SOFs
+        # the dominant interval before that stretch and the SOF_INTERVALS after it
+        self._firsts = np.empty((0, SOF_INTERVALS + 1), dtype=np.int64)
+        self._candidate = None      # (bitrate, sofs) of the estimate waiting to be confirmed
+
+    @property
+    def ready(self):
+        return self.edges >= self.min_edges
+
+    def add(self, ticks, levels):
+        # session ticks and levels of one batch of records, records that repeat the level are skipped
+        ts = np.asarray(ticks, dtype=np.int64)
+        lv = np.asarray(levels, dtype=np.int64)
+        if not len(ts) or self.locked is not None:
+            return
+
+        # the last few edges of the previous batch come first, those near its end were waiting for
+        # the intervals after them
+        tail_ts, tail_lv = self._tail
+        ts = np.concatenate((tail_ts, ts))
+        lv = np.concatenate((tail_lv, lv))
+        keep = np.r_[True, lv[1:] != lv[:-1]]
+        ts, lv = ts[keep], lv[keep]
+        seen = len(tail_ts)
+        self._tail = ts[-(SOF_INTERVALS + 2):], lv[-(SOF_INTERVALS + 2):]
+
+        # long idle gaps are not bit times
+        d = np.diff(ts)
+        new = d[max(seen - 1, 0):]
+        new = new[new < len(self.hist)]
+        self.hist += np.bincount(new, minlength=len(self.hist))
+        self.edges += len(new)
+
+        # edge k is a SOF with d[k - 2] before its recessive stretch d[k - 1], the edges of the tail up
+        # to the last SOF_INTERVALS have been looked at before
+        k = np.arange(max(seen - SOF_INTERVALS, 2), len(ts) - SOF_INTERVALS)
+        peaks = self.peaks()
+        if not len(k) or not len(peaks):
+            return
+        around = np.stack([d[k - 2]] + [d[k + i] for i in range(SOF_INTERVALS)], axis=1)
+        sof = (lv[k] == 0) & (d[k - 1] >= IDLE_BITS * peaks[0]) & (2 * d[k - 1] >= 3 * d[k - 2]) \
+            & (around[:, 1:].max(axis=1) < d[k - 1])
+        self.sofs += int(sof.sum())
+        self._gaps = np.concatenate((self._gaps, d[k - 1][sof]))[-self.max_sofs:]
+        self._firsts = np.concatenate((self._firsts, around[sof]))[-self.max_sofs:]
+
+    def peaks(self):
+        # centre of every run of bins above peak_ratio of the tallest one
+        hist = self.hist
+        if not hist.any():
+            return np.empty(0)
+
+        above = hist >= max(1, hist.max() * self.peak_ratio)
+        starts = np.flatnonzero(above & ~np.r_[False, above[:-1]])
+        ends = np.flatnonzero(above & ~np.r_[above[1:], False]) + 1
+
+        ticks = np.arange(len(hist))
+        return np.array([np.average(ticks[a:b], weights=hist[a:b]) for a, b in zip(starts, ends)])
+
+    def sof_intervals(self):
+        # the ACK slot and the intervals after every SOF, the first of them dominant. The shortest
+        # interval may have become shorter since a SOF was added, mostly with the first FD data phase
+        peaks = self.peaks()
+        if not len(peaks):
+            return self._firsts[:0]
+        return self._firsts[self._gaps >= IDLE_BITS * peaks[0]]
+
+    def bit_ticks(self):
+        intervals = self.sof_intervals()
+        if len(intervals) < self.min_frames:
+            return None
+
+        # rising edges come late through the transceivers, which lengthens every dominant stretch and
+        # shortens every recessive one by as much: two intervals in a row after the SOF add up to a
+        # whole number of bits all the same. The shortest of those sums is two or a few bits, take the
+        # largest divisor that fits them and the intervals themselves once that delay is taken off.
+        # A bus with a single ID sends the same few intervals over and over, a divisor a bit too large
+        # can fit those with a negative delay, which no transceiver has, the ACK slot rules out the rest
+        sums = (intervals[:, 1:-1] + intervals[:, 2:]).ravel().astype(np.float64)
+        dominant = np.r_[1.0, (-1.0) ** np.arange(SOF_INTERVALS)]
+        base = np.percentile(sums, 10)
+        for k in range(1, 11):
+            # every node has its own clock, fit the divisor to all of them before checking
+            n = np.maximum(np.round(sums * k / base), 2)
+            candidate = np.sum(sums * n) / np.sum(n ** 2)
+            n = np.maximum(np.round(sums / candidate), 2)
+            fits = np.abs(sums - n * candidate) <= np.maximum(1.0, self.tolerance * sums)
+            if fits.mean() < 0.9:
+                continue
+            rest = (intervals - np.maximum(np.round(intervals / candidate), 1) * candidate) * dominant
+            delay = np.median(rest)
+            slack = np.maximum(1.0, self.tolerance * intervals)
+            if -max(1.0, self.tolerance * candidate) <= delay <= 0.4 * candidate \
+                    and (np.abs(rest - delay) <= slack).mean() >= 0.8:
+                break
+        else:
+            return None
+
+        # least squares refinement over the sums that fit
+        return float(np.sum(sums[fits] * n[fits]) / np.sum(n[fits] ** 2))
+
+    def estimate(self):
+        # from what has been seen so far, None when that is not enough
+        if not self.ready:
+            return None
+
+        bit_ticks = self.bit_ticks()
+        if not bit_ticks:
+            return None
+
+        measured = self.tick_hz / bit_ticks
+        nearest = min(STANDARD_BITRATES, key=lambda rate: abs(rate - measured))
+        if abs(nearest - measured) <= self.tolerance * nearest:
+            return nearest
+        return int(round(measured, -3))
+
+    def bitrate(self):
+        # the confirmed estimate, None until there is one
+        if self.locked is not None:
+            return self.locked
+
+        bitrate = self.estimate()
+        if bitrate is None:
+            return None
+        candidate = self._candidate
+        if not candidate or candidate[0] != bitrate:
+            self._candidate = (bitrate, self.sofs)
+        elif self.sofs >= candidate[1] + self.min_frames:
+            self.locked = bitrate
+            return bitrate
+        return None
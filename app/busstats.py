@@ -0,0 +1,179 @@
+import threading
+
+import numpy as np
+
+from frames import ERROR_KINDS
+
+# columns of the per-bucket counters
+FRAMES, DATA, REMOTE, EXTENDED, CRC_ERRORS, BUSY_TICKS, FD = range(7)
+COUNTERS = ('frames', 'data', 'remote', 'extended', 'crc_errors', 'busy_ticks', 'fd')
+
+# idle bits in front of a frame, bin k holds gaps of bit_length k: 0, 1, 2-3, 4-7, ... and the rest
+GAP_BINS = 16
+
+
+def gap_bin_labels():
+    labels = ['0', '1']
+    for k in range(2, GAP_BINS - 1):
+        labels.append(f"{1 << (k - 1)}-{(1 << k) - 1}")
+    labels.append(f">={1 << (GAP_BINS - 2)}")
+    return labels
+
+
+class BusStats:
+    # Running bus statistics, updated in O(1) per frame. The sliding window is a ring of `buckets`
+    # fixed-size rows of bucket_ticks each, the oldest row is zeroed and reused as time moves on, so
+    # the cost and memory stay the same however long the capture runs. Lifetime totals are kept too.
+    # Per-ID counters get a column each, the arrays only grow (by doubling) when a new ID turns up.
+
+    def __init__(self, tick_hz=10_000_000, window=1.0, buckets=10, id_capacity=64):
+        self.tick_hz = tick_hz
+        self.buckets = buckets
+        self.bucket_ticks = max(int(window * tick_hz) // buckets, 1)
+        self.id_capacity = id_capacity
+        self._lock = threading.Lock()
+        self.clear()
+
+    def clear(self):
+        with self._lock:
+            self._win = np.zeros((self.buckets, len(COUNTERS)), dtype=np.int64)
+            self._total = np.zeros(len(COUNTERS), dtype=np.int64)
+            self._gap_win = np.zeros((self.buckets, GAP_BINS), dtype=np.int64)
+            self._gap_total = np.zeros(GAP_BINS, dtype=np.int64)
+            self._err_win = np.zeros((self.buckets, len(ERROR_KINDS)), dtype=np.int64)
+            self._err_total = np.zeros(len(ERROR_KINDS), dtype=np.int64)
+            self._id_win = np.zeros((self.buckets, self.id_capacity), dtype=np.int64)
+            self._id_total = np.zeros(self.id_capacity, dtype=np.int64)
+            self._id_col = {}           # (can_id, ide) -> column
+            self._ids = []              # column -> (can_id, ide)
+            self._bucket = None         # absolute number of the newest bucket
+            self._first = None          # tick the statistics start at
+            self._now = None            # newest tick seen
+
+    def advance(self, tick):
+        # moves the window up to tick, a quiet bus still ages its old frames out
+        with self._lock:
+            self._advance(tick)
+
+    def _advance(self, tick):
+        if self._first is None:
+            self._first = tick
+        if self._now is None or tick > self._now:
+            self._now = tick
+
+        bucket = tick // self.bucket_ticks
+        if self._bucket is None:
+            self._bucket = bucket
+            return
+        steps = bucket - self._bucket
+        if steps <= 0:
+            return
+
+        # zero the rows that are being reused, at most one full turn of the ring
+        for b in range(self._bucket + 1, self._bucket + 1 + min(steps, self.buckets)):
+            row = b % self.buckets
+            self._win[row] = 0
+            self._gap_win[row] = 0
+            self._err_win[row] = 0
+            self._id_win[row] = 0
+        self._bucket = bucket
+
+    def add(self, frame):
+        with self._lock:
+            tick = frame.end_tick
+            self._advance(tick)
+
+            col = self._id_col.get((frame.can_id, frame.ide))
+            if col is None:
+                col = self._new_id((frame.can_id, frame.ide))
+
+            gap = min(int(frame.idle_bits).bit_length(), GAP_BINS - 1)
+            # CAN FD has no remote frames, its RTR position is the RRS bit
+            kind = REMOTE if frame.rtr and not frame.fdf else DATA
+            self._total[FRAMES] += 1
+            self._total[kind] += 1
+            self._total[BUSY_TICKS] += frame.end_tick - frame.start_tick
+            if frame.ide:
+                self._total[EXTENDED] += 1
+            if frame.fdf:
+                self._total[FD] += 1
+            if not frame.crc_ok:
+                self._total[CRC_ERRORS] += 1
+            self._gap_total[gap] += 1
+            self._id_total[col] += 1
+
+            # a frame older than the window only counts towards the totals
+            bucket = tick // self.bucket_ticks
+            if self._bucket - bucket >= self.buckets:
+                return
+            row = bucket % self.buckets
+            win = self._win[row]
+            win[FRAMES] += 1
+            win[kind] += 1
+            win[BUSY_TICKS] += frame.end_tick - frame.start_tick
+            if frame.ide:
+                win[EXTENDED] += 1
+            if frame.fdf:
+                win[FD] += 1
+            if not frame.crc_ok:
+                win[CRC_ERRORS] += 1
+            self._gap_win[row, gap] += 1
+            self._id_win[row, col] += 1
+
+    def add_error(self, kind, tick):
+        # one protocol error (an ERR_* kind from frames.py)
+        with self._lock:
+            self._advance(tick)
+            self._err_total[kind] += 1
+            bucket = tick // self.bucket_ticks
+            if self._bucket - bucket < self.buckets:
+                self._err_win[bucket % self.buckets, kind] += 1
+
+    def _new_id(self, key):
+        col = len(self._ids)
+        if col == self._id_total.shape[0]:
+            grow = col
+            self._id_win = np.concatenate([self._id_win, np.zeros((self.buckets, grow), dtype=np.int64)], axis=1)
+            self._id_total = np.concatenate([self._id_total, np.zeros(grow, dtype=np.int64)])
+        self._id_col[key] = col
+        self._ids.append(key)
+        return col
+
+    def window_seconds(self):
+        # the full ring, or less while the capture is younger than that
+        if self._now is None:
+            return 0.0
+        span = (self.buckets - 1) * self.bucket_ticks + self._now % self.bucket_ticks + 1
+        return min(span, self._now - self._first + 1) / self.tick_hz
+
+    def summary(self, top=None):
+        # everything the stats panel shows, costs O(buckets x IDs) and nothing per frame seen.
+        # ids are (can_id, ide, frames/s in the window, total frames), busiest first,
+        # errors {kind: (in the window, total)}
+        with self._lock:
+            seconds = self.window_seconds()
+            win = self._win.sum(axis=0)
+            id_win = self._id_win.sum(axis=0)[:len(self._ids)]
+            id_total = self._id_total[:len(self._ids)].copy()
+            errors = self._err_win.sum(axis=0)
+            error_total = self._err_total.copy()
+            gaps = self._gap_win.sum(axis=0)
+            gap_total = self._gap_total.copy()
+            total = self._total.copy()
+            ids = list(self._ids)
+
+        order = np.lexsort((-id_total, -id_win))
+        if top is not None:
+            order = order[:top]
+        rate = 1 / seconds if seconds else 0.0
+
+        return {'window_s': seconds,
+                'frames_per_s': win[FRAMES] * rate,
+                'load_pct': 100 * win[BUSY_TICKS] / (seconds * self.tick_hz) if seconds else 0.0,
+                'window': dict(zip(COUNTERS, win.tolist())),
+                'totals': dict(zip(COUNTERS, total.tolist())),
+                'ids': [(ids[c][0], int(ids[c][1]), float(id_win[c] * rate), int(id_total[c])) for c in order],
+                'errors_per_s': int(errors.sum()) * rate,
+                'errors': {kind: (n, total) for kind, n, total in zip(ERROR_KINDS, errors.tolist(), error_total.tolist())},
+                'gaps': gaps.tolist(),
+                'gap_totals': gap_total.tolist()}
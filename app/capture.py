@@ -0,0 +1,224 @@
+import mmap
+import struct
+import time
+
+import numpy as np
+
+from decoder import EDGE_RECORD_DTYPE, RECORD_SIZE, RecordStream
+from timeline import SessionClock
+
+# File layout:
+#   header   HEADER
+#   blocks   BLOCK header followed by count raw EdgeRecords, appended as the capture grows
+#   index    one INDEX_DTYPE row per block, written on close
+#   trailer  TRAILER pointing back at the index
+# A capture that was never closed has no index, the reader then walks the block headers instead.
+
+MAGIC = b'CANCAP\r\n'
+VERSION = 1
+HEADER = struct.Struct('<8sHHIIQ32s4x')     # magic, version, header size, tick Hz, bitrate, created ns, firmware
+BLOCK = struct.Struct('<4sIQQ')             # magic, record count, first tick, last tick
+BLOCK_MAGIC = b'BLK\x00'
+TRAILER = struct.Struct('<8sQQ')            # magic, index offset, block count
+TRAILER_MAGIC = b'CANIDX\r\n'
+
+INDEX_DTYPE = np.dtype([('offset', '<u8'),      # file offset of the first record
+                        ('first_tick', '<u8'),
+                        ('last_tick', '<u8'),
+                        ('count', '<u4'),
+                        ('pad', '<u4')])
+
+DEFAULT_FIRMWARE = 'CAN_Reader STM32F411'
+
+
+def unwrap_ticks(timestamps, base=0, last=None):
+    # capture ticks of bare timestamps, see SessionClock; returns the ticks plus the (base, last)
+    # to pass in with the next batch
+    clock = SessionClock()
+    clock.offset, clock.last = base, last
+    ticks = clock.unwrap(timestamps)
+    return ticks, clock.offset, clock.last
+
+
+class CaptureWriter:
+    # Append-only writer, raw serial chunks go in and only aligned EdgeRecords reach the file
+
+    def __init__(self, path, tick_hz=10_000_000, bitrate=0, firmware=DEFAULT_FIRMWARE, block_records=4096):
+        self.path = path
+        self.tick_hz = tick_hz
+        self.bitrate = bitrate
+        self.block_records = block_records
+        self.stream = RecordStream()
+        self.record_count = 0
+
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, VERSION, HEADER.size, tick_hz, bitrate,
+                                     time.time_ns(), firmware.encode()[:32]))
+        self._pending = []
+        self._pending_count = 0
+        self._index = []
+
+        # firmware timestamps restart every burst, the index keeps one ever increasing tick count
+        self._clock = SessionClock(tick_hz)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def block_count(self):
+        return len(self._index)
+
+    def write(self, raw_data):
+        self.write_records(self.stream.feed(raw_data))
+
+    def write_records(self, records):
+        if not len(records):
+            return
+        self._pending.append(np.array(records, dtype=EDGE_RECORD_DTYPE))
+        self._pending_count += len(records)
+        if self._pending_count >= self.block_records:
+            self.flush()
+
+    def flush(self):
+        if not self._pending_count:
+            return
+
+        records = np.concatenate(self._pending)
+        self._pending = []
+        self._pending_count = 0
+
+        ticks = self._clock.unwrap(records['timestamp'], records['burst'])
+        offset = self._file.tell() + BLOCK.size
+        self._file.write(BLOCK.pack(BLOCK_MAGIC, len(records), int(ticks[0]), int(ticks[-1])))
+        self._file.write(records.tobytes())
+        self._index.append((offset, int(ticks[0]), int(ticks[-1]), len(records), 0))
+        self.record_count += len(records)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+
+        index_offset = self._file.tell()
+        self._file.write(np.array(self._index, dtype=INDEX_DTYPE).tobytes())
+        self._file.write(TRAILER.pack(TRAILER_MAGIC, index_offset, len(self._index)))
+        self._file.close()
+
+
+class CaptureReader:
+    # Memory-mapped reader, record arrays are views into the file and nothing is read until touched
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if len(self._mm) < HEADER.size:
+            raise ValueError(f"{path}: too short for a capture header")
+        magic, version, header_size, tick_hz, bitrate, created, firmware = HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC:
+            raise ValueError(f"{path}: not a capture file")
+        if version > VERSION:
+            raise ValueError(f"{path}: capture version {version} is newer than this reader")
+
+        self.version = version
+        self.header_size = header_size
+        self.tick_hz = tick_hz
+        self.bitrate = bitrate
+        self.created_ns = created
+        self.firmware = firmware.rstrip(b'\x00').decode(errors='replace')
+        self.index = self._read_index()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    @property
+    def record_count(self):
+        return int(self.index['count'].sum())
+
+    @property
+    def first_tick(self):
+        return int(self.index['first_tick'][0]) if len(self.index) else 0
+
+    @property
+    def last_tick(self):
+        return int(self.index['last_tick'][-1]) if len(self.index) else 0
+
+    def _read_index(self):
+        size = len(self._mm)
+        if size >= self.header_size + TRAILER.size:
+            magic, offset, count = TRAILER.unpack_from(self._mm, size - TRAILER.size)
+            if magic == TRAILER_MAGIC and offset + count * INDEX_DTYPE.itemsize == size - TRAILER.size:
+                return np.frombuffer(self._mm, dtype=INDEX_DTYPE, count=count, offset=offset).copy()
+        return self._scan_blocks()
+
+    def _scan_blocks(self):
+        # no trailer, the writer never got to close the file: walk the block headers
+        size = len(self._mm)
+        pos = self.header_size
+        rows = []
+        while pos + BLOCK.size <= size:
+            magic, count, first, last = BLOCK.unpack_from(self._mm, pos)
+            end = pos + BLOCK.size + count * RECORD_SIZE
+            if magic != BLOCK_MAGIC or end > size:
+                break
+            rows.append((pos + BLOCK.size, first, last, count, 0))
+            pos = end
+        return np.array(rows, dtype=INDEX_DTYPE)
+
+    def block(self, i):
+        row = self.index[i]
+        return np.frombuffer(self._mm, dtype=EDGE_RECORD_DTYPE, count=int(row['count']), offset=int(row['offset']))
+
+    def block_bytes(self, i):
+        row = self.index[i]
+        start = int(row['offset'])
+        return memoryview(self._mm)[start:start + int(row['count']) * RECORD_SIZE]
+
+    def find_block(self, tick):
+        # first block that ends at or after tick
+        return int(np.searchsorted(self.index['last_tick'], tick, side='left'))
+
+    def blocks(self, t0=None, t1=None):
+        # block numbers overlapping t0 .. t1 (capture ticks)
+        lo = self.find_block(t0) if t0 is not None else 0
+        hi = int(np.searchsorted(self.index['first_tick'], t1, side='right')) if t1 is not None else len(self.index)
+        return range(lo, hi)
+
+    def records(self, t0=None, t1=None):
+        for i in self.blocks(t0, t1):
+            yield self.block(i)
+
+    def chunks(self, t0=None, t1=None):
+        for i in self.blocks(t0, t1):
+            yield self.block_bytes(i)
+
+    def close(self):
+        try:
+            self._mm.close()
+        except BufferError:
+            # record arrays handed out still point into the map, it goes away with them
+            pass
+        self._file.close()
+
+
+def load_capture(path):
+    # every record of a capture in one array, for files that comfortably fit in memory
+    with CaptureReader(path) as reader:
+        return np.concatenate([np.empty(0, dtype=EDGE_RECORD_DTYPE)] + list(reader.records()))
+
+
+def save_capture(path, chunks, tick_hz=10_000_000, bitrate=0, firmware=DEFAULT_FIRMWARE):
+    with CaptureWriter(path, tick_hz, bitrate, firmware) as writer:
+        for raw in chunks:
+            writer.write(raw)
+    return writer.record_count
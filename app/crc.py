@@ -0,0 +1,85 @@
+import numpy as np
+
+CRC15_POLY = 0x4599     # x^15 + x^14 + x^10 + x^8 + x^7 + x^4 + x^3 + 1
+CRC15_MASK = 0x7FFF
+
+
+def _make_table(poly, width):
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    table = []
+    for byte in range(256):
+        crc = byte << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) if crc & top else (crc << 1)
+        table.append(crc & mask)
+    return table
+
+
+CRC15_TABLE = _make_table(CRC15_POLY, 15)
+CRC15_TABLE_NP = np.array(CRC15_TABLE, dtype=np.uint16)
+
+
+def crc15_from_int(value, nbits):
+    # CRC-15 starts from zero, so leading zero bits are free and the
+    # stream can be left padded up to a whole number of bytes
+    nbytes = (nbits + 7) // 8
+    crc = 0
+    for byte in value.to_bytes(nbytes, 'big'):
+        crc = ((crc << 8) & CRC15_MASK) ^ CRC15_TABLE[((crc >> 7) ^ byte) & 0xFF]
+    return crc
+
+
+def crc15(bits):
+    if len(bits) == 0:
+        return 0
+    value = int(bytes(bits).hex()[1::2], 2)
+    return crc15_from_int(value, len(bits))
+
+
+def crc15_batch(bit_rows):
+    # bit_rows: list of 0/1 sequences, or a 2D array with every row right aligned
+    if isinstance(bit_rows, np.ndarray) and bit_rows.ndim == 2:
+        matrix = bit_rows.astype(np.uint8, copy=False)
+    else:
+        width = max((len(r) for r in bit_rows), default=0)
+        matrix = np.zeros((len(bit_rows), width), dtype=np.uint8)
+        for i, row in enumerate(bit_rows):
+            if len(row):
+                matrix[i, width - len(row):] = row
+
+    pad = (-matrix.shape[1]) % 8
+    if pad:
+        matrix = np.pad(matrix, ((0, 0), (pad, 0)))
+
+    packed = np.packbits(matrix, axis=1)
+    crc = np.zeros(len(matrix), dtype=np.uint16)
+    for col in packed.T:
+        crc = ((crc << 8) & CRC15_MASK) ^ CRC15_TABLE_NP[((crc >> 7) ^ col) & 0xFF]
+    return crc
+
+
+# CAN FD: CRC-17 for up to 16 data bytes, CRC-21 above, both start with only the top bit set
+CRC17_POLY = 0x1685B    # x^17 + x^16 + x^14 + x^13 + x^11 + x^6 + x^4 + x^3 + x + 1
+CRC21_POLY = 0x102899   # x^21 + x^20 + x^13 + x^11 + x^7 + x^4 + x^3 + 1
+
+CRC17_TABLE = _make_table(CRC17_POLY, 17)
+CRC21_TABLE = _make_table(CRC21_POLY, 21)
+FD_CRCS = {17: (CRC17_POLY, CRC17_TABLE), 21: (CRC21_POLY, CRC21_TABLE)}
+
+
+def crc_fd(bits, width):
+    # bits: 0/1 array or sequence, SOF .. stuff count with the dynamic stuff bits left in.
+    # The non-zero start value makes leading zeros count, so the odd bits go first one at a time
+    poly, table = FD_CRCS[width]
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    bits = np.asarray(bits, dtype=np.uint8)
+
+    head = len(bits) % 8
+    crc = top
+    for bit in bits[:head].tolist():
+        crc = ((crc << 1) ^ poly) & mask if (crc & top) ^ (bit << (width - 1)) else (crc << 1) & mask
+    for byte in np.packbits(bits[head:]).tolist():
+        crc = ((crc << 8) & mask) ^ table[((crc >> (width - 8)) ^ byte) & 0xFF]
+    return crc
@@ -1,13 +1,838 @@
-import struct
+import bisect
+import copy
+import math
+import time
+
+import numpy as np
+
+from autobaud import BitrateEstimator
+from busstats import BusStats
+from crc import crc15, crc_fd
+from frames import (CANFrame, ErrorLog, FD_DLC_LEN, FrameIndex, FrameStore, TAIL_ACK, TAIL_LEN, TAIL_RECESSIVE,
+                    ERR_ACK, ERR_ACK_DELIM, ERR_ACTIVE_FLAG, ERR_CRC, ERR_CRC_DELIM, ERR_EOF, ERR_OVERLOAD,
+                    ERR_PASSIVE_FLAG, ERR_STUFF)
+from metrics import stage_timers
+from timeline import SessionClock
+
+# Mirrors the firmware's EdgeRecord struct, burst counts the UART transfers (always 0 on older firmware)
+EDGE_RECORD_DTYPE = np.dtype([('start', 'u1'),
+                              ('level', 'u1'),
+                              ('pin', 'u1'),
+                              ('burst', 'u1'),
+                              ('timestamp', '<u4')])
+RECORD_SIZE = EDGE_RECORD_DTYPE.itemsize
+RECORD_START = 0x11
+RECORD_PIN = 0x01
+
+# longest run of bits one edge interval expands to, an idle bus or the gap between two bursts
+# says nothing more past that, and it is still long enough for a cut off frame to run out in
+MAX_INTERVAL_BITS = 256
+
+# a recessive to dominant edge after at least EOF's worth of recessive bits is a SOF (or an error or
+# overload flag), BitSampler hard syncs to it
+HARD_SYNC_BITS = 7
+
+FLAG_BITS = 6           # an error or overload flag
+RECOVERY_BITS = 11      # recessive bits that end an error/overload frame, delimiter (8) plus intermission (3)
+
+# longest CAN FD data phase on the wire, ESI .. CRC delimiter: 517 bits with up to one stuff bit per 4,
+# then stuff count and CRC-21 with their fixed stuff bits
+FD_MAX_BITS = 517 + 130 + 32 + 1
+
+# how far on edges are sampled after a bit rate switch, about one frame, see CANDecoder._switch_rate
+SAMPLE_AHEAD_BITS = 256
+
+
+def fd_fixed_len(crc_len):
+    # stuff count (4) and CRC behind a fixed stuff bit every 4 bits
+    return 4 + crc_len + (4 + crc_len + 3) // 4
+
+
+def parse_fd_data_phase(raw, run_bit, run_len):
+    # Destuffs and splits up a CAN FD data phase in one go. raw is a 0/1 array from ESI on, run_bit and
+    # run_len the stuffing run the arbitration phase ended on. Works on runs rather than bits: a stuff
+    # bit is the first bit of any run that follows a run of exactly five, the 6th bit of a longer run is
+    # a stuff error. Returns None while raw is too short to tell, ('error', pos, level, fixed) for a
+    # stuff error at raw[pos] (fixed: a fixed stuff bit that does not flip the level), or
+    # ('frame', esi, dlc, data, stuff_count, crc, crc_len, dyn_end, end, dyn_stuff, stuff) where
+    # raw[:dyn_end] is ESI .. the last data bit, raw[end] the CRC delimiter and stuff all stuff bit positions
+    n = len(raw)
+    if not n:
+        return None
+
+    starts = np.concatenate(([0], np.flatnonzero(raw[1:] != raw[:-1]) + 1))
+    lengths = np.diff(np.append(starts, n))
+    carried = raw[0] == run_bit
+    runs = lengths.copy()
+    if carried:
+        runs[0] += run_len
+    before = np.empty_like(runs)
+    before[0] = 0 if carried else run_len
+    before[1:] = runs[:-1]
+
+    stuffed = starts[before == 5]
+    long_runs = np.flatnonzero(runs >= 6)
+    err = n
+    if len(long_runs):
+        r = long_runs[0]
+        err = int(starts[r] + 5 - (runs[r] - lengths[r]))
+
+    keep = np.ones(n, dtype=bool)
+    keep[stuffed] = False
+    kept = np.flatnonzero(keep)
+    if len(kept) >= 5:
+        dlc = bits_to_int(raw[kept[1:5]].tolist())
+        dyn = 5 + 8 * FD_DLC_LEN[dlc]
+    else:
+        dyn = n + 1
+    if len(kept) < dyn:
+        return ('error', err, int(raw[err]), False) if err < n else None
+
+    dyn_end = int(kept[dyn - 1]) + 1
+    if err < dyn_end:
+        return 'error', err, int(raw[err]), False
+
+    crc_len = 17 if FD_DLC_LEN[dlc] <= 16 else 21
+    end = dyn_end + fd_fixed_len(crc_len)
+    if n <= end:
+        return None
+
+    fixed = np.arange(dyn_end, end, 5)
+    wrong = np.flatnonzero(raw[fixed] == raw[fixed - 1])
+    if len(wrong):
+        pos = int(fixed[wrong[0]])
+        return 'error', pos, int(raw[pos]), True
+
+    field = np.delete(raw[dyn_end:end], fixed - dyn_end)
+    dyn_stuff = stuffed[stuffed < dyn_end]
+    data = np.packbits(raw[kept[5:dyn]]).tobytes()
+    return ('frame', int(raw[0]), dlc, data, bits_to_int(field[:4].tolist()), bits_to_int(field[4:].tolist()),
+            crc_len, dyn_end, end, len(dyn_stuff), np.concatenate([dyn_stuff, fixed]))
+
+
+def fd_stuff_count(count):
+    # the 4 bit stuff count field: Gray coded count modulo 8 and an even parity bit
+    gray = (count % 8) ^ ((count % 8) >> 1)
+    return (gray << 1) | (bin(gray).count('1') & 1)
+
+
+def find_record_offsets(buf):
+    # byte offsets of every complete record whose header matches 11 0x 01
+    n = len(buf) - RECORD_SIZE + 1
+    if n <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    hits = np.flatnonzero((buf[:n] == RECORD_START) &
+                          (buf[1:n + 1] <= 1) &
+                          (buf[2:n + 2] == RECORD_PIN))
+
+    # a sentinel can also show up inside a timestamp, keep the first of any overlapping pair
+    if len(hits) > 1 and (np.diff(hits) < RECORD_SIZE).any():
+        kept = []
+        next_free = -1
+        for pos in hits.tolist():
+            if pos >= next_free:
+                kept.append(pos)
+                next_free = pos + RECORD_SIZE
+        hits = np.array(kept, dtype=np.intp)
+
+    return hits
+
+
+def gather_records(buf, offsets):
+    if len(offsets) == 0:
+        return np.empty(0, dtype=EDGE_RECORD_DTYPE)
+
+    first = int(offsets[0])
+    if offsets[-1] - first == (len(offsets) - 1) * RECORD_SIZE:
+        # aligned stream, map it straight onto the struct layout
+        return np.frombuffer(buf, dtype=EDGE_RECORD_DTYPE, count=len(offsets), offset=first)
+
+    rows = buf[offsets[:, None] + np.arange(RECORD_SIZE)]
+    return rows.view(EDGE_RECORD_DTYPE).ravel()
+
+
+def parse_edge_records(raw_data):
+    buf = np.frombuffer(raw_data, dtype=np.uint8)
+    records = gather_records(buf, find_record_offsets(buf))
+    return records['level'], records['timestamp']
+
+
+class RecordStream:
+    # Reassembles EdgeRecords across arbitrary chunk boundaries
+
+    def __init__(self):
+        self._tail = b''
+        self.skipped_bytes = 0
+        self.record_count = 0
+
+    @property
+    def pending_bytes(self):
+        return len(self._tail)
+
+    def reset(self):
+        self._tail = b''
+        self.skipped_bytes = 0
+        self.record_count = 0
+
+    def feed(self, raw_data):
+        data = self._tail + bytes(raw_data) if self._tail else raw_data
+        buf = np.frombuffer(data, dtype=np.uint8)
+
+        offsets = find_record_offsets(buf)
+        records = gather_records(buf, offsets)
+
+        # anything after the last full record that could still be the start of one is carried over
+        end = int(offsets[-1]) + RECORD_SIZE if len(offsets) else 0
+        keep_from = max(end, len(buf) - (RECORD_SIZE - 1), 0)
+
+        self.skipped_bytes += keep_from - len(offsets) * RECORD_SIZE
+        self.record_count += len(offsets)
+        self._tail = bytes(data[keep_from:])
+
+        return records
+
+
+class FrameDecoder:
+    # Resumable destuff + frame state machine, only ever looks at bits it has not seen yet. Protocol
+    # errors go to an ErrorLog with their bit positions; after one, the decoder waits for RECOVERY_BITS
+    # recessive bits before it looks for the next SOF, the way a controller integrates into the bus again.
+    # The checks cost nothing per bit on a healthy bus: the stuff check only runs on a 6th equal bit and
+    # the form, ACK and overload checks once per frame.
+    # A CAN FD frame's data phase (ESI .. CRC) is left to parse_fd_data_phase in one go; rate_switch, when
+    # set, is told the bits after a given bit come at the other bit rate so it can expand them again
+
+    def __init__(self):
+        self.tick_of = None
+        self.rate_switch = None
+        self.stats = None
+        self.reset()
+
+    def reset(self):
+        # new containers rather than clearing them, snapshots may still hold the old ones
+        self.frames = FrameStore()
+        self.index = FrameIndex()
+        self.errors = ErrorLog()
+        self.stuff_pos = []
+        self.pos = 0
+        self._in_frame = False
+        self._idle = 0
+        self._start = 0
+        self._last = -1
+        self._bits = []
+        self._stuffed_len = None
+        self._stuffing = False
+        self._run_bit = None
+        self._run_len = 0
+
+        self._recovering = False
+        self._recessive = 0         # recessive run while recovering
+        self._dominant = 0          # dominant run while recovering
+        self._flag_start = -1       # first bit of that run
+        self._flagged = False       # the error/overload flag has been seen
+        self._overload = False      # recovering from an overload frame rather than an error
+        self._passive = None        # first bit of the six recessive bits that broke the frame
+
+        self._data_phase = False    # an FD frame's BRS has been seen, its data phase is next
+        self._switched = False      # the bit rate has been switched for it
+        self._head = None           # its SOF .. BRS as sent, for the CRC
+        self._fd = None             # (esi, dlc, data, stuff count, crc, crc_calc) once the data phase is in
+
+    def feed(self, bits, base=0):
+        # bits[0] is bit number base, everything before pos has been seen already.
+        # rate_switch may expand the bits list again while this runs
+        closed = len(self.frames)
+        i, n = self.pos - base, len(bits)
+        if self._data_phase:
+            i = self._read_data_phase(bits, base, i)
+            n = len(bits)
+
+        while i is not None and i < n:
+            if not self._in_frame and not self._recovering:
+                # between frames only the idle bits need counting, skip to the next SOF
+                try:
+                    sof = bits.index(0, i)
+                except ValueError:
+                    sof = n
+                self._idle += sof - i
+                i = sof
+                if i == n:
+                    break
+            if self._push(bits[i], base + i):
+                i = self._read_data_phase(bits, base, i + 1)
+                n = len(bits)
+                continue
+            i += 1
+
+        if i is not None:
+            self.pos = base + n
+        return self.frames[closed:]
+
+    def flush(self):
+        # bus is known to be idle, so the rest of an open frame can only be recessive
+        if self._in_frame and self._stuffed_len is not None:
+            while self._in_frame:
+                self._push(1, None)
+        else:
+            self._in_frame = False
+            self._data_phase = False
+            self._bits = []
+
+    def pending_frame(self):
+        if not self._in_frame:
+            return None
+
+        probe = copy.copy(self)
+        probe.frames = []
+        probe.index = None
+        probe.stats = None
+        probe.errors = None
+        probe.rate_switch = None
+        probe.stuff_pos = []
+        probe._bits = self._bits[:]
+        probe.flush()
+        return probe.frames[0] if probe.frames else None
+
+    def _push(self, bit, raw_idx):
+        # raw_idx is None for the recessive padding added by flush(). True once an FD frame's BRS is in
+        self._last = self._last + 1 if raw_idx is None else raw_idx
+
+        if self._recovering:
+            self._recover(bit, self._last)
+            return
+
+        if not self._in_frame:
+            if bit == 1:
+                self._idle += 1
+                return
+            self._start_frame()
+
+        if self._stuffing:
+            if self._run_len == 5:
+                if bit != self._run_bit:
+                    if raw_idx is not None:
+                        self.stuff_pos.append(raw_idx)
+                    self._run_bit = bit
+                    self._run_len = 1
+                    return
+                if raw_idx is not None:
+                    self._stuff_error(bit)
+                    return
+
+            if self._stuffed_len is not None and len(self._bits) >= self._stuffed_len:
+                self._stuffing = False
+            elif bit == self._run_bit:
+                self._run_len += 1
+            else:
+                self._run_bit = bit
+                self._run_len = 1
+
+        self._bits.append(bit)
+        n = len(self._bits)
+
+        if self._stuffed_len is None:
+            self._stuffed_len = self._header_len()
+            return self._data_phase
+        elif n == self._stuffed_len + TAIL_LEN:
+            frame = self._build_frame()
+            self.frames.append(frame)
+            if self.index is not None:
+                self.index.add(frame)
+            if self.stats is not None:
+                self.stats.add(frame)
+            self._in_frame = False
+            self._idle = 0
+            if raw_idx is not None:
+                self._check_tail(frame)
+
+    def _start_frame(self):
+        # SOF
+        self._in_frame = True
+        self._start = self._last
+        self._bits = []
+        self._stuffed_len = None
+        self._stuffing = True
+        self._run_bit = None
+        self._run_len = 0
+        self._data_phase = False
+        self._switched = False
+        self._fd = None
+
+    def _read_data_phase(self, bits, base, i):
+        # bits[i] is the first bit after BRS. Returns where to carry on, None (with pos set) until the
+        # whole data phase up to the CRC delimiter has been expanded
+        if not self._switched:
+            self._switched = True
+            self._head = bits[max(self._start - base, 0):i]
+            if self._bits[-1] and self.rate_switch:
+                self.rate_switch(base + i - 1, True)
+
+        raw = np.array(bits[i:i + FD_MAX_BITS], dtype=np.uint8)
+        parsed = parse_fd_data_phase(raw, self._run_bit, self._run_len)
+        if parsed is None:
+            if len(raw) < FD_MAX_BITS:
+                self._data_phase = True
+                self.pos = base + i
+                return None
+            parsed = 'error', len(raw) - 1, int(raw[-1]), True
+        self._data_phase = False
+        fast = self._bits[-1] and self.rate_switch
+
+        if parsed[0] == 'error':
+            _, pos, level, fixed = parsed
+            self._last = base + i + pos
+            if not fixed:
+                self._stuff_error(level)
+            else:
+                self._error(ERR_STUFF, self._last, self._start)
+                self._in_frame = False
+                self._bits = []
+                self._begin_recovery()
+            if fast:
+                self.rate_switch(self._last, False)
+            return i + pos + 1
+
+        _, esi, dlc, data, stuff_count, crc, crc_len, dyn_end, end, dyn_stuff, stuff = parsed
+        start = base + i
+        # the stuff count covers the dynamic stuff bits of the whole frame, arbitration included
+        count = len(self.stuff_pos) - bisect.bisect_left(self.stuff_pos, self._start) + dyn_stuff
+        if stuff_count != fd_stuff_count(count):
+            self._error(ERR_CRC, start + dyn_end + 1, self._start)
+        self.stuff_pos.extend((stuff + start).tolist())
+        crc_calc = crc_fd(np.concatenate([np.array(self._head, dtype=np.uint8), raw[:dyn_end],
+                                          raw[dyn_end + 1:dyn_end + 5]]), crc_len)
+
+        self._fd = (esi, dlc, data, stuff_count, crc, crc_calc)
+        self._stuffing = False
+        self._stuffed_len = len(self._bits)
+        self._last = start + end - 1
+        if fast:
+            self.rate_switch(start + end, False)
+        return i + end
+
+    def _error(self, kind, bit, frame_start=-1):
+        tick = self.tick_of(bit) if self.tick_of else 0
+        if self.errors is not None:
+            self.errors.append(kind, bit, frame_start, tick)
+        if self.stats is not None:
+            self.stats.add_error(kind, tick)
+
+    def _stuff_error(self, level):
+        # six equal bits: dominant ones are another node's active error flag, recessive ones a passive
+        # error flag (or the capture losing the rest of the frame, the bus looks the same)
+        self._error(ERR_STUFF, self._last, self._start)
+        self._in_frame = False
+        self._bits = []
+        self._begin_recovery()
+        self._flag_start = self._last - FLAG_BITS + 1
+        if level:
+            self._recessive = FLAG_BITS
+            self._passive = self._flag_start
+        else:
+            self._dominant = FLAG_BITS
+            self._flagged = True
+            self._error(ERR_ACTIVE_FLAG, self._flag_start, self._start)
+
+    def _check_tail(self, frame):
+        tail = frame.tail
+        first = frame.end_bit - (TAIL_LEN - 1)      # session bit of the CRC delimiter
+
+        if frame.crc != frame.crc_calc:
+            self._error(ERR_CRC, first - 1, frame.start_bit)
+        if tail & TAIL_ACK:
+            self._error(ERR_ACK, first + 1, frame.start_bit)
+        if tail | TAIL_ACK == TAIL_RECESSIVE:
+            return
+
+        # first dominant tail bit other than the ACK slot, k counts from the CRC delimiter
+        k = next(k for k in range(TAIL_LEN) if k != 1 and not (tail >> (TAIL_LEN - 1 - k)) & 1)
+        if k == TAIL_LEN - 1:
+            # dominant in the last intermission bit is the next frame's SOF
+            self._start_frame()
+            self._bits.append(0)
+            self._run_bit = 0
+            self._run_len = 1
+            return
+
+        if k == 0:
+            self._error(ERR_CRC_DELIM, first, frame.start_bit)
+        elif k == 2:
+            self._error(ERR_ACK_DELIM, first + 2, frame.start_bit)
+        elif k < 9:
+            self._error(ERR_EOF, first + k, frame.start_bit)
+        else:
+            # last EOF bit or the first two intermission bits
+            self._error(ERR_OVERLOAD, first + k, frame.start_bit)
+
+        self._begin_recovery(overload=k >= 9)
+        for j in range(k, TAIL_LEN):
+            if self._recovering:
+                self._recover((tail >> (TAIL_LEN - 1 - j)) & 1, first + j)
+
+    def _begin_recovery(self, overload=False):
+        self._recovering = True
+        self._recessive = 0
+        self._dominant = 0
+        self._flag_start = -1
+        self._flagged = False
+        self._overload = overload
+        self._passive = None
+
+    def _recover(self, bit, pos):
+        if bit:
+            self._recessive += 1
+            self._dominant = 0
+            if self._recessive >= RECOVERY_BITS:
+                if self._passive is not None and not self._flagged:
+                    self._error(ERR_PASSIVE_FLAG, self._passive)
+                self._recovering = False
+                self._idle = 0
+            return
+
+        if not self._dominant:
+            self._flag_start = pos
+        self._recessive = 0
+        self._dominant += 1
+        if self._dominant == FLAG_BITS and not self._flagged:
+            self._flagged = True
+            if not self._overload:
+                self._error(ERR_ACTIVE_FLAG, self._flag_start)
+
+    def _header_len(self):
+        # length of the stuffed part (SOF .. CRC) once the DLC has been seen
+        bits = self._bits
+        if len(bits) < 14:
+            return None
+
+        extended = bits[13] == 1
+        fdf = 33 if extended else 14
+        if len(bits) > fdf and bits[fdf] and (len(bits) == fdf + 1 or not bits[fdf + 1]):
+            # CAN FD: FDF, a dominant res and BRS, then the data phase takes over. A recessive res is no
+            # FD frame (ISO calls it a protocol exception), usually a frame cut short, it reads on as classic
+            self._data_phase = len(bits) == fdf + 3
+            return None
+
+        dlc_end = 39 if extended else 19
+        if len(bits) < dlc_end:
+            return None
+
+        rtr = bits[32] if extended else bits[12]
+        data_len = 0 if rtr else min(bits_to_int(bits[dlc_end - 4:dlc_end]), 8)
+        return dlc_end + data_len * 8 + 15
+
+    def _build_frame(self):
+        if self._fd is not None:
+            return self._build_fd_frame()
+
+        bits = self._bits
+        ide = bits[13]
+
+        if ide:
+            can_id = bits_to_int(bits[1:12] + bits[14:32])
+            rtr, r0, r1 = bits[32], bits[33], bits[34]
+            idx = 35
+        else:
+            can_id = bits_to_int(bits[1:12])
+            rtr, r0, r1 = bits[12], bits[14], 0
+            idx = 15
+
+        dlc = bits_to_int(bits[idx:idx + 4])
+        idx += 4
+
+        n_data = 0 if rtr else min(dlc, 8)
+        data = bytes(bits_to_int(bits[i:i + 8]) for i in range(idx, idx + n_data * 8, 8))
+        idx += n_data * 8
+
+        frame = CANFrame(can_id, ide=ide, rtr=rtr, dlc=dlc, data=data,
+                         crc=bits_to_int(bits[idx:idx + 15]),
+                         crc_calc=crc15(bits[:idx]),
+                         srr=bits[12] if ide else 1, r0=r0, r1=r1,
+                         tail=bits_to_int(bits[idx + 15:]),
+                         idle_bits=self._idle,
+                         start_bit=self._start, end_bit=self._last)
+
+        if self.tick_of:
+            frame.start_tick = self.tick_of(frame.start_bit)
+            frame.end_tick = self.tick_of(frame.end_bit + 1)
+
+        return frame
+
+    def _build_fd_frame(self):
+        # _bits holds SOF .. BRS and the tail, the data phase is in _fd
+        bits = self._bits
+        ide = bits[13]
+        if ide:
+            can_id = bits_to_int(bits[1:12] + bits[14:32])
+            rrs, res, brs = bits[32], bits[34], bits[35]
+        else:
+            can_id = bits_to_int(bits[1:12])
+            rrs, res, brs = bits[12], bits[15], bits[16]
+        esi, dlc, data, stuff_count, crc, crc_calc = self._fd
+
+        frame = CANFrame(can_id, ide=ide, rtr=rrs, dlc=dlc, data=data, crc=crc, crc_calc=crc_calc,
+                         srr=bits[12] if ide else 1, r0=res, fdf=1, brs=brs, esi=esi,
+                         stuff_count=stuff_count, tail=bits_to_int(bits[self._stuffed_len:]),
+                         idle_bits=self._idle, start_bit=self._start, end_bit=self._last)
+
+        if self.tick_of:
+            frame.start_tick = self.tick_of(frame.start_bit)
+            frame.end_tick = self.tick_of(frame.end_bit + 1)
+
+        return frame
+
+
+def window_frames(store, count, bit_base):
+    # the first count frames of a FrameStore from bit_base on, the idle run in front of the
+    # first one is cut back so it does not reach out of the window
+    first = int(np.searchsorted(store.column('start_bit')[:count], bit_base))
+    frames = [store[row] for row in range(first, count)]
+    if frames and frames[0].start_bit - frames[0].idle_bits < bit_base:
+        frames[0].idle_bits = frames[0].start_bit - bit_base
+    return frames
+
+
+def bits_to_int(bits):
+    if len(bits) == 0:
+        return 0
+    # b'\x00\x01\x01'.hex() == '000101', every second digit is a bit
+    return int(bytes(bits).hex()[1::2], 2)
+
+
+class BitTiming:
+    # Default matches the CAN_Reader board: TIM2 at 0.1 us/tick on a 500 kbit/s bus.
+    # data_bitrate and data_sample_point are used inside CAN FD data phases. switch_points are the
+    # transmitter's nominal and data sample points, the bit rate changes at those in BRS and the CRC
+    # delimiter; sample_point is only where this decoder samples. sjw and data_sjw are the
+    # resynchronization jump widths, in bits like the sample points, see BitSampler. As wide as the
+    # sample point allows by default, that keeps up with the most clock error
+
+    def __init__(self, bitrate=500_000, tick_hz=10_000_000, sample_point=0.5,
+                 data_bitrate=2_000_000, data_sample_point=0.5, switch_points=(0.8, 0.7), sjw=0.5, data_sjw=0.5):
+        self.bitrate = bitrate
+        self.tick_hz = tick_hz
+        self.sample_point = sample_point
+        self.data_bitrate = data_bitrate
+        self.data_sample_point = data_sample_point
+        self.switch_points = switch_points
+        self.sjw = sjw
+        self.data_sjw = data_sjw
+
+    def __repr__(self):
+        return (f"BitTiming(bitrate={self.bitrate}, tick_hz={self.tick_hz}, sample_point={self.sample_point}, "
+                f"sjw={self.sjw}, data_bitrate={self.data_bitrate})")
+
+    def data_phase(self):
+        return BitTiming(self.data_bitrate, self.tick_hz, self.data_sample_point, sjw=self.data_sjw)
+
+    @property
+    def bit_ticks(self):
+        return self.tick_hz / self.bitrate
+
+    @property
+    def sample_ticks(self):
+        return self.sample_point * self.bit_ticks
+
+    @property
+    def sjw_ticks(self):
+        return self.sjw * self.bit_ticks
+
+
+class BitSampler:
+    # ISO 11898 bit synchronization over whole arrays of edges. The bit clock is hard synced to the
+    # recessive to dominant edge after an idle bus (a SOF) and resynced on every other one, by the
+    # phase error but at most sjw; dominant to recessive edges change the level but never move the
+    # clock. Bit k after the last sync at tick `anchor` is sampled at anchor + sample_ticks + k *
+    # bit_ticks. A resync within sjw is the same as a hard sync, so every edge is done at once
+    # assuming that and only the edges after a larger phase error are gone over again one by one.
+    # Started at a bit rate switch, where the clock is only an estimate, the first recessive to
+    # dominant edge gets a hard sync as well
+
+    def __init__(self, timing, anchor=None):
+        self.timing = timing
+        self.anchor = anchor        # tick the bit clock was last synced to
+        self.last = anchor          # tick of the last edge
+        self._hard = True           # the next recessive to dominant edge is a hard sync
+
+    def sample(self, levels, ticks):
+        # levels and ticks of a run of edges that all change the level. Returns the bits before each
+        # edge, their count per edge and the tick the first bit after each edge starts at
+        levels = np.asarray(levels)
+        ticks = np.asarray(ticks, dtype=np.float64)
+        n = len(ticks)
+        if not n:
+            return np.empty(0, dtype=np.uint8), np.empty(0, dtype=np.int64), ticks
+        bit_ticks, sample_ticks, sjw = self.timing.bit_ticks, self.timing.sample_ticks, self.timing.sjw_ticks
+        first = ticks[0] if self.last is None else self.last
+
+        prev = np.concatenate(([first], ticks[:-1]))
+        falling = levels == 0
+        hard = falling & (ticks - prev >= HARD_SYNC_BITS * bit_ticks)
+        if self.last is None:
+            # the interval up to the very first edge has no known start, that edge is the first sync
+            hard[0] = True
+        if self._hard and falling.any():
+            hard[np.argmax(falling)] = True
+            self._hard = False
+        syncs = falling | hard
+
+        # where the clock is synced after each edge, if every recessive to dominant edge synced it fully
+        synced = np.maximum.accumulate(np.where(syncs, np.arange(n), -1))
+        after = np.where(synced >= 0, ticks[synced], first if self.anchor is None else self.anchor)
+        before = np.concatenate(([first if self.anchor is None else self.anchor], after[:-1]))
+
+        # sample points from the sync up to the edge and up to the edge before
+        end = np.maximum(np.ceil((ticks - before - sample_ticks) / bit_ticks), 0)
+        start = np.maximum(np.ceil((prev - before - sample_ticks) / bit_ticks), 0)
+        # > 0 for an edge that comes late, in the bit's sync segment or phase segment 1, < 0 for an early one
+        phase = ticks - before - end * bit_ticks
+        late = np.flatnonzero(syncs & ~hard & (np.abs(phase) > sjw))
+
+        if len(late):
+            # plain floats from here on, a badly off clock can make this most of the edges
+            t = ticks.tolist()
+            syncs, hard = syncs.tolist(), hard.tolist()
+            sample_ticks = self.timing.sample_ticks
+            k = int(late[0])
+            anchor, count, error = float(before[k]), float(end[k]), float(phase[k])
+            while k < n:
+                # edge k moves the clock by sjw only, the edges up to the next sync are counted from there
+                anchor += count * bit_ticks + min(max(error, -sjw), sjw)
+                after[k] = anchor
+                count = 0
+                j = k + 1
+                while j < n:
+                    before[j] = anchor
+                    start[j] = count
+                    end[j] = count = max(math.ceil((t[j] - anchor - sample_ticks) / bit_ticks), 0)
+                    if syncs[j]:
+                        error = t[j] - anchor - count * bit_ticks
+                        break
+                    after[j] = anchor
+                    j += 1
+                if j < n and not hard[j] and abs(error) > sjw:
+                    k = j
+                    continue
+                # back in step, on to the next edge that was too far off to begin with
+                k = int(late[np.searchsorted(late, j, side='right')]) if late[-1] > j else n
+                if k < n:
+                    anchor, count, error = float(before[k]), float(end[k]), float(phase[k])
+
+        self.anchor = float(after[-1])
+        self.last = float(ticks[-1])
+
+        counts = np.clip(end - start, 0, MAX_INTERVAL_BITS).astype(np.int64)
+        bits = np.repeat((1 - levels).astype(np.uint8), counts)
+        # the first bit after a sync starts at the sync, after any other edge it is the next one on the clock
+        return bits, counts, np.where(syncs, after, before + end * bit_ticks)
+
+
+def bit_starts(edge_bit, edge_start, switches, bit_ticks):
+    # start tick (CANDecoder.bit_to_tick, unrounded) and length of every bit from edge_bit[0] up to
+    # edge_bit[-1], given a run of edges. switches are CANDecoder.switches
+    edge_bit = np.asarray(edge_bit)
+    counts = np.diff(edge_bit)
+    bits = np.arange(edge_bit[0], edge_bit[-1])
+    base_bit = np.repeat(edge_bit[:-1], counts)
+    base = np.repeat(np.asarray(edge_start[:-1], dtype=np.float64), counts)
+    lengths = np.full(len(bits), float(bit_ticks))
+
+    if switches:
+        switch_bit, switch_tick, switch_ticks = (np.array(column) for column in zip(*switches))
+        k = np.searchsorted(switch_bit, bits, side='right') - 1
+        after = k >= 0
+        lengths[after] = switch_ticks[k[after]]
+        nearer = after & (switch_bit[k] > base_bit)
+        base_bit = np.where(nearer, switch_bit[k], base_bit)
+        base = np.where(nearer, switch_tick[k], base)
+    return base + (bits - base_bit) * lengths, lengths
+
 
 class CANDecoder:
-    def __init__(self, bit_duration=20, offset=8):
+    # Edges go onto one session timeline (see SessionClock) that is never reset by the firmware's
+    # bursts. Frames are kept for the whole session, the waveform only for the last window_bits bits:
+    # bit_data[0] is bit number bit_base and timestamp_data[0] entry number ts_base of the session.
+
+    def __init__(self, timing=None, window_bits=1 << 14, auto_bitrate=False):
         self.bit_data = []
         self.timestamp_data = []
         self.state_data = []
-        self.bit_duration = bit_duration
-        self.offset = offset
-        self.last_time = 0
+        self.timing = timing or BitTiming()
+        self.window_bits = window_bits
+        self.autobaud = None
+        self._held = []
+        if auto_bitrate:
+            self.enable_auto_bitrate()
+        self.last_time = None
+        self.bit_base = 0
+        self.ts_base = 0
+        self.stream = RecordStream()
+        self.clock = SessionClock(self.timing.tick_hz)
+        self.frame_decoder = FrameDecoder()
+        self.frame_decoder.tick_of = self.bit_to_tick
+        self.frame_decoder.rate_switch = self._switch_rate
+        self.stats = BusStats(self.timing.tick_hz)
+        self.frame_decoder.stats = self.stats
+        self.generation = 0
+        self.edge_bit = []          # first bit after every edge in the window
+        self.edge_start = []        # session tick that bit starts at, on the bit clock BitSampler keeps
+        self._edge_tick = []        # session tick of the edge itself
+        self.sampler = BitSampler(self.timing)  # at timing.data_phase() in an FD data phase
+        self._switch_bit = []       # first bit after every bit rate switch in the window (and the one before it)
+        self._switch_tick = []      # tick that bit starts at
+        self._switch_ticks = []     # bit length from there on
+        self.rewind = (0, 0, 0)     # (count, timestamp_data entry, bit) of the last time bits were expanded again
+        self._published = 0         # edges with bits before the current decode call, a snapshot may hold them
+
+        # running totals for PipelineMetrics, never reset
+        self.records_decoded = 0
+        self.frames_decoded = 0
+        self.timers = stage_timers('parse', 'bits', 'frames')
+
+    @property
+    def bit_duration(self):
+        return self.timing.bit_ticks
+
+    @property
+    def offset(self):
+        return self.timing.sample_ticks
+
+    def set_timing(self, timing):
+        self.timing = timing
+        self.reset_data()
+
+    def enable_auto_bitrate(self, min_edges=64):
+        self.autobaud = BitrateEstimator(self.timing.tick_hz, min_edges=min_edges)
+        self._held = []
+
+    def disable_auto_bitrate(self):
+        self.autobaud = None
+        self._held = []
+
+    def _auto_configure(self, levels, ticks):
+        # levels and session ticks of a batch of records, held back until the estimate is confirmed.
+        # Nothing is decoded at a guessed bitrate, so the one switch to the estimate has nothing to
+        # reset, and once confirmed it stays (BitrateEstimator.locked) until the session starts over
+        self.autobaud.add(ticks, levels)
+        bitrate = self.autobaud.bitrate()
+
+        if bitrate is None:
+            self._held.append((levels, ticks))
+            return levels[:0], ticks[:0]
+
+        if bitrate != self.timing.bitrate:
+            timing = copy.copy(self.timing)
+            timing.bitrate = bitrate
+            self.set_timing(timing)
+
+        if self._held:
+            levels = np.concatenate([held for held, _ in self._held] + [levels])
+            ticks = np.concatenate([held for _, held in self._held] + [ticks])
+            self._held = []
+        return levels, ticks
+
+    @property
+    def skipped_bytes(self):
+        return self.stream.skipped_bytes
 
     def get_plot_data(self):
         return self.state_data, self.timestamp_data
@@ -17,53 +842,219 @@ class CANDecoder:
         self.timestamp_data.clear()
         self.bit_data.clear()
         self.total_time = 0
-        self.last_time = 0
+        self.last_time = None
+        self.bit_base = 0
+        self.ts_base = 0
+        self.frame_decoder.reset()
+        self.stats.clear()
+        self.generation += 1
+        self.edge_bit.clear()
+        self.edge_start.clear()
+        self._edge_tick.clear()
+        self.sampler = BitSampler(self.timing)
+        self._switch_bit.clear()
+        self._switch_tick.clear()
+        self._switch_ticks.clear()
 
-    def decode_8byte_data(self, raw_data):
-        i = 0
+    def reset_session(self):
+        # a new source, unlike reset_data the timeline starts over as well
+        self.stream.reset()
+        self.clock.reset()
+        self._held = []
+        if self.autobaud is not None:
+            self.autobaud.reset()
+        self.reset_data()
 
-        while i < len(raw_data):
+    @property
+    def holding(self):
+        # records are being held back until there are enough edges for a bitrate estimate
+        return bool(self._held)
 
-            if raw_data[i:i+3] == b'\x11\x00\x01' or raw_data[i:i+3] == b'\x11\x01\x01':
-                record = raw_data[i:i+8]
-                if len(record) < 8:
-                    continue
+    @property
+    def bitrate_known(self):
+        # False while auto bitrate has not confirmed an estimate, timing.bitrate is only a guess then
+        return self.autobaud is None or self.autobaud.locked is not None
 
-                state = record[1]
-                if len(self.state_data) > 1 and state == self.state_data[-1]:
-                    i += 8
-                    continue
+    def open_frame_tick(self):
+        # session tick of the SOF of the frame being received, None between frames
+        if not self.frame_decoder._in_frame:
+            return None
+        return self.bit_to_tick(self.frame_decoder._start)
 
-                timestamp = struct.unpack("<I", record[4:8])[0]
-            
-                # Debugging output
-                # print(f"Rec: {record[0:4]}          {record[4:8]}           Lev: {state}    Dur: {timestamp}")
-                
-                if len(self.timestamp_data) > 0 and timestamp < self.timestamp_data[-1]:
-                    self.reset_data()
+    @property
+    def switches(self):
+        # (first bit, tick it starts at, bit length) of every bit rate switch still needed in the window
+        return tuple(zip(self._switch_bit, self._switch_tick, self._switch_ticks))
 
-                if timestamp > 3150:
-                    break
+    def bit_to_tick(self, bit_idx):
+        j = bisect.bisect_right(self.edge_bit, bit_idx) - 1
+        if j < 0:
+            if not self.edge_bit:
+                return round(bit_idx * self.bit_duration)
+            j = 0
+        bit, tick, bit_ticks = self.edge_bit[j], self.edge_start[j], self.bit_duration
 
-                if len(self.state_data) >= 1:
-                    self.state_data.append(self.state_data[-1])
-                    self.timestamp_data.append(timestamp)
-                    
-                self.state_data.append(state)
-                self.timestamp_data.append(timestamp)
+        # the latest bit rate switch sets the bit length, and is the reference when it is nearer than the edge
+        k = bisect.bisect_right(self._switch_bit, bit_idx) - 1
+        if k >= 0:
+            bit_ticks = self._switch_ticks[k]
+            if self._switch_bit[k] > bit:
+                bit, tick = self._switch_bit[k], self._switch_tick[k]
+        return round(tick + (bit_idx - bit) * bit_ticks)
 
-                duration = timestamp - self.last_time
+    def _switch_rate(self, bit, fast):
+        # FrameDecoder hook: the bits after session bit `bit` come at the data bit rate (fast) or back at
+        # the nominal one. The switch happens at the transmitter's sample point in `bit`, the bit clock
+        # starts over there at the new bit length and the edges from there on are sampled again. Only
+        # SAMPLE_AHEAD_BITS of them, decode_8byte_data takes care of the rest in growing blocks: a frame
+        # later the rate may switch again and they would be sampled once more. Those edges are normally
+        # all new since the last decode call, rewind tells the plotter where to start over when they are not.
+        # Only the first such switch of a call moves it, the ones after it fall in what is redone anyway
+        nominal, data = self.timing, self.timing.data_phase()
+        old, new = (nominal, data) if fast else (data, nominal)
+        at_old, at_new = self.timing.switch_points if fast else self.timing.switch_points[::-1]
+        start = self.bit_to_tick(bit) + at_old * old.bit_ticks + (1 - at_new) * new.bit_ticks
 
-                while duration > self.offset:
-                    self.bit_data.append(1 - state)
-                    duration -= self.bit_duration
-                    pass
+        self.sampler = BitSampler(new, start)
+        self._switch_bit.append(bit + 1)
+        self._switch_tick.append(start)
+        self._switch_ticks.append(new.bit_ticks)
 
-                self.last_time = timestamp
-                
-                i += 8
+        j = bisect.bisect_right(self.edge_bit, bit) - 1
+        del self.bit_data[bit + 1 - self.bit_base:]
+        if j < 0:
+            return
+        if j + 1 < self._published:
+            self._published = j + 1
+            self.rewind = (self.rewind[0] + 1, self.ts_base + 2 * j, self.edge_bit[j])
+        del self.edge_bit[j + 1:]
+        del self.edge_start[j + 1:]
+        self._sample_edges(start + SAMPLE_AHEAD_BITS * new.bit_ticks)
+
+    def _sample_edges(self, until=None):
+        # the edges that have no bits yet, up to tick `until`
+        first = len(self.edge_bit)
+        stop = len(self._edge_tick) if until is None else bisect.bisect_right(self._edge_tick, until, first)
+        if stop == first:
+            return
+        ticks = np.array(self._edge_tick[first:stop], dtype=np.float64)
+        # edge k's level is state_data[2 * k], see _trim
+        levels = np.array(self.state_data[2 * first:2 * stop:2], dtype=np.int64)
+        bits, counts, starts = self.sampler.sample(levels, ticks)
+
+        self.edge_bit.extend((self.bit_base + len(self.bit_data) + np.cumsum(counts)).tolist())
+        self.edge_start.extend(starts.tolist())
+        self.bit_data.extend(bits.tolist())
+
+    def get_frames(self):
+        # frames that still have their bits in the window, the one being received last
+        frames = window_frames(self.frame_decoder.frames, len(self.frame_decoder.frames), self.bit_base)
+        pending = self.frame_decoder.pending_frame()
+        if pending:
+            frames.append(pending)
+        return frames, self.frame_decoder.stuff_pos
+
+    def decode_8byte_data(self, raw_data, arrival=None):
+        # arrival is the host time.monotonic() the data came in at, live ports only
+        t0 = time.perf_counter()
+        records = self.stream.feed(raw_data)
+        self.records_decoded += len(records)
+
+        levels = records['level'].astype(np.int64)
+        ticks = self.clock.unwrap(records['timestamp'], records['burst'], arrival)
+        if self.autobaud is not None and len(levels):
+            levels, ticks = self._auto_configure(levels, ticks)
+
+        t1 = time.perf_counter()
+        if len(levels):
+            self._decode_edges(levels, ticks)
+
+        # all new edges are sampled and handed to the frame decoder. A bit rate switch samples the edges
+        # after it once more (_switch_rate), so from there on they go in blocks that double in size
+        t2 = time.perf_counter()
+        sampling = 0.0
+        closed = len(self.frame_decoder.frames)
+        ahead = None
+        self._published = len(self.edge_bit)
+        while len(self.edge_bit) < len(self._edge_tick):
+            t = time.perf_counter()
+            if ahead is None:
+                self._sample_edges()
             else:
-                i += 1
+                self._sample_edges(self._edge_tick[len(self.edge_bit)] + ahead * self.sampler.timing.bit_ticks)
+            sampling += time.perf_counter() - t
+            switches = len(self._switch_bit)
+            self.frame_decoder.feed(self.bit_data, self.bit_base)
+            if len(self._switch_bit) != switches:
+                ahead = SAMPLE_AHEAD_BITS
+            elif ahead is not None:
+                ahead *= 2
+        self.frames_decoded += len(self.frame_decoder.frames) - closed
+        if self.last_time is not None:
+            self.stats.advance(self.last_time)
+        self._trim()
+
+        t3 = time.perf_counter()
+        self.timers['parse'].add(t1 - t0)
+        self.timers['bits'].add(t2 - t1 + sampling)
+        # destuffing and frame decoding happen bit by bit in the same pass, as does sampling again at a
+        # bit rate switch
+        self.timers['frames'].add(t3 - t2 - sampling)
+
+    def _decode_edges(self, levels, timestamps):
+        # drop records that repeat the level already on the bus
+        prev = np.empty_like(levels)
+        prev[0] = self.state_data[-1] if self.state_data else -1
+        prev[1:] = levels[:-1]
+        keep = levels != prev
+        levels, timestamps = levels[keep], timestamps[keep]
+        if not len(levels):
+            return
+
+        # step plot points: (previous level, t) then (new level, t) for every edge
+        prev_levels = np.empty_like(levels)
+        prev_levels[0] = self.state_data[-1] if self.state_data else 0
+        prev_levels[1:] = levels[:-1]
+        states = np.column_stack([prev_levels, levels]).ravel()
+        times = np.repeat(timestamps, 2)
+        if not self.state_data:
+            states, times = states[1:], times[1:]
+        self.state_data.extend(states.tolist())
+        self.timestamp_data.extend(times.tolist())
+
+        self._edge_tick.extend(timestamps.tolist())
+        self.last_time = int(timestamps[-1])
+
+    def _trim(self):
+        # once the window is twice window_bits long it is cut back at an edge, frames are not touched
+        if len(self.bit_data) <= 2 * self.window_bits:
+            return
+
+        target = self.bit_base + len(self.bit_data) - self.window_bits
+        edge = bisect.bisect_right(self.edge_bit, target) - 1
+        if edge <= 0:
+            return
+
+        # timestamp_data starts with edge 0 on its own, then holds two entries per edge
+        bit_base = self.edge_bit[edge]
+        del self.bit_data[:bit_base - self.bit_base]
+        del self.state_data[:2 * edge]
+        del self.timestamp_data[:2 * edge]
+        del self.edge_bit[:edge]
+        del self.edge_start[:edge]
+        del self._edge_tick[:edge]
+        self.bit_base = bit_base
+        self.ts_base += 2 * edge
+
+        stuff_pos = self.frame_decoder.stuff_pos
+        del stuff_pos[:bisect.bisect_left(stuff_pos, bit_base)]
+
+        # the last switch before the window still gives the bit length at its start
+        switch = bisect.bisect_right(self._switch_bit, bit_base) - 1
+        if switch > 0:
+            del self._switch_bit[:switch]
+            del self._switch_tick[:switch]
+            del self._switch_ticks[:switch]
 
     def decode_frame_type(self, bits):
         frames = []
@@ -133,6 +1124,9 @@ class CANDecoder:
                 if len(bits[current_idx:current_idx+15]) < 5:
                     break
 
+                # a frame cut short is padded with recessive bits so it still decodes, but flagged
+                frame_info['Truncated'] = current_idx + 28 > len(bits)
+
                 while len(bits[current_idx:current_idx+15]) < 15:
                     bits.append(1)
                 # CRC (next 15 bits after data)
@@ -175,7 +1169,8 @@ class CANDecoder:
         print("finished decoding frames")
         return frames
     
-    def remove_stuff_bits(self, bitstream):
+    def remove_stuff_bits(self, bitstream, errors=None):
+        # errors, when given, gets the position of every sixth equal bit (a stuff error), that bit is kept
         un_stf_bits = [bitstream[0]]
         stf_bit_pos = []
 
@@ -187,6 +1182,8 @@ class CANDecoder:
             bit_cnt += 1
             if bit == last_bit:
                 cnt += 1
+                if cnt == 6 and errors is not None:
+                    errors.append(bit_cnt)
                 un_stf_bits.append(bit)
             else:
                 if cnt == 5:
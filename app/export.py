@@ -0,0 +1,228 @@
+"""Headless capture decoder, writes every frame of a capture as a table.
+
+    python app/export.py capture.cancap -o frames.csv
+    python app/export.py bench.cancap -o frames.npz --bitrate 250000
+    python app/export.py old_log.txt -o frames.jsonl --format jsonl
+    python app/export.py capture.cancap -o frames.npz --signals signals.yaml
+    python app/export.py fd_bus.cancap -o frames.csv --data-bitrate 5000000
+
+Reads .cancap captures, the repr() text logs written by older versions and plain
+binary dumps of the serial stream. Only numpy is needed, no display; --signals adds
+the decoded signal values (see app/signals.py) and needs PyYAML. CAN FD frames
+are decoded with their data phase at --data-bitrate (2 Mbit/s unless given).
+"""
+import argparse
+import ast
+import csv
+import json
+import os
+import sys
+
+import numpy as np
+
+from autobaud import BitrateEstimator
+from capture import MAGIC, CaptureReader
+from decoder import BitTiming, CANDecoder, RecordStream
+from frames import FLAG_BRS, FLAG_FDF, FrameStore
+from timeline import SessionClock
+
+COLUMNS = ('timestamp', 'id', 'ide', 'rtr', 'dlc', 'data', 'crc_ok', 'fd', 'brs')
+FORMATS = ('csv', 'jsonl', 'npz')
+
+
+def read_blocks(path, chunk_size=1 << 20):
+    # EdgeRecord arrays from any of the supported capture files
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+
+    if magic == MAGIC:
+        with CaptureReader(path) as reader:
+            yield from reader.records()
+        return
+
+    stream = RecordStream()
+    if path.endswith('.txt'):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    yield stream.feed(ast.literal_eval(line))
+    else:
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                yield stream.feed(chunk)
+
+
+def capture_info(path):
+    # (tick Hz, bitrate) from the capture header, bitrate 0 when unknown
+    try:
+        with CaptureReader(path) as reader:
+            return reader.tick_hz, reader.bitrate
+    except ValueError:
+        return BitTiming().tick_hz, 0
+
+
+def estimate_bitrate(path, tick_hz):
+    estimator = BitrateEstimator(tick_hz)
+    clock = SessionClock(tick_hz)
+    for records in read_blocks(path):
+        estimator.add(clock.unwrap(records['timestamp'], records['burst']), records['level'])
+        bitrate = estimator.bitrate()
+        if bitrate:
+            return bitrate
+    # not confirmed yet, but the whole capture went into it
+    return estimator.estimate()
+
+
+def iter_frames(blocks, timing):
+    # (capture tick, CANFrame) for every frame, the decoder's session ticks match the capture's
+    decoder = CANDecoder(timing)
+    emitted = 0
+
+    for records in blocks:
+        if not len(records):
+            continue
+
+        decoder.decode_8byte_data(records.tobytes())
+        frames = decoder.frame_decoder.frames
+        for frame in frames[emitted:]:
+            yield frame.start_tick, frame
+        emitted = len(frames)
+
+    pending = decoder.frame_decoder.pending_frame()
+    if pending:
+        yield pending.start_tick, pending
+
+
+class CsvWriter:
+    def __init__(self, path, tick_hz, signals=None):
+        self.tick_hz = tick_hz
+        self.signals = signals
+        self._file = open(path, 'w', newline='')
+        self._csv = csv.writer(self._file)
+        self._csv.writerow(COLUMNS + (('signals',) if signals else ()))
+
+    def write(self, tick, frame):
+        row = [f"{tick / self.tick_hz:.7f}", f"0x{frame.can_id:x}", frame.ide, frame.rtr,
+               frame.dlc, frame.data.hex(), int(frame.crc_ok), frame.fdf, frame.brs]
+        if self.signals:
+            decoded = self.signals.decode(frame)
+            row.append("; ".join(f"{decoded[0]}.{signal}={value:g}{' ' + unit if unit else ''}"
+                                 for signal, value, unit in decoded[1]) if decoded else "")
+        self._csv.writerow(row)
+
+    def close(self):
+        self._file.close()
+
+
+class JsonlWriter:
+    def __init__(self, path, tick_hz, signals=None):
+        self.tick_hz = tick_hz
+        self.signals = signals
+        self._file = open(path, 'w')
+
+    def write(self, tick, frame):
+        row = dict(zip(COLUMNS, (round(tick / self.tick_hz, 7), frame.can_id, frame.ide, frame.rtr,
+                                 frame.dlc, frame.data.hex(), frame.crc_ok, frame.fdf, frame.brs)))
+        decoded = self.signals.decode(frame) if self.signals else None
+        if decoded:
+            row['message'] = decoded[0]
+            row['signals'] = {signal: value for signal, value, _ in decoded[1]}
+        self._file.write(json.dumps(row) + '\n')
+
+    def close(self):
+        self._file.close()
+
+
+class NpzWriter:
+    # columns are collected in a FrameStore and written in one go on close, signals are decoded
+    # in bulk then and stored as "<message>.<signal>" plus "<message>.rows" (the frame numbers)
+
+    def __init__(self, path, tick_hz, signals=None):
+        self.path = path
+        self.tick_hz = tick_hz
+        self.signals = signals
+        self.store = FrameStore()
+        self.ticks = []
+
+    def write(self, tick, frame):
+        self.store.append(frame)
+        self.ticks.append(tick)
+
+    def close(self):
+        rows = self.store.rows()
+        columns = {}
+        if self.signals:
+            for message, values in self.signals.decode_rows(rows).items():
+                columns.update({f"{message}.{name}": column for name, column in values.items()})
+        np.savez(self.path,
+                 **columns,
+                 timestamp=np.array(self.ticks, dtype=np.int64) / self.tick_hz,
+                 id=rows['can_id'],
+                 ide=(rows['flags'] & 1).astype(np.uint8),
+                 rtr=((rows['flags'] >> 1) & 1).astype(np.uint8),
+                 dlc=rows['dlc'],
+                 data=self.store.data(),
+                 crc_ok=rows['crc'] == rows['crc_calc'],
+                 fd=((rows['flags'] & FLAG_FDF) != 0).astype(np.uint8),
+                 brs=((rows['flags'] & FLAG_BRS) != 0).astype(np.uint8))
+
+
+WRITERS = {'csv': CsvWriter, 'jsonl': JsonlWriter, 'npz': NpzWriter}
+
+
+def export(path, out_path, fmt, bitrate=None, signals_path=None, data_bitrate=None):
+    signals = None
+    if signals_path:
+        from signals import load_signals
+        signals = load_signals(signals_path)
+
+    tick_hz, header_bitrate = capture_info(path)
+    bitrate = bitrate or header_bitrate or estimate_bitrate(path, tick_hz)
+    if not bitrate:
+        raise ValueError(f"{path}: no bitrate in the header and too few edges to estimate one")
+
+    timing = BitTiming(bitrate, tick_hz)
+    if data_bitrate:
+        timing.data_bitrate = data_bitrate
+
+    writer = WRITERS[fmt](out_path, tick_hz, signals)
+    count = 0
+    try:
+        for tick, frame in iter_frames(read_blocks(path), timing):
+            writer.write(tick, frame)
+            count += 1
+    finally:
+        writer.close()
+    return count, bitrate
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('capture')
+    parser.add_argument('-o', '--output', help="defaults to the capture name with the format's extension")
+    parser.add_argument('-f', '--format', choices=FORMATS,
+                        help="defaults to the output extension, or csv")
+    parser.add_argument('-b', '--bitrate', type=int, help="overrides the capture header / estimate")
+    parser.add_argument('-d', '--data-bitrate', type=int, help="CAN FD data phase bitrate")
+    parser.add_argument('-s', '--signals', help="YAML signal definitions, adds the decoded values")
+    args = parser.parse_args(argv)
+
+    fmt = args.format
+    if fmt is None and args.output:
+        ext = os.path.splitext(args.output)[1].lstrip('.')
+        fmt = ext if ext in FORMATS else None
+    fmt = fmt or 'csv'
+    out_path = args.output or os.path.splitext(args.capture)[0] + '.' + fmt
+
+    try:
+        count, bitrate = export(args.capture, out_path, fmt, args.bitrate, args.signals, args.data_bitrate)
+    except (OSError, ValueError) as e:
+        print(f"export: {e}", file=sys.stderr)
+        return 1
+
+    print(f"{count} frames at {bitrate} bit/s written to {out_path}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,403 @@
+import numpy as np
+
+# CD, ACK, AD, EOF x7, IFS x3 as sent by an acknowledged frame
+TAIL_OK = 0b1011111111111
+TAIL_LEN = 13
+
+FRAME_DTYPE = np.dtype([('can_id', '<u4'),
+                        ('flags', 'u1'),
+                        ('dlc', 'u1'),
+                        ('data', 'u1', (8,)),          # a CAN FD payload past 8 bytes is kept by FrameStore
+                        ('crc', '<u4'),
+                        ('crc_calc', '<u4'),
+                        ('stuff_count', 'u1'),
+                        ('tail', '<u2'),
+                        ('idle_bits', '<u4'),
+                        ('start_bit', '<i8'),
+                        ('end_bit', '<i8'),
+                        ('start_tick', '<i8'),
+                        ('end_tick', '<i8')])
+
+FLAG_IDE = 0x01
+FLAG_RTR = 0x02
+FLAG_SRR = 0x04
+FLAG_R0 = 0x08
+FLAG_R1 = 0x10
+FLAG_FDF = 0x20
+FLAG_BRS = 0x40
+FLAG_ESI = 0x80
+
+# CAN FD payload length for every DLC code
+FD_DLC_LEN = (0, 1, 2, 3, 4, 5, 6, 7, 8, 12, 16, 20, 24, 32, 48, 64)
+
+# bits of a frame's tail value, see CANFrame.fields()
+TAIL_ACK = 1 << 11
+TAIL_RECESSIVE = (1 << TAIL_LEN) - 1
+
+# protocol errors as the bus shows them, the position is the session bit they show at
+ERR_STUFF = 0           # six equal bits where a stuff bit was due
+ERR_CRC = 1             # CRC field does not match the frame
+ERR_ACK = 2             # nobody acknowledged, the ACK slot stayed recessive
+ERR_CRC_DELIM = 3       # form error, dominant CRC delimiter
+ERR_ACK_DELIM = 4       # form error, dominant ACK delimiter
+ERR_EOF = 5             # form error, dominant bit in the end of frame
+ERR_ACTIVE_FLAG = 6     # active error frame, six or more dominant bits
+ERR_PASSIVE_FLAG = 7    # passive error frame, a frame broken off by six recessive bits and no active flag
+ERR_OVERLOAD = 8        # overload frame, dominant bit in the intermission or the last EOF bit
+ERROR_KINDS = ('stuff', 'crc', 'ack', 'crc_delim', 'ack_delim', 'eof', 'active_flag', 'passive_flag', 'overload')
+
+ERROR_DTYPE = np.dtype([('kind', 'u1'),
+                        ('bit', '<i8'),
+                        ('frame_start', '<i8'),     # SOF of the frame it hit, -1 outside a frame
+                        ('tick', '<i8')])
+
+
+def data_len(dlc, fdf=0):
+    # data bytes a DLC stands for
+    return FD_DLC_LEN[dlc] if fdf else min(dlc, 8)
+
+
+class CANFrame:
+    # fdf marks a CAN FD frame: rtr is then the RRS bit, r0 the res bit, brs/esi are set and the
+    # CRC is CRC-17 or CRC-21 behind the stuff count
+
+    __slots__ = ('can_id', 'ide', 'rtr', 'srr', 'r0', 'r1', 'fdf', 'brs', 'esi', 'dlc', 'data',
+                 'crc', 'crc_calc', 'stuff_count', 'tail', 'idle_bits',
+                 'start_bit', 'end_bit', 'start_tick', 'end_tick')
+
+    def __init__(self, can_id, ide=0, rtr=0, dlc=0, data=b'', crc=0, crc_calc=0,
+                 srr=1, r0=0, r1=0, tail=TAIL_OK, idle_bits=0,
+                 start_bit=0, end_bit=0, start_tick=0, end_tick=0,
+                 fdf=0, brs=0, esi=0, stuff_count=0):
+        self.can_id = can_id
+        self.ide = ide
+        self.rtr = rtr
+        self.srr = srr
+        self.r0 = r0
+        self.r1 = r1
+        self.fdf = fdf
+        self.brs = brs
+        self.esi = esi
+        self.stuff_count = stuff_count
+        self.dlc = dlc
+        self.data = data
+        self.crc = crc
+        self.crc_calc = crc_calc
+        self.tail = tail
+        self.idle_bits = idle_bits
+        self.start_bit = start_bit
+        self.end_bit = end_bit
+        self.start_tick = start_tick
+        self.end_tick = end_tick
+
+    @classmethod
+    def from_row(cls, row, data=None):
+        # one FRAME_DTYPE row (or a record with the same fields) back into a CANFrame, data is the whole
+        # payload when the row only holds the first 8 bytes of it
+        flags = int(row['flags'])
+        dlc = int(row['dlc'])
+        fdf = int(bool(flags & FLAG_FDF))
+        n_data = 0 if flags & FLAG_RTR else data_len(dlc, fdf)
+        return cls(int(row['can_id']),
+                   ide=int(bool(flags & FLAG_IDE)),
+                   rtr=int(bool(flags & FLAG_RTR)),
+                   srr=int(bool(flags & FLAG_SRR)),
+                   r0=int(bool(flags & FLAG_R0)),
+                   r1=int(bool(flags & FLAG_R1)),
+                   fdf=fdf,
+                   brs=int(bool(flags & FLAG_BRS)),
+                   esi=int(bool(flags & FLAG_ESI)),
+                   stuff_count=int(row['stuff_count']),
+                   dlc=dlc,
+                   data=(row['data'] if data is None else data)[:n_data].tobytes(),
+                   crc=int(row['crc']),
+                   crc_calc=int(row['crc_calc']),
+                   tail=int(row['tail']),
+                   idle_bits=int(row['idle_bits']),
+                   start_bit=int(row['start_bit']),
+                   end_bit=int(row['end_bit']),
+                   start_tick=int(row['start_tick']),
+                   end_tick=int(row['end_tick']))
+
+    def __repr__(self):
+        kind = ('ext' if self.ide else 'std') + (' fd' if self.fdf else '') + (' brs' if self.brs else '')
+        return f"CANFrame(id=0x{self.can_id:x}, {kind}, rtr={self.rtr}, dlc={self.dlc}, data={self.data.hex()}, crc_ok={self.crc_ok})"
+
+    @property
+    def frame_type(self):
+        return ('Extended' if self.ide else 'Standard') + (' FD' if self.fdf else '')
+
+    @property
+    def subtype(self):
+        return 'Remote' if self.rtr and not self.fdf else 'Data'
+
+    @property
+    def crc_len(self):
+        if not self.fdf:
+            return 15
+        return 17 if data_len(self.dlc, 1) <= 16 else 21
+
+    @property
+    def base_id(self):
+        return self.can_id >> 18 if self.ide else self.can_id
+
+    @property
+    def crc_ok(self):
+        return self.crc == self.crc_calc
+
+    @property
+    def ack(self):
+        return (self.tail >> 11) & 1
+
+    def fields(self):
+        # (name, width, value) in wire order, stuff bits excluded
+        out = []
+        if self.idle_bits:
+            out.append(('IDLE ', self.idle_bits, (1 << self.idle_bits) - 1))
+
+        out.append(('SOF', 1, 0))
+        if self.fdf:
+            if self.ide:
+                out += [('BASE ID', 11, self.can_id >> 18),
+                        ('SRR', 1, self.srr),
+                        ('IDE', 1, 1),
+                        ('EXT ID', 18, self.can_id & 0x3FFFF),
+                        ('RRS', 1, self.rtr)]
+            else:
+                out += [('ID', 11, self.can_id),
+                        ('RRS', 1, self.rtr),
+                        ('IDE', 1, 0)]
+            out += [('FDF', 1, 1),
+                    ('res', 1, self.r0),
+                    ('BRS', 1, self.brs),
+                    ('ESI', 1, self.esi)]
+        elif self.ide:
+            out += [('BASE ID', 11, self.can_id >> 18),
+                    ('SRR', 1, self.srr),
+                    ('IDE', 1, 1),
+                    ('EXT ID', 18, self.can_id & 0x3FFFF),
+                    ('RTR', 1, self.rtr),
+                    ('r0', 1, self.r0),
+                    ('r1', 1, self.r1)]
+        else:
+            out += [('ID', 11, self.can_id),
+                    ('RTR', 1, self.rtr),
+                    ('IDE', 1, 0),
+                    ('r0', 1, self.r0)]
+
+        out.append(('DLC', 4, self.dlc))
+        for i, byte in enumerate(self.data):
+            out.append((f'Data{i}', 8, byte))
+        if self.fdf:
+            # the fixed stuff bits in front of it and inside the CRC are stuff bits like any other
+            out.append(('SC', 4, self.stuff_count))
+
+        tail = self.tail
+        out += [('CRC', self.crc_len, self.crc),
+                ('CD', 1, (tail >> 12) & 1),
+                ('ACK', 1, (tail >> 11) & 1),
+                ('AD', 1, (tail >> 10) & 1),
+                ('EOF', 7, (tail >> 3) & 0x7F),
+                ('IFS', 3, tail & 0x7)]
+        return out
+
+
+class FrameStore:
+    # Columnar frame history backed by one growing structured array. A row has room for a classic
+    # frame's 8 data bytes, the 64 byte payloads of CAN FD frames with more go to a pool next to it
+    # in row order
+
+    def __init__(self, capacity=1024):
+        self._rows = np.zeros(capacity, dtype=FRAME_DTYPE)
+        self._len = 0
+        self._payload_rows = _Column()
+        self._payloads = np.zeros((16, 64), dtype=np.uint8)
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for i in range(self._len):
+            yield self[i]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[k] for k in range(*i.indices(self._len))]
+        if i < 0:
+            i += self._len
+        if not 0 <= i < self._len:
+            raise IndexError(i)
+
+        return CANFrame.from_row(self._rows[i], self.payload(i))
+
+    def clear(self):
+        self._len = 0
+        self._payload_rows = _Column()
+
+    def append(self, frame):
+        if self._len == len(self._rows):
+            grown = np.zeros(len(self._rows) * 2, dtype=FRAME_DTYPE)
+            grown[:self._len] = self._rows
+            self._rows = grown
+
+        flags = ((FLAG_IDE if frame.ide else 0) | (FLAG_RTR if frame.rtr else 0) |
+                 (FLAG_SRR if frame.srr else 0) | (FLAG_R0 if frame.r0 else 0) |
+                 (FLAG_R1 if frame.r1 else 0) | (FLAG_FDF if frame.fdf else 0) |
+                 (FLAG_BRS if frame.brs else 0) | (FLAG_ESI if frame.esi else 0))
+        data = np.frombuffer(frame.data[:8].ljust(8, b'\x00'), dtype=np.uint8)
+        if len(frame.data) > 8:
+            self._add_payload(frame.data)
+
+        self._rows[self._len] = (frame.can_id, flags, frame.dlc, data,
+                                 frame.crc, frame.crc_calc, frame.stuff_count, frame.tail, frame.idle_bits,
+                                 frame.start_bit, frame.end_bit,
+                                 frame.start_tick, frame.end_tick)
+        self._len += 1
+
+    def _add_payload(self, data):
+        n = self._payload_rows.n
+        if n == len(self._payloads):
+            grown = np.zeros((n * 2, 64), dtype=np.uint8)
+            grown[:n] = self._payloads[:n]
+            self._payloads = grown
+        self._payloads[n] = np.frombuffer(data.ljust(64, b'\x00'), dtype=np.uint8)
+        self._payload_rows.append(self._len)
+
+    def payload(self, i):
+        # the 64 byte payload of row i, None when the row holds all of it
+        rows = self._payload_rows.view()
+        k = int(np.searchsorted(rows, i))
+        if k < len(rows) and rows[k] == i:
+            return self._payloads[k]
+        return None
+
+    def data(self, n=None):
+        # payloads of the first n rows (all of them by default) as one (n, 64) array
+        n = self._len if n is None else min(n, self._len)
+        out = np.zeros((n, 64), dtype=np.uint8)
+        out[:, :8] = self._rows['data'][:n]
+        rows = self._payload_rows.view()
+        k = int(np.searchsorted(rows, n))
+        out[rows[:k]] = self._payloads[:k]
+        return out
+
+    def column(self, name):
+        return self._rows[name][:self._len]
+
+    def rows(self):
+        return self._rows[:self._len]
+
+
+class ErrorLog:
+    # Columnar protocol error history, append-only like FrameStore
+
+    def __init__(self, capacity=256):
+        self._rows = np.zeros(capacity, dtype=ERROR_DTYPE)
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def append(self, kind, bit, frame_start=-1, tick=0):
+        if self._len == len(self._rows):
+            grown = np.zeros(len(self._rows) * 2, dtype=ERROR_DTYPE)
+            grown[:self._len] = self._rows
+            self._rows = grown
+        self._rows[self._len] = (kind, bit, frame_start, tick)
+        self._len += 1
+
+    def rows(self, n=None):
+        return self._rows[:self._len if n is None else min(n, self._len)]
+
+    def counts(self, n=None):
+        # {kind name: count}
+        per_kind = np.bincount(self.rows(n)['kind'], minlength=len(ERROR_KINDS))
+        return dict(zip(ERROR_KINDS, per_kind.tolist()))
+
+
+class _Column:
+    # Append-only int64 column (rows of width values when width is set), grows by copying
+    # so a reader holding an older length keeps seeing consistent data
+
+    __slots__ = ('data', 'n')
+
+    def __init__(self, capacity=16, width=None):
+        self.data = np.empty(capacity if width is None else (capacity, width), dtype=np.int64)
+        self.n = 0
+
+    def append(self, value):
+        if self.n == len(self.data):
+            grown = np.empty((len(self.data) * 2,) + self.data.shape[1:], dtype=np.int64)
+            grown[:self.n] = self.data[:self.n]
+            self.data = grown
+        self.data[self.n] = value
+        self.n += 1
+
+    def view(self, n=None):
+        return self.data[:self.n if n is None else min(n, self.n)]
+
+
+class FrameIndex:
+    # Start ticks of every closed frame in FrameStore order plus a (row, tick) posting list per CAN ID,
+    # frames arrive in time order so both stay sorted and a query is two binary searches per ID
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return self._ticks.n
+
+    def clear(self):
+        self._ticks = _Column(1024)
+        self._postings = {}
+
+    def add(self, frame):
+        row = self._ticks.n
+        posting = self._postings.get(frame.can_id)
+        if posting is None:
+            posting = self._postings[frame.can_id] = _Column(width=2)
+        posting.append((row, frame.start_tick))
+        self._ticks.append(frame.start_tick)
+
+    def ids(self):
+        return sorted(self._postings)
+
+    def count(self, can_id, limit=None):
+        posting = self._postings.get(can_id)
+        if posting is None:
+            return 0
+        rows = posting.view()[:, 0]
+        return len(rows) if limit is None else int(np.searchsorted(rows, limit))
+
+    def query(self, ids=None, t0=None, t1=None, limit=None):
+        # FrameStore rows with t0 <= start tick <= t1, limit caps the rows seen (a snapshot's frame count)
+        n = len(self) if limit is None else min(limit, len(self))
+
+        if ids is None:
+            lo, hi = _tick_bounds(self._ticks.view(n), t0, t1)
+            return np.arange(lo, hi, dtype=np.int64)
+
+        if isinstance(ids, int):
+            ids = (ids,)
+
+        parts = []
+        for can_id in ids:
+            posting = self._postings.get(can_id)
+            if posting is None:
+                continue
+            entries = posting.view()
+            entries = entries[:np.searchsorted(entries[:, 0], n)]
+            lo, hi = _tick_bounds(entries[:, 1], t0, t1)
+            parts.append(entries[lo:hi, 0])
+
+        if not parts:
+            return np.empty(0, dtype=np.int64)
+        if len(parts) == 1:
+            return parts[0].copy()
+        return np.sort(np.concatenate(parts))
+
+
+def _tick_bounds(ticks, t0, t1):
+    lo = 0 if t0 is None else int(np.searchsorted(ticks, t0, side='left'))
+    hi = len(ticks) if t1 is None else int(np.searchsorted(ticks, t1, side='right'))
+    return lo, max(lo, hi)
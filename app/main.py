@@ -6,19 +6,199 @@ from PIL import Image, ImageTk
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib.animation import FuncAnimation
-from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg, NavigationToolbar2Tk
 matplotlib.use("TkAgg")
 
 import serial.tools.list_ports
 
+import argparse
 import threading
 
 from plotter import Plotter
+from metrics import MetricsDump, PipelineMetrics
+from capture import save_capture
+from replay import ReplayReader
+from synth import SyntheticBus
+from multiport import SYNTHETIC_PORT, CaptureManager
+from busstats import gap_bin_labels
+from signals import load_signals
+from frames import CANFrame
 
 READ_INTERVAL = 100
+BITRATE_CHOICES = ["Auto", "1000000", "800000", "500000", "250000", "125000"]
+DATA_BITRATE_CHOICES = ["2000000", "4000000", "5000000"]       # CAN FD data phase
+MULTIPORT_ROWS = 1000
+STATUS_INTERVAL = 1000
+STATS_TOP_IDS = 50
+
+class MultiPortWindow(tk.Toplevel):
+    # Captures the selected ports in parallel (one decoding process each) and lists their frames
+    # merged in time order, the newest MULTIPORT_ROWS rows are kept
+
+    def __init__(self, app, ports):
+        super().__init__(app)
+        self.title("Multi-port capture")
+        self.geometry("900x600")
+
+        self.app = app
+        self.manager = None
+        self.after_id = None
+        self.start_time = None
+
+        side = tk.Frame(self)
+        side.pack(side=tk.LEFT, fill=tk.Y, padx=10, pady=10)
+
+        tk.Label(side, text="Ports", font=("Segoe UI", 14)).pack(anchor=tk.W)
+        self.port_list = tk.Listbox(side, selectmode=tk.MULTIPLE, exportselection=False, height=12)
+        for port in ports:
+            self.port_list.insert(tk.END, port)
+        self.port_list.pack(fill=tk.Y, expand=True)
+
+        tk.Button(side, text="Start", bg="lightgrey", font=("Segoe UI", 14), command=self.start).pack(fill=tk.X, pady=(10, 0))
+        tk.Button(side, text="Stop", bg="lightgrey", font=("Segoe UI", 14), command=self.stop).pack(fill=tk.X, pady=(5, 0))
+
+        self.status = tk.Label(side, text="", font=("Segoe UI", 10), justify=tk.LEFT)
+        self.status.pack(anchor=tk.W, pady=(10, 0))
+
+        columns = ("time", "ch", "id", "dlc", "data", "crc")
+        self.table = ttk.Treeview(self, columns=columns, show="headings")
+        for name, width in zip(columns, (100, 40, 90, 40, 200, 50)):
+            self.table.heading(name, text=name)
+            self.table.column(name, width=width, anchor=tk.W)
+        scroll = ttk.Scrollbar(self, orient=tk.VERTICAL, command=self.table.yview)
+        self.table.configure(yscrollcommand=scroll.set)
+        scroll.pack(side=tk.RIGHT, fill=tk.Y)
+        self.table.pack(fill=tk.BOTH, expand=True, padx=(0, 5), pady=10)
+
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def start(self):
+        ports = [self.port_list.get(i) for i in self.port_list.curselection()]
+        if not ports:
+            print("No ports selected.")
+            return
+        self.stop()
+
+        bitrate = self.app.bitrate_combo.get()
+        self.manager = CaptureManager(ports, baudrate=1152000, bitrate=None if bitrate == "Auto" else int(bitrate),
+                                      data_bitrate=int(self.app.data_bitrate_combo.get()))
+        self.manager.start()
+        self.start_time = None
+        self.table.delete(*self.table.get_children())
+        self.after_id = self.after(READ_INTERVAL, self.periodic_update)
+        print(f"Multi-port capture on {', '.join(ports)}")
+
+    def stop(self):
+        if self.after_id:
+            self.after_cancel(self.after_id)
+            self.after_id = None
+        if self.manager:
+            self.add_rows(self.manager.stop())
+            self.update_status()
+            self.manager = None
+
+    def periodic_update(self):
+        self.add_rows(self.manager.poll())
+        self.update_status()
+        self.after_id = self.after(READ_INTERVAL, self.periodic_update)
+
+    def add_rows(self, merged):
+        if not len(merged):
+            return
+        if self.start_time is None:
+            self.start_time = int(merged['time'][0])
+
+        tick_hz = self.manager.tick_hz
+        for row in merged[-MULTIPORT_ROWS:]:
+            frame = CANFrame.from_row(row)
+            self.table.insert("", tk.END, values=(f"{(row['time'] - self.start_time) / tick_hz:.6f}",
+                                                  self.manager.ports[row['channel']], f"0x{frame.can_id:x}",
+                                                  frame.dlc, "RTR" if frame.rtr else frame.data.hex(' '),
+                                                  "ok" if frame.crc_ok else "bad"))
+
+        rows = self.table.get_children()
+        if len(rows) > MULTIPORT_ROWS:
+            self.table.delete(*rows[:len(rows) - MULTIPORT_ROWS])
+        self.table.yview_moveto(1)
+
+    def update_status(self):
+        lines = [f"{port}: {count} frames" for port, count in zip(self.manager.ports, self.manager.frame_counts)]
+        lines += [f"{self.manager.ports[channel]}: {error}" for channel, error in self.manager.errors.items()]
+        if self.manager.late_frames:
+            lines.append(f"{self.manager.late_frames} late frames")
+        self.status.config(text="\n".join(lines))
+
+    def on_close(self):
+        self.stop()
+        self.destroy()
+
+
+class StatsWindow(tk.Toplevel):
+    # Live bus statistics, redrawn from the decoder's BusStats aggregates only, never from the frame history
+
+    def __init__(self, app):
+        super().__init__(app)
+        self.title("Bus statistics")
+        self.geometry("700x700")
+
+        self.app = app
+        self.after_id = None
+
+        self.summary = tk.Label(self, text="", anchor=tk.W, justify=tk.LEFT, font=("Consolas", 11))
+        self.summary.pack(fill=tk.X, padx=10, pady=10)
+
+        tk.Label(self, text="Frames per ID", font=("Segoe UI", 12)).pack(anchor=tk.W, padx=10)
+        columns = ("id", "type", "rate", "total")
+        self.id_table = ttk.Treeview(self, columns=columns, show="headings", height=12)
+        for name, width in zip(columns, (120, 60, 100, 100)):
+            self.id_table.heading(name, text=name)
+            self.id_table.column(name, width=width, anchor=tk.W)
+        self.id_table.pack(fill=tk.BOTH, expand=True, padx=10)
+
+        tk.Label(self, text="Inter-frame gap (idle bits)", font=("Segoe UI", 12)).pack(anchor=tk.W, padx=10, pady=(10, 0))
+        self.gaps = tk.Label(self, text="", anchor=tk.W, justify=tk.LEFT, font=("Consolas", 10))
+        self.gaps.pack(fill=tk.X, padx=10, pady=(0, 10))
+
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
+        self.refresh()
+
+    def refresh(self):
+        stats = self.app.plotter.decoder.stats
+        s = stats.summary(top=STATS_TOP_IDS)
+        win, totals = s['window'], s['totals']
+
+        self.summary.config(text="\n".join([
+            f"Bus load     {s['load_pct']:6.1f} %       over the last {s['window_s']:.1f} s",
+            f"Frames       {s['frames_per_s']:8,.0f} /s     {totals['frames']:,} total",
+            f"Data/Remote  {win['data']:,} / {win['remote']:,}     {totals['data']:,} / {totals['remote']:,} total",
+            f"Extended     {win['extended']:,}     {totals['extended']:,} total",
+            f"CAN FD       {win['fd']:,}     {totals['fd']:,} total",
+            f"CRC errors   {win['crc_errors']:,}     {totals['crc_errors']:,} total",
+            f"Bus errors   {s['errors_per_s']:8,.1f} /s     " +
+            ", ".join(f"{kind} {total:,}" for kind, (n, total) in s['errors'].items() if total)]))
+
+        self.id_table.delete(*self.id_table.get_children())
+        for can_id, ide, rate, total in s['ids']:
+            self.id_table.insert("", tk.END, values=(f"0x{can_id:x}", "ext" if ide else "std", f"{rate:.1f}/s", total))
+
+        # text bars scaled to the fullest bin, in the window and since the start
+        gaps, gap_totals = s['gaps'], s['gap_totals']
+        peak = max(gaps) or 1
+        rows = [f"{label:>10} {'#' * (30 * n // peak):<30} {n:>7,} {total:>10,}"
+                for label, n, total in zip(gap_bin_labels(), gaps, gap_totals) if total]
+        self.gaps.config(text="\n".join(rows))
+
+        self.after_id = self.after(STATUS_INTERVAL, self.refresh)
+
+    def on_close(self):
+        if self.after_id:
+            self.after_cancel(self.after_id)
+            self.after_id = None
+        self.destroy()
+
 
 class LogicAnalyzerApp(tk.Tk):
-    def __init__(self):
+    def __init__(self, metrics_path=None, metrics_interval=10.0):
         super().__init__()
         self.title("Logic Analyzer")
         self.geometry("1600x900")
@@ -29,7 +209,6 @@ class LogicAnalyzerApp(tk.Tk):
         self.configure(bg="white")
 
         self.stop_event   = threading.Event()
-        self.serial_thr   = None
         
         self.after_id = None
 
@@ -41,6 +220,16 @@ class LogicAnalyzerApp(tk.Tk):
 
         self.plotter = Plotter(self)
         self.plotter.ax = self.ax        
+        self.plotter.attach(self.canvas)
+
+        # per-stage rates, queue depths and timings, refreshed every STATUS_INTERVAL
+        self.metrics = PipelineMetrics(self.plotter)
+        self._status_sample = None
+        self.metrics_dump = None
+        if metrics_path:
+            self.metrics_dump = MetricsDump(self.metrics, metrics_path, metrics_interval)
+            self.metrics_dump.start()
+        self.update_status()
 
         self.protocol("WM_DELETE_WINDOW", self.on_close)
 
@@ -61,6 +250,18 @@ class LogicAnalyzerApp(tk.Tk):
         self.port_combo.pack(side=tk.LEFT)
 
         tk.Button(top_frame, image=self.refresh_icon, bg=top_frame['bg'], bd=0, command=self.update_serial_ports).pack(side=tk.LEFT, padx=10)
+
+        # Bitrate
+        tk.Label(top_frame, text="Bitrate", bg=top_frame['bg'], font=("Segoe UI", 20)).pack(side=tk.LEFT, padx=(10, 5))
+        self.bitrate_combo = ttk.Combobox(top_frame, values=BITRATE_CHOICES, width=10)
+        self.bitrate_combo.set("Auto")
+        self.bitrate_combo.pack(side=tk.LEFT)
+
+        tk.Label(top_frame, text="FD", bg=top_frame['bg'], font=("Segoe UI", 20)).pack(side=tk.LEFT, padx=(10, 5))
+        self.data_bitrate_combo = ttk.Combobox(top_frame, values=DATA_BITRATE_CHOICES, width=10)
+        self.data_bitrate_combo.set(DATA_BITRATE_CHOICES[0])
+        self.data_bitrate_combo.pack(side=tk.LEFT)
+
         tk.Button(top_frame, image=self.start_icon, bg=top_frame['bg'], bd=0, command=self.start).pack(side=tk.LEFT, padx=10)
         tk.Button(top_frame, image=self.stop_icon, bg=top_frame['bg'], bd=0, command=self.stop).pack(side=tk.LEFT, padx=10)
 
@@ -89,6 +290,29 @@ class LogicAnalyzerApp(tk.Tk):
 
         self.all_checkbuttons = [cb_bit, cb_hex, cb_hili, cb_stuff, cb_frametype]
 
+        # Record Button, streams everything to rotating capture files while it is on
+        self.record_button = tk.Button(top_frame, image=self.reset_icon, bg=top_frame['bg'], bd=0,
+                                       relief=tk.RAISED, command=self.toggle_recording)
+        self.record_button.pack(side=tk.LEFT, padx=10)
+
+        # Find by ID, jumps to the next frame with any of the (hex, comma separated) IDs
+        self.find_entry = tk.Entry(top_frame, width=10, font=("Segoe UI", 14))
+        self.find_entry.pack(side=tk.LEFT, padx=(10, 0))
+        self.find_entry.bind("<Return>", lambda event: self.find_frame())
+        tk.Button(top_frame, text="Find", bg="lightgrey", font=("Segoe UI", 14), command=self.find_frame).pack(side=tk.LEFT, padx=10)
+
+        # Multi-port Button, opens a window that captures several ports into one merged frame list
+        tk.Button(top_frame, text="Multi-port", bg="lightgrey", font=("Segoe UI", 14), command=self.open_multiport).pack(side=tk.LEFT, padx=10)
+
+        # Stats Button, live bus load and per-ID rates
+        tk.Button(top_frame, text="Stats", bg="lightgrey", font=("Segoe UI", 14), command=self.open_stats).pack(side=tk.LEFT, padx=10)
+
+        # Signals Button, loads YAML signal definitions and shows the decoded values in the frame labels
+        tk.Button(top_frame, text="Signals", bg="lightgrey", font=("Segoe UI", 14), command=self.load_signal_file).pack(side=tk.LEFT, padx=10)
+
+        # Replay Button
+        tk.Button(top_frame, text="Replay", bg="lightgrey", font=("Segoe UI", 14), command=self.replay_capture).pack(side=tk.LEFT, padx=10)
+
         # Save Raw Button
         tk.Button(top_frame, text="Save Raw", bg="lightgrey", font=("Segoe UI", 14), command=self.save_raw_data).pack(side=tk.LEFT, padx=10)
 
@@ -105,6 +329,14 @@ class LogicAnalyzerApp(tk.Tk):
 
         self.canvas = FigureCanvasTkAgg(self.figure, master=self)
         self.canvas.draw()
+
+        # pan/zoom, the plotter re-renders the visible range whenever the x limits change
+        self.toolbar = NavigationToolbar2Tk(self.canvas, self, pack_toolbar=False)
+        self.toolbar.update()
+        self.status_bar = tk.Label(self, text="", anchor=tk.W, bg="white", font=("Consolas", 10))
+        self.status_bar.pack(side=tk.BOTTOM, fill=tk.X)
+        self.toolbar.pack(side=tk.BOTTOM, fill=tk.X)
+
         self.canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
 
     def get_serial_ports(self):
@@ -113,7 +345,7 @@ class LogicAnalyzerApp(tk.Tk):
 
     def update_serial_ports(self):
         available_ports = self.get_serial_ports()
-        self.port_combo['values'] = available_ports
+        self.port_combo['values'] = available_ports + [SYNTHETIC_PORT]
         if available_ports:
             self.port_combo.set(available_ports[0])
         else:
@@ -136,14 +368,14 @@ class LogicAnalyzerApp(tk.Tk):
                     print(f"Already connected to {selected_port}")
                     return
 
-            self.serial_thr = threading.Thread(
-                target=self.plotter.start,
-                args=(selected_port,),
-                kwargs={'baudrate': 1152000},
-                daemon=True
-            )
-
-            self.serial_thr.start()
+            self.plotter.set_bitrate(self.bitrate_combo.get())
+            self.plotter.set_data_bitrate(self.data_bitrate_combo.get())
+            if selected_port == SYNTHETIC_PORT:
+                bitrate = self.bitrate_combo.get()
+                bus = SyntheticBus(bitrate=500_000 if bitrate == "Auto" else int(bitrate))
+                self.plotter.start_reader(ReplayReader.from_synthetic(bus))
+            else:
+                self.plotter.start(selected_port, baudrate=1152000)
 
             # self.anim = FuncAnimation(self.figure, self.plotter.update, interval=100, blit=False)
 
@@ -157,11 +389,11 @@ class LogicAnalyzerApp(tk.Tk):
     def periodic_update(self):
         try:
             self.plotter.update(None)
-            self.canvas.draw()
+            self.plotter.render()
         except Exception as e:
 
             print(f"\nException caught: {e}\n")
-            self.plotter.decoder.reset_data()
+            self.plotter.reset()
             return         
 
         if not self.stop_event.is_set():
@@ -169,7 +401,7 @@ class LogicAnalyzerApp(tk.Tk):
 
     def stop(self):
         self.stop_event.set()
-        self.plotter.reader.disconnect()
+        self.plotter.stop()
         
         # Cancel the after loop
         if self.after_id:
@@ -180,7 +412,93 @@ class LogicAnalyzerApp(tk.Tk):
     def reset(self):
         print("Reset clicked")
 
+    def replay_capture(self):
+        file_path = filedialog.askopenfilename(filetypes=[("CAN capture", "*.cancap")],
+                                               title="Replay Capture")
+        if not file_path:
+            return
+
+        try:
+            reader = ReplayReader.from_capture(file_path)
+        except (OSError, ValueError) as e:
+            print(f"Error opening capture: {e}")
+            return
+
+        self.stop_event.clear()
+        self.plotter.set_bitrate(str(reader.bitrate) if reader.bitrate else "Auto")
+        self.plotter.set_data_bitrate(self.data_bitrate_combo.get())
+        self.plotter.start_reader(reader)
+        if self.after_id is None:
+            self.after_id = self.after(READ_INTERVAL, self.periodic_update)
+        print(f"Replaying {file_path}")
+
+    def find_frame(self):
+        try:
+            ids = [int(text, 16) for text in self.find_entry.get().replace(',', ' ').split()]
+        except ValueError:
+            print(f"Not a hex CAN ID: {self.find_entry.get()}")
+            return
+        if not ids:
+            return
+
+        row, older = self.plotter.find_next(ids)
+        names = ', '.join(f'0x{i:x}' for i in ids)
+        if row is None and older:
+            print(f"{older:,} frames with ID {names}, all older than the trace the decoder keeps")
+        elif row is None:
+            print(f"No frame with ID {names}")
+
+    def load_signal_file(self):
+        file_path = filedialog.askopenfilename(filetypes=[("Signal definitions", "*.yaml *.yml")],
+                                               title="Load Signal Definitions")
+        if not file_path:
+            return
+
+        try:
+            self.plotter.signals = load_signals(file_path)
+        except (OSError, ValueError) as e:
+            print(f"Error loading signals: {e}")
+            return
+        print(f"Loaded {len(self.plotter.signals)} message definitions from {file_path}")
+        self.refresh_plot()
+
+    def open_stats(self):
+        StatsWindow(self)
+
+    def open_multiport(self):
+        MultiPortWindow(self, self.get_serial_ports() + [SYNTHETIC_PORT])
+
+    def toggle_recording(self):
+        if self.plotter.recorder:
+            recorder = self.plotter.stop_recording()
+            self.record_button.config(relief=tk.RAISED, bg=self.record_button.master['bg'])
+            print(f"Recording stopped, {recorder.bytes_written} bytes in {len(recorder.files)} file(s)")
+            return
+
+        directory = filedialog.askdirectory(title="Record Captures To")
+        if directory:
+            self.plotter.start_recording(directory)
+            self.record_button.config(relief=tk.SUNKEN, bg="red")
+            print(f"Recording to {directory}")
+
+    def update_status(self):
+        recorder = self.plotter.recorder
+        if recorder is not None and recorder.error is not None:
+            self.toggle_recording()
+            print(f"Recording stopped by a write error: {recorder.error}")
+
+        try:
+            sample = self.metrics.sample()
+            self.status_bar.config(text=self.metrics.status_text(sample, self._status_sample))
+            self._status_sample = sample
+        except Exception as e:
+            print(f"Error updating status: {e}")
+        self.after(STATUS_INTERVAL, self.update_status)
+
     def on_close(self):
+        if self.metrics_dump:
+            self.metrics_dump.stop()
+        self.plotter.stop_recording()
         self.quit()
         self.destroy()
 
@@ -190,14 +508,13 @@ class LogicAnalyzerApp(tk.Tk):
             print("No raw data to save.")
             return
 
-        file_path = filedialog.asksaveasfilename(defaultextension=".txt",
-                                                filetypes=[("Text files", "*.txt")],
+        file_path = filedialog.asksaveasfilename(defaultextension=".cancap",
+                                                filetypes=[("CAN capture", "*.cancap")],
                                                 title="Save Raw Data")
         if file_path:
-            with open(file_path, "w") as file:
-                for raw in raw_data_list:
-                    file.write(repr(raw) + '\n')  # เขียนเป็น b'...' format
-            print(f"Raw data saved to {file_path}")
+            snap = self.plotter.snap
+            count = save_capture(file_path, raw_data_list.chunks(), snap.timing.tick_hz, snap.bitrate)
+            print(f"Raw data saved to {file_path} ({count} records)")
 
     def save_graph_image(self):
         file_path = filedialog.asksaveasfilename(defaultextension=".png",
@@ -229,15 +546,17 @@ class LogicAnalyzerApp(tk.Tk):
     
     def refresh_plot(self):
         try:
-            self.plotter.setup_graph(self.plotter.decoder.bit_data)
-            bits, stuff_pos = self.plotter.decoder.remove_stuff_bits(self.plotter.decoder.bit_data)
-            frames = self.plotter.decoder.decode_frame_type(bits)
-            self.plotter.draw_frame(self.plotter.decoder.bit_data, frames, stuff_pos)
-            self.canvas.draw()
+            self.plotter.redraw()
+            self.plotter.render()
         except Exception as e:
             print(f"Error refreshing plot: {e}")
 
 if __name__ == "__main__":
-    app = LogicAnalyzerApp()
+    parser = argparse.ArgumentParser(description="CAN logic analyzer")
+    parser.add_argument('--metrics', metavar='PATH', help="append a JSON line of pipeline metrics to PATH periodically")
+    parser.add_argument('--metrics-interval', type=float, default=10.0, help="seconds between metrics lines")
+    args = parser.parse_args()
+
+    app = LogicAnalyzerApp(args.metrics, args.metrics_interval)
     app.mainloop()
 
@@ -0,0 +1,149 @@
+import json
+import threading
+import time
+
+import numpy as np
+
+
+class StageTimer:
+    # Durations of the last `size` calls of one stage in a ring, cheap enough to leave on all the time
+
+    def __init__(self, size=1024):
+        self._ring = np.zeros(size)
+        self.calls = 0
+        self.total = 0.0
+
+    def add(self, seconds):
+        self._ring[self.calls % len(self._ring)] = seconds
+        self.calls += 1
+        self.total += seconds
+
+    def percentiles(self, q=(50, 99)):
+        # milliseconds over the calls still in the ring, None before the first call
+        n = min(self.calls, len(self._ring))
+        if not n:
+            return None
+        return [float(ms) for ms in np.percentile(self._ring[:n], q) * 1000]
+
+    def clear(self):
+        self.calls = 0
+        self.total = 0.0
+
+
+def stage_timers(*names):
+    return {name: StageTimer() for name in names}
+
+
+class PipelineMetrics:
+    # Collects the counters, queue depths and stage timers of the plotter's reader -> decoder ->
+    # pipeline -> plotter chain into one JSON-friendly sample. Only reads attributes the stages keep
+    # anyway, so sampling from another thread costs the stages nothing
+
+    COUNTERS = ('bytes', 'records', 'frames')
+
+    def __init__(self, plotter):
+        self.plotter = plotter
+
+    def sample(self):
+        plotter = self.plotter
+        reader, pipeline, decoder = plotter.reader, plotter.pipeline, plotter.decoder
+
+        totals = {'bytes': reader.bytes_read if reader else 0,
+                  'records': decoder.records_decoded,
+                  'frames': decoder.frames_decoded}
+
+        queues = {'ring_bytes': reader.pending_bytes if reader else 0,
+                  'overrun_bytes': reader.overrun_bytes if reader else 0,
+                  'resync_bytes': decoder.skipped_bytes,
+                  'snapshot_queue': pipeline.snapshots.qsize() if pipeline else 0,
+                  'snapshots_dropped': pipeline.dropped if pipeline else 0,
+                  'history_dropped_bytes': plotter.raw_data_log.dropped_bytes,
+                  'recorder_queued_bytes': plotter.recorder.queued_bytes if plotter.recorder else 0,
+                  'recorder_dropped_bytes': plotter.recorder.dropped_bytes if plotter.recorder else 0}
+
+        stages = {}
+        timers = dict(decoder.timers)
+        if pipeline:
+            timers.update(pipeline.timers)
+        timers.update(plotter.timers)
+        for name, timer in timers.items():
+            ms = timer.percentiles()
+            stages[name] = {'calls': timer.calls,
+                            'p50_ms': ms[0] if ms else None,
+                            'p99_ms': ms[1] if ms else None}
+
+        return {'time': time.time(), 'monotonic': time.monotonic(),
+                'totals': totals, 'queues': queues, 'stages': stages}
+
+    @classmethod
+    def rates(cls, sample, prev):
+        # per-second rates between two samples, a counter that went backwards was reset
+        if prev is None:
+            return {f"{name}_per_s": None for name in cls.COUNTERS}
+        dt = sample['monotonic'] - prev['monotonic']
+        rates = {}
+        for name in cls.COUNTERS:
+            delta = sample['totals'][name] - prev['totals'][name]
+            if delta < 0:
+                delta = sample['totals'][name]
+            rates[f"{name}_per_s"] = delta / dt if dt > 0 else None
+        return rates
+
+    def status_text(self, sample, prev):
+        # one line for the status bar
+        rates = self.rates(sample, prev)
+
+        def rate(name, unit):
+            value = rates[f"{name}_per_s"]
+            return f"{value:,.0f} {unit}/s" if value is not None else f"- {unit}/s"
+
+        cells = [rate('bytes', 'B'), rate('records', 'rec'), rate('frames', 'frm'),
+                 f"ring {sample['queues']['ring_bytes']:,} B",
+                 f"resync {sample['queues']['resync_bytes']:,} B",
+                 f"dropped snaps {sample['queues']['snapshots_dropped']}"]
+        if sample['queues']['recorder_dropped_bytes']:
+            cells.append(f"rec dropped {sample['queues']['recorder_dropped_bytes']:,} B")
+        for name, stage in sample['stages'].items():
+            if stage['p50_ms'] is not None:
+                cells.append(f"{name} {stage['p50_ms']:.2f}/{stage['p99_ms']:.2f} ms")
+        return "   ".join(cells)
+
+
+class MetricsDump:
+    # Appends one JSON line with a PipelineMetrics sample (plus rates) every interval seconds, for soak runs
+
+    def __init__(self, metrics, path, interval=10.0):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.lines = 0
+
+        self._stop = threading.Event()
+        self._thr = None
+
+    def start(self):
+        self._stop.clear()
+        self._thr = threading.Thread(target=self._loop, daemon=True)
+        self._thr.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thr and self._thr.is_alive():
+            self._thr.join(timeout=1)
+        self._thr = None
+
+    def _loop(self):
+        prev = None
+        with open(self.path, 'a') as f:
+            while not self._stop.wait(self.interval):
+                try:
+                    sample = self.metrics.sample()
+                except Exception as e:
+                    # the UI thread may be swapping the reader or pipeline right now
+                    print(f"[MetricsDump] sample error: {e}")
+                    continue
+                sample['rates'] = self.metrics.rates(sample, prev)
+                prev = sample
+                f.write(json.dumps(sample) + '\n')
+                f.flush()
+                self.lines += 1
@@ -0,0 +1,210 @@
+import heapq
+import itertools
+import multiprocessing
+import queue
+import time
+
+import numpy as np
+
+from decoder import BitTiming, CANDecoder
+from frames import FRAME_DTYPE, FrameStore
+from replay import ReplayReader
+from serial_reader import SerialReader
+from synth import SyntheticBus
+
+SYNTHETIC_PORT = "Synthetic bus"
+
+# merged frames: host time in ticks and the channel they came from, then the FrameStore columns with
+# the whole payload of CAN FD frames in data
+MERGED_DTYPE = np.dtype([('time', '<i8'), ('channel', 'u1')] +
+                        [('data', 'u1', (64,)) if field[0] == 'data' else field for field in FRAME_DTYPE.descr])
+
+
+def open_reader(port, baudrate=1152000, bitrate=None):
+    # SYNTHETIC_PORT plays random traffic instead of opening a port
+    if port == SYNTHETIC_PORT:
+        return ReplayReader.from_synthetic(SyntheticBus(bitrate=bitrate or 500_000))
+    return SerialReader(port, baudrate)
+
+
+def channel_worker(channel, port, baudrate, bitrate, out, stop, tick_hz=10_000_000, hold=0.25, poll=0.05,
+                   data_bitrate=2_000_000):
+    # Runs in its own process: reads and decodes one port, and sends its closed frames back in batches.
+    # Frame times are host time.monotonic() in ticks, so channels with separate session clocks line up;
+    # every batch also carries a watermark, no later frame of this channel will be timed before it
+    try:
+        reader = open_reader(port, baudrate, bitrate)
+    except Exception as e:
+        out.put(('error', channel, f"{port}: {e}"))
+        return
+
+    decoder = CANDecoder(BitTiming(bitrate or 500_000, tick_hz, data_bitrate=data_bitrate), window_bits=1 << 12,
+                         auto_bitrate=not bitrate)
+    decoder.clock.uart_baud = baudrate if reader.ser is not None else None
+    hold_ticks = int(hold * tick_hz)
+    last_time = watermark = -1
+
+    try:
+        while not stop.is_set():
+            data = reader.read_view(timeout=poll)
+            if data:
+                # a replay has no arrival time, the moment it is read stands in for one
+                arrival = reader.arrival if reader.arrival is not None else time.monotonic()
+                decoder.decode_8byte_data(data, arrival)
+
+            # nothing needs the frames here once they are sent, start a fresh store every batch
+            store = decoder.frame_decoder.frames
+            rows = np.zeros(len(store), dtype=MERGED_DTYPE)
+            for name in FRAME_DTYPE.names:
+                rows[name] = store.data() if name == 'data' else store.column(name)
+            rows['channel'] = channel
+            decoder.frame_decoder.frames = FrameStore()
+            decoder.frame_decoder.index = None
+
+            offset = decoder.clock.host_offset
+            if offset is None:
+                continue
+
+            # the host offset only ever shrinks, a channel's times must not go backwards because of it,
+            # nor fall behind a watermark already sent: the merge may have handed out frames up to it
+            times = np.maximum.accumulate(np.maximum(rows['start_tick'] + offset, max(last_time, watermark)))
+            rows['time'] = times
+            if len(times):
+                last_time = int(times[-1])
+
+            if not decoder.holding:
+                bound = int(time.monotonic() * tick_hz) - hold_ticks
+                if decoder.last_time is not None:
+                    bound = max(bound, decoder.last_time + offset)
+                open_tick = decoder.open_frame_tick()
+                if open_tick is not None:
+                    bound = min(bound, open_tick + offset)
+                watermark = max(watermark, bound, last_time)
+
+            out.put(('frames', channel, rows, watermark))
+    except Exception as e:
+        out.put(('error', channel, f"{port}: {e}"))
+    finally:
+        reader.disconnect()
+        out.put(('closed', channel))
+
+
+class CaptureManager:
+    # Opens several ports at once, each decoded by its own process so decoding scales with cores,
+    # and heap-merges their frame streams into one time-ordered stream. A frame is only handed out
+    # once every open channel's watermark has passed it, which holds the merge back by about hold seconds.
+
+    def __init__(self, ports, baudrate=1152000, bitrate=None, hold=0.25, tick_hz=10_000_000, data_bitrate=2_000_000):
+        self.ports = list(ports)
+        self.baudrate = baudrate
+        self.bitrate = bitrate
+        self.data_bitrate = data_bitrate
+        self.hold = hold
+        self.tick_hz = tick_hz
+
+        self.errors = {}
+        self.frame_counts = [0] * len(self.ports)
+        self.late_frames = 0            # frames that came in behind an already merged one
+
+        self._ctx = multiprocessing.get_context('spawn')
+        self._out = None
+        self._stop = None
+        self._procs = []
+        self._open = set()
+        self._pending = [[] for _ in self.ports]
+        self._watermarks = [None] * len(self.ports)
+        self._merged_to = None
+
+    @property
+    def running(self):
+        return any(proc.is_alive() for proc in self._procs)
+
+    def start(self):
+        self._out = self._ctx.Queue()
+        self._stop = self._ctx.Event()
+        for channel, port in enumerate(self.ports):
+            proc = self._ctx.Process(target=channel_worker, daemon=True,
+                                     args=(channel, port, self.baudrate, self.bitrate, self._out, self._stop,
+                                           self.tick_hz, self.hold),
+                                     kwargs={'data_bitrate': self.data_bitrate})
+            proc.start()
+            self._procs.append(proc)
+        self._open = set(range(len(self.ports)))
+
+    def stop(self):
+        # whatever is still pending comes back merged
+        if self._stop is None:
+            return np.empty(0, dtype=MERGED_DTYPE)
+        self._stop.set()
+
+        # a worker only exits once its queued batches have been taken off the pipe
+        deadline = time.monotonic() + 2
+        while self._open and time.monotonic() < deadline:
+            self._receive(timeout=0.1)
+        for proc in self._procs:
+            proc.join(timeout=0.5)
+            if proc.is_alive():
+                proc.terminate()
+
+        self._procs = []
+        self._open = set()
+        self._stop = None
+        return self._merge(None)
+
+    def poll(self):
+        # frames every open channel has moved past, as a MERGED_DTYPE array in time order
+        self._receive()
+        marks = [self._watermarks[channel] for channel in self._open]
+        if any(mark is None for mark in marks):
+            return np.empty(0, dtype=MERGED_DTYPE)
+        return self._merge(min(marks) if marks else None)
+
+    def _receive(self, timeout=None):
+        while True:
+            try:
+                msg = self._out.get(timeout=timeout) if timeout else self._out.get_nowait()
+            except queue.Empty:
+                return
+            timeout = None
+
+            kind, channel = msg[0], msg[1]
+            if kind == 'frames':
+                _, _, rows, watermark = msg
+                if len(rows):
+                    self._pending[channel].append(rows)
+                    self.frame_counts[channel] += len(rows)
+                self._watermarks[channel] = watermark
+            elif kind == 'error':
+                self.errors[channel] = msg[2]
+                print(f"[CaptureManager] {msg[2]}")
+                self._open.discard(channel)
+            else:
+                self._open.discard(channel)
+
+    def _merge(self, limit):
+        # limit None takes everything that is pending
+        runs = []
+        for channel, batches in enumerate(self._pending):
+            if not batches:
+                continue
+            rows = np.concatenate(batches)
+
+            cut = len(rows) if limit is None else int(np.searchsorted(rows['time'], limit, side='right'))
+            self._pending[channel] = [rows[cut:]] if cut < len(rows) else []
+            if cut:
+                runs.append(rows[:cut])
+
+        if not runs:
+            return np.empty(0, dtype=MERGED_DTYPE)
+
+        # every run is already in time order, a k-way heap merge puts them together
+        starts = np.cumsum([0] + [len(rows) for rows in runs])
+        merged = heapq.merge(*(zip(rows['time'].tolist(), itertools.repeat(k), range(len(rows)))
+                               for k, rows in enumerate(runs)))
+        order = np.fromiter((starts[k] + i for _, k, i in merged), dtype=np.intp, count=starts[-1])
+        out = np.concatenate(runs)[order]
+
+        if self._merged_to is not None:
+            self.late_frames += int(np.count_nonzero(out['time'] < self._merged_to))
+        self._merged_to = max(int(out['time'][-1]), self._merged_to or 0)
+        return out
@@ -0,0 +1,180 @@
+import queue
+import threading
+import time
+
+from decoder import window_frames
+from metrics import stage_timers
+from recorder import RawHistory
+
+
+class Snapshot:
+    # Render-ready copy of the decoder's window, never touched again once published. bit_data[0] is
+    # session bit bit_base and timestamp_data[0] entry ts_base, frame bit numbers are session wide.
+    # edge_bit[k] is the first bit after edge k of the window and edge_start[k] the tick it starts at,
+    # switches and rewind see CANDecoder._switch_rate
+
+    __slots__ = ('seq', 'generation', 'timing', 'bitrate', 'bit_data', 'state_data', 'timestamp_data', 'bit_base',
+                 'ts_base', 'edge_bit', 'edge_start', 'switches', 'rewind', 'pending', 'stuff_pos', 'closed_frames',
+                 'skipped_bytes', 'frame_store', 'index', 'error_log', 'closed_errors', '_frames')
+
+    def __init__(self, decoder, seq=0):
+        self.seq = seq
+        self.generation = decoder.generation
+        self.timing = decoder.timing
+        # for capture headers, 0 (unknown) until auto bitrate has confirmed one
+        self.bitrate = decoder.timing.bitrate if decoder.bitrate_known else 0
+        self.bit_data = tuple(decoder.bit_data)
+        self.state_data = tuple(decoder.state_data)
+        self.timestamp_data = tuple(decoder.timestamp_data)
+        self.bit_base = decoder.bit_base
+        self.ts_base = decoder.ts_base
+        self.edge_bit = tuple(decoder.edge_bit)
+        self.edge_start = tuple(decoder.edge_start)
+        self.switches = decoder.switches
+        self.rewind = decoder.rewind
+        self.pending = decoder.frame_decoder.pending_frame()
+        self.stuff_pos = tuple(decoder.frame_decoder.stuff_pos)
+        self.closed_frames = len(decoder.frame_decoder.frames)
+        self._frames = None
+
+        # append-only, so the first closed_frames rows stay valid while the decoder carries on
+        self.frame_store = decoder.frame_decoder.frames
+        self.index = decoder.frame_decoder.index
+        self.error_log = decoder.frame_decoder.errors
+        self.closed_errors = len(self.error_log)
+        self.skipped_bytes = decoder.skipped_bytes
+
+    @property
+    def bit_duration(self):
+        return self.timing.bit_ticks
+
+    def get_plot_data(self):
+        return self.state_data, self.timestamp_data
+
+    def get_frames(self):
+        # built on first use, only the snapshots the UI actually draws pay for it
+        if self._frames is None:
+            frames = window_frames(self.frame_store, self.closed_frames, self.bit_base)
+            if self.pending:
+                frames.append(self.pending)
+            self._frames = tuple(frames)
+        return list(self._frames), self.stuff_pos
+
+    def find_frames(self, ids=None, t0=None, t1=None):
+        return self.index.query(ids, t0, t1, limit=self.closed_frames)
+
+    def window_errors(self):
+        # ErrorLog rows from bit_base on
+        rows = self.error_log.rows(self.closed_errors)
+        return rows[rows['bit'] >= self.bit_base]
+
+    def frame(self, row):
+        if not 0 <= row < self.closed_frames:
+            raise IndexError(row)
+        return self.frame_store[row]
+
+
+class DecodePipeline:
+    # Decode worker between the serial reader and the UI, the UI only ever sees snapshots
+
+    def __init__(self, reader, decoder, depth=2, poll=0.05, raw_log=None, recorder=None):
+        self.reader = reader
+        self.decoder = decoder
+        self.poll = poll
+        self.raw_data_log = raw_log if raw_log is not None else RawHistory()
+        self.recorder = recorder
+        self.snapshots = queue.Queue(maxsize=depth)
+        self.dropped = 0
+        self.timers = stage_timers('store', 'snapshot')
+
+        self._seq = 0
+        self._calls = queue.Queue()
+        self._stop = threading.Event()
+        self._thr = None
+
+    @property
+    def running(self):
+        return self._thr is not None and self._thr.is_alive()
+
+    def start(self):
+        self._stop.clear()
+        self._thr = threading.Thread(target=self._loop, daemon=True)
+        self._thr.start()
+
+    def stop(self):
+        self._stop.set()
+        if self.running:
+            self._thr.join(timeout=1)
+        self._thr = None
+
+    def call(self, fn, *args):
+        # decoder changes from other threads run on the worker between two chunks
+        if self.running:
+            self._calls.put((fn, args))
+        else:
+            fn(*args)
+            self._publish()
+
+    def latest(self):
+        snap = None
+        while True:
+            try:
+                snap = self.snapshots.get_nowait()
+            except queue.Empty:
+                return snap
+
+    def _run_calls(self):
+        ran = False
+        while True:
+            try:
+                fn, args = self._calls.get_nowait()
+            except queue.Empty:
+                return ran
+            fn(*args)
+            ran = True
+
+    def _loop(self):
+        while not self._stop.is_set():
+            changed = self._run_calls()
+
+            # a view into the reader's ring, only valid until the next read
+            data = self.reader.read_view(timeout=self.poll)
+            if data:
+                start = time.perf_counter()
+                chunk = bytes(data)
+                self.raw_data_log.append(chunk)
+                recorder = self.recorder
+                if recorder and recorder.error is None:
+                    recorder.append(chunk)
+                self.timers['store'].add(time.perf_counter() - start)
+                try:
+                    self.decoder.decode_8byte_data(data, self.reader.arrival)
+                except Exception as e:
+                    print(f"[DecodePipeline] decode error: {e}")
+                    self.decoder.reset_data()
+                changed = True
+
+                # files the recorder opens from now on get the bitrate once it is known
+                if recorder and not recorder.bitrate and self.decoder.bitrate_known:
+                    recorder.bitrate = self.decoder.timing.bitrate
+
+            if changed:
+                self._publish()
+
+    def _publish(self):
+        start = time.perf_counter()
+        self._seq += 1
+        snap = Snapshot(self.decoder, self._seq)
+        self.timers['snapshot'].add(time.perf_counter() - start)
+
+        # a slow UI only ever misses intermediate snapshots, never the newest one
+        while True:
+            try:
+                self.snapshots.put_nowait(snap)
+                return
+            except queue.Full:
+                try:
+                    self.snapshots.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
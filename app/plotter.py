@@ -1,8 +1,12 @@
-from decoder import CANDecoder
+from decoder import CANDecoder, BitTiming, bit_starts
 from serial_reader import SerialReader
+from pipeline import DecodePipeline, Snapshot
+from recorder import RawHistory, RotatingRecorder
+from metrics import stage_timers
 import numpy as np
 import time
-from matplotlib import patches
+from matplotlib.collections import LineCollection, PolyCollection
+from frames import ERROR_KINDS
 
 class Plotter:
 
@@ -10,6 +14,8 @@ class Plotter:
 
         self.decoder = CANDecoder()
         self.reader = None
+        self.pipeline = None
+        self.snap = Snapshot(self.decoder)
         self.ax = None
         self.app = app
 
@@ -19,9 +25,38 @@ class Plotter:
 
         self.font_size = 9
         self.font_color = 'black'
-        self.raw_data_log = []
-
-        self.plot_timestamp = []
+        self.raw_data_log = RawHistory()
+        self.recorder = None
+        self.timers = stage_timers('update', 'draw')
+        self.signals = None             # SignalDatabase, decoded values go into the frame labels
+
+        self.plot_timestamp = []        # (start, end) tick of every bit in the snapshot's window
+        self._ts_done = 0               # session index of the next timestamp_data entry to expand
+        self._ts_bit_base = 0
+        self._ts_generation = -1
+        self._ts_rewind = 0
+
+        self.canvas = None
+        self._trace = None
+        self._trace_end_bit = 0
+        self._trace_span = (0, 0)
+        self._background = None         # the figure without its animated artists, see _on_draw
+        self._annotated = None          # the background with the annotations, the waveform goes on top
+        self._layers_dirty = False
+        self._trace_dirty = False
+        self._layer_key = None
+        self._layers = None             # the annotation artists, made once and then only updated
+        self._texts = {}                # a pool of Text artists per kind of label, see _place_texts
+        self._drawn = None              # what the annotation artists show, see draw_frame
+
+        self._view = None               # None follows the capture, (x0, x1) after a pan/zoom
+        self._follow_ticks = None       # width shown while following, follow_bits until zoomed
+        self.follow_bits = 1024
+        self._setting_view = False
+        self._rerender_timer = None
+        self.bit_label_px = 8           # pixels per bit needed before bit values are drawn
+        self.field_label_px = 4
+        self.boundary_px = 3
 
         self.frame_color = {"IDLE":"#45c0de", 
                             "IDLE ":"#45c0de",
@@ -32,10 +67,16 @@ class Plotter:
                             "r1":"#49b45d",
                             "SRR":"#49b45d",
                             "IDE":"#49b45d",
+                            "RRS":"#49b45d",
+                            "FDF":"#49b45d",
+                            "res":"#49b45d",
+                            "BRS":"#49b45d",
+                            "ESI":"#49b45d",
                             "BASE ID":"#92c255",
                             "EXT ID":"#92c255",
                             "DLC":"#00a765",
                             "Data":"#028fc3",
+                            "SC":"#b70032",
                             "CRC":"#b70032",
                             "CD":"#b70032",
                             "ACK":"#fbb900",
@@ -44,233 +85,616 @@ class Plotter:
                             "IFS":"#757575"}
 
     def start(self, port, baudrate):
-        self.reader = SerialReader(port, baudrate)
-
-    def bits_to_hex(self, bits):
-        if bits:
-            return f"0x{int(bits, 2):02x}"
+        self.start_reader(SerialReader(port, baudrate), uart_baud=baudrate)
+
+    def start_reader(self, reader, uart_baud=None):
+        # anything with read_view/disconnect will do, a SerialReader or a ReplayReader;
+        # uart_baud lets the session clock account for the time a burst spends on the UART
+        self.stop()
+        self.decoder.clock.uart_baud = uart_baud
+        self._decoder_call(self.decoder.reset_session)
+        self.reader = reader
+        self.pipeline = DecodePipeline(self.reader, self.decoder, raw_log=self.raw_data_log,
+                                       recorder=self.recorder)
+        self.pipeline.start()
+
+    def stop(self):
+        if self.pipeline:
+            self.pipeline.stop()
+        if self.reader:
+            self.reader.disconnect()
+
+    def start_recording(self, directory, **kwargs):
+        self.stop_recording()
+        self.recorder = RotatingRecorder(directory, tick_hz=self.snap.timing.tick_hz, bitrate=self.snap.bitrate,
+                                         **kwargs)
+        self.recorder.start()
+        if self.pipeline:
+            self.pipeline.recorder = self.recorder
+        return self.recorder
+
+    def stop_recording(self):
+        recorder, self.recorder = self.recorder, None
+        if self.pipeline:
+            self.pipeline.recorder = None
+        if recorder:
+            recorder.stop()
+        return recorder
+
+    def _decoder_call(self, fn, *args):
+        if self.pipeline and self.pipeline.running:
+            self.pipeline.call(fn, *args)
         else:
-            return "0x00"
-    
-    def retrive_bit_timestamp(self, timestamp_data):
-        actual_bit_timestamp = []
-        for time_index in range(0, len(timestamp_data)-1,2):
-            t1 = timestamp_data[time_index]
-            t2 = timestamp_data[time_index + 1] 
-            time_diff = t2 - t1
-            bit_count = 0
+            fn(*args)
+            self.snap = Snapshot(self.decoder)
 
-            while time_diff > 20:
-                bit_count += 1
-                time_diff -= 20
-            if time_diff > 8:
-                bit_count += 1
-
-            for i in np.arange(t1, t2, (t2 - t1) / bit_count):
-                actual_bit_timestamp.append(i)
-                actual_bit_timestamp.append(i + (t2 - t1) / bit_count)
+    def set_bitrate(self, choice):
+        if choice == "Auto":
+            self._decoder_call(self.decoder.enable_auto_bitrate)
+        else:
+            timing = BitTiming(int(choice), self.decoder.timing.tick_hz,
+                               data_bitrate=self.decoder.timing.data_bitrate)
+            self._decoder_call(self._set_fixed_bitrate, timing)
+
+    def set_data_bitrate(self, choice):
+        # CAN FD data phase, the nominal bitrate (or its estimate) stays as it is
+        timing = self.decoder.timing
+        self._decoder_call(self.decoder.set_timing,
+                           BitTiming(timing.bitrate, timing.tick_hz, timing.sample_point, data_bitrate=int(choice)))
+
+    def _set_fixed_bitrate(self, timing):
+        self.decoder.disable_auto_bitrate()
+        self.decoder.set_timing(timing)
+
+    def reset(self):
+        self._decoder_call(self.decoder.reset_data)
+
+    def find_frames(self, ids=None, t0=None, t1=None):
+        # FrameStore rows of the closed frames in the current snapshot, see FrameIndex.query
+        return self.snap.find_frames(ids, t0, t1)
+
+    def find_next(self, ids):
+        # (row, older) of the first matching frame after the one in the middle of the view, wrapping around
+        # to the start of the trace. The decoder only keeps the trace of its last window_bits, row is None
+        # when no match is in there and older counts the matches before it
+        lead = 4 * self.snap.bit_duration
+        first = self._trace_span[0] - lead
+        x0, x1 = self._view or self.follow_view()
+        t0 = max(int((x0 + x1) / 2 - lead) + 1, first)
+        rows = self.find_frames(ids, t0=t0)
+        if not len(rows):
+            rows = self.find_frames(ids, t0=first)
+        older = len(self.find_frames(ids, t1=first - 1))
+        if not len(rows):
+            return None, older
+
+        row = int(rows[0])
+        self.jump_to_frame(row)
+        return row, older
+
+    def jump_to_frame(self, row, pad_bits=20):
+        # False when the frame is older than the trace, the view stays where it is then
+        frame = self.snap.frame(row)
+        bt = self.snap.bit_duration
+        # the plot runs offset_bits ahead of the decoder's ticks, see trace_data
+        lead, pad = 4 * bt, pad_bits * bt
+        if frame.start_tick + lead < self._trace_span[0]:
+            return False
+        self._view = (frame.start_tick + lead - pad, frame.end_tick + lead + pad)
+        self._set_xlim(*self._view)
+        self._rerender()
+        return True
 
-        actual_bit_timestamp[0] = 0
+    def retrive_bit_timestamp(self, timestamp_data):
+        # only the edge intervals that arrived since the last call are expanded, and whatever the
+        # decoder has trimmed off the front of its window is dropped here as well
+        snap = self.snap
+        if self._ts_generation != snap.generation or snap.ts_base > self._ts_done:
+            self._ts_generation = snap.generation
+            self._ts_done = snap.ts_base
+            self._ts_bit_base = snap.bit_base
+            self.plot_timestamp = []
+        elif snap.bit_base > self._ts_bit_base:
+            del self.plot_timestamp[:2 * (snap.bit_base - self._ts_bit_base)]
+            self._ts_bit_base = snap.bit_base
+        count, ts, bit = snap.rewind
+        if count != self._ts_rewind:
+            # a dropped snapshot may have carried an earlier rewind, the whole window is expanded again then
+            if count - self._ts_rewind > 1:
+                ts, bit = snap.ts_base, snap.bit_base
+            self._ts_rewind = count
+            if ts < self._ts_done:
+                del self.plot_timestamp[max(2 * (bit - self._ts_bit_base), 0):]
+                self._ts_done = max(ts, snap.ts_base)
+
+        actual_bit_timestamp = self.plot_timestamp
+
+        done = self._ts_done - snap.ts_base
+        stop = len(timestamp_data) - 1
+        if stop > done:
+            # edge intervals done // 2 on, each pair of entries is one, up to the last edge
+            first, n = done // 2, (stop - done + 1) // 2
+            self._ts_done += 2 * n
+
+            # the decoder's own bit clock, see BitSampler, FD data phases run at another bit rate
+            edges = slice(first, first + n + 1)
+            if snap.edge_bit[edges.stop - 1] > snap.edge_bit[first]:
+                bit_start, length = bit_starts(snap.edge_bit[edges], snap.edge_start[edges], snap.switches,
+                                               snap.bit_duration)
+                # a bit ends where the next one starts, a resync lengthens or shortens it by the phase
+                # error; only the end of a long idle stretch, cut at MAX_INTERVAL_BITS, keeps its length
+                bit_end = bit_start + length
+                bit_end[:-1] = np.where(np.diff(bit_start) < 2 * length[:-1], bit_start[1:], bit_end[:-1])
+                # the same goes for the last bit of the previous call, nothing came after it then
+                if len(actual_bit_timestamp) == 2 * (snap.edge_bit[first] - self._ts_bit_base) > 0:
+                    last_start, last_end = actual_bit_timestamp[-2:]
+                    if bit_start[0] - last_start < 2 * (last_end - last_start):
+                        actual_bit_timestamp[-1] = float(bit_start[0])
+                actual_bit_timestamp.extend(np.column_stack([bit_start, bit_end]).ravel().tolist())
 
         return actual_bit_timestamp
 
     def setup_graph(self, data):
 
-        self.ax.clear()
-        self.ax.set_ylim(-0.5, 1.5)
-        self.ax.set_xlabel('Time (ticks)\n 0.1 us/tick')
-        self.ax.set_ylabel('Logic Level')
-        self.ax.grid(True, axis='y')
-
-        
-        self.plot_timestamp = self.retrive_bit_timestamp(self.decoder.timestamp_data)
+        if self._layers is None:
+            self.ax.clear()
+            self.ax.set_ylim(-0.5, 1.5)
+            self.ax.set_xlabel('Time (ticks)\n 0.1 us/tick')
+            self.ax.set_ylabel('Logic Level')
+            self.ax.grid(True, axis='y')
+            # below the annotations in the cached background as well as in a full draw
+            self.ax.set_axisbelow(True)
+            self._trace = None
+            self._background = None
+            self._make_layers()
+            # the limits only ever come from the view, empty artists must not rescale them
+            self.ax.set_autoscale_on(False)
+
+            # clear() drops the axes callbacks, so pan/zoom has to be hooked up again
+            self.ax.callbacks.connect('xlim_changed', self._on_xlim)
+        if self._view:
+            self._set_xlim(*self._view)
+
+        self.plot_timestamp = self.retrive_bit_timestamp(self.snap.timestamp_data)
 
     def get_pos(self, bit_cnt, offset_bits=4):
+        # bit_cnt counts from offset_bits before the first bit of the window
         pos = 0
+        bt = self.snap.bit_duration
         act_bit_mins_4 = bit_cnt - offset_bits
         if bit_cnt > 3 and (bit_cnt - offset_bits) * 2 < len(self.plot_timestamp):
             time_diff = self.plot_timestamp[act_bit_mins_4 * 2 + 1] - self.plot_timestamp[act_bit_mins_4 * 2]
-            pos = self.plot_timestamp[act_bit_mins_4 * 2] + time_diff / 2 + 80
+            pos = self.plot_timestamp[act_bit_mins_4 * 2] + time_diff / 2 + offset_bits * bt
         elif (bit_cnt - offset_bits) * 2 >= len(self.plot_timestamp):
             cnt_from_last = bit_cnt - len(self.plot_timestamp) // 2
-            pos = self.plot_timestamp[-1] + cnt_from_last * 20 + 10
+            pos = self.plot_timestamp[-1] + cnt_from_last * bt + bt / 2
         else:
-            pos = bit_cnt * 20 + 10 
+            pos = self.plot_timestamp[0] + bit_cnt * bt + bt / 2
         
         return pos
 
-    def draw_frame(self, bit_data, frames, stuff_bit_pos):
-
+    def layout_frames(self, bit_data, frames, stuff_bit_pos, x_min=None, x_max=None):
+        # works out where every highlight, boundary and label goes without creating any artists,
+        # frames entirely outside x_min .. x_max are skipped
         actual_bit_cnt = 0
         offset_bits = 4
+        bt = self.snap.bit_duration
+        lead = offset_bits * bt
+        bit_base = self.snap.bit_base
+        stuff_bit_pos = {pos - bit_base for pos in stuff_bit_pos}
+        n_stamps = len(self.plot_timestamp)
+
+        layout = {'spans': [], 'span_colors': [], 'bounds': [],
+                  'bits': ([], []), 'stuff': [], 'names': [], 'hex': [],
+                  'frame_labels': [], 'end_bit': 0}
 
         lst_1bit_prt_cnt = 0
 
-        for frame_info in frames:
-            
-            x_pos = self.get_pos(actual_bit_cnt, offset_bits) 
-
-            if self.app.frametype_chkbox.get():
-                frame_type_label = f"Frame type: {frame_info['FrameType']} {frame_info['FrameSubtype']} Frame"
-                self.ax.text(x_pos, 1.05, frame_type_label,
-                            fontsize=12, fontweight='bold', verticalalignment='bottom',
-                            horizontalalignment='left', color='black',
-                            bbox=dict(facecolor='yellow', edgecolor='black', boxstyle='round,pad=0.13'))
-            
-            # add IDLE to frame info
-            if actual_bit_cnt == 0:
-                frame_info = {'IDLE': [1] * offset_bits, **frame_info}
+        for frame in frames:
 
-            for part, bits in frame_info.items():
-        
-                if part in ('FrameType', 'FrameSubtype'):
+            actual_bit_cnt = frame.start_bit - bit_base - frame.idle_bits + offset_bits
+            if actual_bit_cnt == offset_bits:
+                actual_bit_cnt = 0
+            layout['end_bit'] = frame.end_bit - bit_base + 1 + offset_bits
+
+            if x_min is not None:
+                if self.get_pos(layout['end_bit'], offset_bits) < x_min:
                     continue
+                if self.get_pos(actual_bit_cnt, offset_bits) - bt > x_max:
+                    break
+
+            crc_status = 'OK' if frame.crc_ok else 'Error'
+            label = f"Frame type: {frame.frame_type} {frame.subtype} Frame (CRC {crc_status})"
+            decoded = self.signals.decode(frame) if self.signals else None
+            if decoded:
+                name, values = decoded
+                label += f"\n{name}: " + ", ".join(f"{signal}={value:g}{' ' + unit if unit else ''}"
+                                                    for signal, value, unit in values)
+            layout['frame_labels'].append((self.get_pos(actual_bit_cnt, offset_bits), label))
 
-                if type(bits) == int:
-                    bits = [bits]
+            fields = frame.fields()
 
-                x_pos = self.get_pos(actual_bit_cnt, offset_bits) 
-                bit_text = ''.join(str(b) for b in bits)
-                bit_decoded = self.bits_to_hex(bit_text)
+            # add IDLE to frame info
+            if actual_bit_cnt == 0:
+                fields.insert(0, ('IDLE', offset_bits, (1 << offset_bits) - 1))
+
+            for part, width, value in fields:
 
+                x_pos = self.get_pos(actual_bit_cnt, offset_bits)
                 if actual_bit_cnt - offset_bits in stuff_bit_pos:
-                    x_pos += 20
-
-                if self.app.bit_chkbox.get():
-                    # draw part name
-                    self.ax.text(
-                        x_pos, -0.45 + lst_1bit_prt_cnt * 0.1, part,
-                        fontsize=self.font_size,
-                        ha='left', va='baseline',
-                        color='black',
-                        bbox=dict(facecolor='yellow', edgecolor='black', boxstyle='round,pad=0.13')
-                    )
-
-                if self.app.hex_chkbox.get():
-                    # draw hex data of each part
-                    self.ax.text(
-                        x_pos, -0.5 + lst_1bit_prt_cnt * 0.1, bit_decoded,
-                        fontsize=self.font_size,
-                        ha='left', va='baseline',
-                        color='black',
-                        bbox=dict(facecolor='yellow', edgecolor='black', boxstyle='round,pad=0.13')
-                    )
-                
-                if len(bits) == 1:
+                    x_pos += bt
+
+                layout['names'].append((x_pos, -0.45 + lst_1bit_prt_cnt * 0.1, part))
+                layout['hex'].append((x_pos, -0.5 + lst_1bit_prt_cnt * 0.1, f"0x{value:02x}"))
+
+                if width == 1:
                     lst_1bit_prt_cnt += 1
-                else :
+                else:
                     lst_1bit_prt_cnt = 0
-                
-                for bit in bits:
+
+                color = self.frame_color['Data'] if part.startswith("Data") else self.frame_color[part]
+
+                for i in range(width):
+                    bit = (value >> (width - 1 - i)) & 1
 
                     if actual_bit_cnt - offset_bits in stuff_bit_pos:
-                        x_pos = self.get_pos(actual_bit_cnt, offset_bits) 
-                        
-                        if self.app.text_chkbox.get():
-
-                            # draw stuff text
-                            self.ax.text(
-                                x_pos, 0.5, 'stuff',
-                                fontsize=self.font_size,
-                                fontweight='bold',
-                                ha='center',
-                                va='center',
-                                color='white',
-                                rotation=90,
-                                bbox=dict(facecolor='red', edgecolor='black', boxstyle='round,pad=0.2')
-                            )
-                        
-                        if self.app.bit_chkbox.get():
-
-                            # draw stuff bit 
-                            self.ax.text(x_pos,  -0.05, bit_data[actual_bit_cnt - offset_bits], fontsize=self.font_size, ha='center', va='center', color=self.font_color)
-                        
+                        x_pos = self.get_pos(actual_bit_cnt, offset_bits)
                         act_bit_mins_4 = actual_bit_cnt - offset_bits
-                        t1 = self.plot_timestamp[act_bit_mins_4 * 2] + 80
-                        t2 = self.plot_timestamp[act_bit_mins_4 * 2 + 1] + 80
 
-                        if self.app.hili_chkbox.get():
-                            self.ax.axvspan(t1, t2, facecolor='#ff6961', alpha=0.5)
-                            
-                        self.ax.axvline(t2, color='grey', linestyle='-', linewidth=0.5)
+                        layout['stuff'].append(x_pos)
+                        layout['bits'][bit_data[act_bit_mins_4]].append(x_pos)
+
+                        t1 = self.plot_timestamp[act_bit_mins_4 * 2] + lead
+                        t2 = self.plot_timestamp[act_bit_mins_4 * 2 + 1] + lead
+                        layout['spans'].append((t1, t2))
+                        layout['span_colors'].append('#ff6961')
+                        layout['bounds'].append(t2)
 
                         actual_bit_cnt += 1
-                    
+
                     x_pos = self.get_pos(actual_bit_cnt, offset_bits)
+                    layout['bits'][bit].append(x_pos)
 
-                    if self.app.bit_chkbox.get():
-                        # draw bit 
-                        self.ax.text(x_pos,  -0.05, str(bit), fontsize=self.font_size, ha='center', va='center', color=self.font_color)
-                    
                     act_bit_mins_4 = actual_bit_cnt - offset_bits
-                    t1 = self.plot_timestamp[act_bit_mins_4 * 2] + 80 if actual_bit_cnt > 3 and act_bit_mins_4 * 2 < len(self.plot_timestamp) else 0
-                    t2 = self.plot_timestamp[act_bit_mins_4 * 2 + 1] + 80 if actual_bit_cnt > 3 and act_bit_mins_4 * 2 < len(self.plot_timestamp) else 0
-                    
-                    color = self.frame_color['Data'] if part.startswith("Data") else self.frame_color[part]
-
-                    if self.app.hili_chkbox.get():
-                        # draw colored plane
-                        if actual_bit_cnt > 3 and act_bit_mins_4 * 2 < len(self.plot_timestamp):
-                            self.ax.axvspan(t1, t2, facecolor=color, alpha=0.5)
-                        else:
-                            self.ax.axvspan(x_pos - 10, x_pos + 10, facecolor=color, alpha=0.5)
-                            
-                    if actual_bit_cnt > 3 and act_bit_mins_4 * 2 < len(self.plot_timestamp):
-                        self.ax.axvline(t2, color='grey', linestyle='-', linewidth=0.5)
+                    if actual_bit_cnt > 3 and act_bit_mins_4 * 2 < n_stamps:
+                        t1 = self.plot_timestamp[act_bit_mins_4 * 2] + lead
+                        t2 = self.plot_timestamp[act_bit_mins_4 * 2 + 1] + lead
                     else:
-                        self.ax.axvline(x_pos + 10, color='grey', linestyle='-', linewidth=0.5)
+                        t1, t2 = x_pos - bt / 2, x_pos + bt / 2
+
+                    layout['spans'].append((t1, t2))
+                    layout['span_colors'].append(color)
+                    layout['bounds'].append(t2)
 
                     actual_bit_cnt += 1
 
-        x, y = self.decoder.get_plot_data()
+        if frames:
+            layout['end_bit'] = frames[-1].end_bit - bit_base + 1 + offset_bits
+        return layout
+
+    def _make_layers(self):
+        # one artist per kind of annotation, draw_frame only swaps their data. The axes are never
+        # cleared again, so the tick and label artists matplotlib keeps for them are reused as well.
+        # All of them, the x axis and the frame move with the view and are animated, a full draw
+        # only caches what stays put and _draw_layers puts them on top
+        ax = self.ax
+        vband = ax.get_xaxis_transform()
+        self._layers = {
+            'spans': ax.add_collection(PolyCollection([], edgecolors='none', alpha=0.5, transform=vband,
+                                                      animated=True), autolim=False),
+            'bounds': ax.add_collection(LineCollection([], colors='grey', linewidths=0.5, transform=vband,
+                                                       animated=True), autolim=False),
+            'bits': [ax.scatter([], [], marker=f'${value}$', s=(self.font_size * 0.8) ** 2, c=self.font_color,
+                                linewidths=0, animated=True) for value in (0, 1)],
+            'boxes': ax.add_collection(PolyCollection([], facecolors='yellow', edgecolors='black', linewidths=0.5,
+                                                      animated=True), autolim=False),
+            'errors': ax.add_collection(LineCollection([], colors='red', linewidths=1.5, transform=vband,
+                                                       animated=True), autolim=False),
+        }
+        ax.xaxis.set_animated(True)
+        for spine in ax.spines.values():
+            spine.set_animated(True)
+        self._texts = {'stuff': [], 'labels': [], 'errors': [], 'frames': []}
+        self._drawn = None
+
+    def _place_texts(self, kind, items, **style):
+        # (x, y, text) items on the pooled Text artists of that kind, the ones left over are hidden
+        pool = self._texts[kind]
+        while len(pool) < len(items):
+            pool.append(self.ax.text(0, 0, '', visible=False, animated=True, **style))
+        for text, (x, y, label) in zip(pool, items):
+            text.set_position((x, y))
+            text.set_text(label)
+            text.set_visible(True)
+        for text in pool[len(items):]:
+            text.set_visible(False)
+
+    def draw_frame(self, bit_data, frames, stuff_bit_pos):
+        # True when the annotations changed and are drawn again, otherwise only the waveform is blitted
+        ax = self.ax
+
+        # waveform first so the visible range is known before laying anything out
+        end_bit = frames[-1].end_bit - self.snap.bit_base + 5 if frames else len(bit_data) + 4
+        self.update_trace(end_bit)
+        x0, x1 = ax.get_xlim()
+
+        layout = self.layout_frames(bit_data, frames, stuff_bit_pos, x0, x1)
+        self._trace_end_bit = layout.pop('end_bit')
+
+        # level of detail, labels only once there is room to read them
+        px_per_bit = self.snap.bit_duration * ax.bbox.width / max(x1 - x0, 1e-9)
+        show_bits = px_per_bit >= self.bit_label_px
+        show_labels = px_per_bit >= self.field_label_px
+        show_bounds = px_per_bit >= self.boundary_px
+
+        def visible(x):
+            return x0 <= x <= x1
+
+        kept = [i for i, (t1, t2) in enumerate(layout['spans']) if t2 >= x0 and t1 <= x1]
+        layout['spans'] = [layout['spans'][i] for i in kept]
+        layout['span_colors'] = [layout['span_colors'][i] for i in kept]
+        layout['bounds'] = [x for x in layout['bounds'] if visible(x)] if show_bounds else []
+        layout['bits'] = tuple([x for x in xs if visible(x)] for xs in layout['bits']) if show_bits else ([], [])
+        layout['stuff'] = [x for x in layout['stuff'] if visible(x)] if show_bits else []
+        layout['names'] = [lbl for lbl in layout['names'] if visible(lbl[0])] if show_labels else []
+        layout['hex'] = [lbl for lbl in layout['hex'] if visible(lbl[0])] if show_labels else []
+        layout['frame_labels'] = [(max(x, x0), label) for x, label in layout['frame_labels']
+                                  if x <= x1] if show_labels else []
+        # protocol errors, one red line each with the kind written along it
+        layout['errors'] = [(x, kind) for x, kind in
+                            ((self.get_pos(int(row['bit']) - self.snap.bit_base + 4), ERROR_KINDS[row['kind']])
+                             for row in self.snap.window_errors()) if visible(x)]
+
+        options = tuple(box.get() for box in (self.app.hili_chkbox, self.app.bit_chkbox, self.app.hex_chkbox,
+                                              self.app.text_chkbox, self.app.frametype_chkbox))
+        drawn = ((x0, x1, ax.bbox.width, ax.bbox.height), options, layout)
+        if drawn == self._drawn:
+            # new frames outside the view change nothing that is on screen
+            self._trace_dirty = True
+            return False
+        self._drawn = drawn
+        hili, bits, hex_labels, text, frametype = options
+        layers = self._layers
+
+        verts, colors = np.zeros((0, 4, 2)), []
+        if hili and layout['spans']:
+            # neighbouring bits of the same colour become one polygon
+            spans = np.clip(np.asarray(layout['spans'], dtype=np.float64), x0, x1)
+            span_colors = layout['span_colors']
+            first = np.flatnonzero([True] + [a != b for a, b in zip(span_colors[1:], span_colors[:-1])])
+            last = np.r_[first[1:], len(span_colors)] - 1
+            left, right = spans[first, 0], spans[last, 1]
+
+            verts = np.zeros((len(first), 4, 2))
+            verts[:, :2, 0] = left[:, None]
+            verts[:, 2:, 0] = right[:, None]
+            verts[:, 1:3, 1] = 1
+            colors = [span_colors[i] for i in first]
+        layers['spans'].set_verts(verts)
+        layers['spans'].set_facecolor(colors)
+
+        layers['bounds'].set_segments([[(x, 0), (x, 1)] for x in layout['bounds']])
+
+        for scatter, xs in zip(layers['bits'], layout['bits'] if bits else ([], [])):
+            scatter.set_offsets(np.column_stack([xs, np.full(len(xs), -0.05)]) if xs else np.zeros((0, 2)))
+
+        self._place_texts('stuff', [(x, 0.5, 'stuff') for x in layout['stuff']] if text else [],
+                          fontsize=self.font_size, fontweight='bold', ha='center', va='center', color='white',
+                          rotation=90, bbox=dict(facecolor='red', edgecolor='black', boxstyle='round,pad=0.2'))
+
+        labels = (layout['names'] if bits else []) + (layout['hex'] if hex_labels else [])
+        # one patch collection for every label background instead of a bbox per text
+        ticks_per_char = (x1 - x0) / max(ax.bbox.width, 1) * self.font_size * 0.7 * ax.figure.dpi / 72
+        layers['boxes'].set_verts([[(x, y - 0.01), (x, y + 0.045), (x + len(label) * ticks_per_char, y + 0.045),
+                                    (x + len(label) * ticks_per_char, y - 0.01)] for x, y, label in labels])
+        self._place_texts('labels', labels, fontsize=self.font_size, ha='left', va='baseline', color='black')
+
+        errors = layout['errors'] if text else []
+        layers['errors'].set_segments([[(x, 0), (x, 1)] for x, _ in errors])
+        self._place_texts('errors', [(x, 1.0, kind) for x, kind in errors],
+                          fontsize=self.font_size, color='red', rotation=90, ha='right', va='top')
+
+        self._place_texts('frames', [(x, 1.05, label) for x, label in layout['frame_labels']] if frametype else [],
+                          fontsize=12, fontweight='bold', verticalalignment='bottom', horizontalalignment='left',
+                          color='black', bbox=dict(facecolor='yellow', edgecolor='black', boxstyle='round,pad=0.13'))
+
+        self._layers_dirty = True
+        return True
+
+    def trace_data(self, end_bit):
+        offset_bits = 4
+        idle_duration = self.snap.bit_duration
+
+        # copies, the padding below must not leak back into the snapshot
+        x, y = map(list, self.snap.get_plot_data())
 
-        idle_duration = 20                           
-        total_bits      = actual_bit_cnt + 1            
-        last_needed_ts  = (total_bits - offset_bits) * idle_duration 
+        origin = y[0] if y else 0
+        total_bits      = end_bit + 1
+        if self.plot_timestamp:
+            last_needed_ts = self.get_pos(total_bits, offset_bits) - (offset_bits + 0.5) * idle_duration
+        else:
+            last_needed_ts = origin + (total_bits - offset_bits) * idle_duration
 
         # add line at the end
         if y and last_needed_ts > y[-1]:
-            y.append(last_needed_ts) 
-            x.append(1)              
+            y.append(last_needed_ts)
+            x.append(1)
 
         # add line at the start
         start_offset = offset_bits * idle_duration
         x = [1, 1] + x
-        y = [0, start_offset] + [yi + start_offset for yi in y]
-
-        plotting_lim = max(y)
-        self.ax.set_xlim(0, plotting_lim)
-        
-        self.ax.step(y, x, where='post', color='blue', linewidth=2)
+        y = [origin, origin + start_offset] + [yi + start_offset for yi in y]
+        return y, x
+
+    def update_trace(self, end_bit):
+        times, levels = self.trace_data(end_bit)
+        times = np.asarray(times, dtype=np.float64)
+        levels = np.asarray(levels, dtype=np.int8)
+        self._trace_end_bit = end_bit
+
+        self._trace_span = (times[0], times[-1])
+        x0, x1 = self._view if self._view else self.follow_view()
+        rescaled = self._view is None and tuple(self.ax.get_xlim()) != (x0, x1)
+        if rescaled or self._trace is None:
+            self._set_xlim(x0, x1)
+
+        xs, ys = self.decimate(times, levels, x0, x1, int(self.ax.bbox.width))
+
+        if self._trace is None:
+            # animated, so it is left out of the cached background and blitted on top
+            self._trace, = self.ax.plot(xs, ys, drawstyle='steps-post', color='blue',
+                                        linewidth=2, animated=True)
+            return True
+
+        self._trace.set_data(xs, ys)
+        return rescaled
+
+    def decimate(self, times, levels, x0, x1, columns):
+        # clip the step trace to the view and, when zoomed out, keep only first/min/max/last per pixel column
+        lo = max(np.searchsorted(times, x0, side='right') - 1, 0)
+        hi = np.searchsorted(times, x1, side='right') + 1
+        times, levels = times[lo:hi], levels[lo:hi]
+
+        if columns <= 0 or len(times) <= 4 * columns:
+            return times, levels
+
+        col = ((times - x0) * (columns / (x1 - x0))).astype(np.int64)
+        starts = np.flatnonzero(np.r_[True, col[1:] != col[:-1]])
+        ends = np.r_[starts[1:], len(col)]
+
+        x = np.repeat(np.maximum(times[starts], x0), 4)
+        y = np.column_stack([levels[starts],
+                             np.minimum.reduceat(levels, starts),
+                             np.maximum.reduceat(levels, starts),
+                             levels[ends - 1]]).ravel()
+        return x, y
+
+    def follow_view(self):
+        # the newest follow_ticks of the window, the decoder keeps more history to pan back into
+        first, last = self._trace_span
+        width = self._follow_ticks or self.follow_bits * self.snap.bit_duration
+        return max(first, last - width), last
+
+    def _set_xlim(self, x0, x1):
+        self._setting_view = True
+        try:
+            self.ax.set_xlim(x0, x1)
+        finally:
+            self._setting_view = False
+
+    def _on_xlim(self, ax):
+        if self._setting_view:
+            return
+
+        x0, x1 = ax.get_xlim()
+        # panning or zooming out to the newest edge goes back to following the capture at that width
+        if x1 >= self._trace_span[1]:
+            self._view = None
+            self._follow_ticks = x1 - x0
+        else:
+            self._view = (x0, x1)
+
+        if self._rerender_timer is not None:
+            self._rerender_timer.stop()
+            self._rerender_timer.start()
+
+    def _rerender(self):
+        self.redraw()
+        self.render()
+
+    def attach(self, canvas):
+        self.canvas = canvas
+        canvas.mpl_connect('draw_event', self._on_draw)
+
+        self._rerender_timer = canvas.new_timer(interval=50)
+        self._rerender_timer.single_shot = True
+        self._rerender_timer.add_callback(self._rerender)
+
+    def _on_draw(self, event):
+        # a full draw leaves the animated artists out, it becomes the background they are drawn on.
+        # Saving draws all of them
+        if self.canvas.is_saving():
+            return
+        self._background = self.canvas.copy_from_bbox(self.ax.figure.bbox)
+        self._draw_layers()
+        self._draw_trace()
+
+    def _draw_layers(self):
+        # in the order Axes.draw would have drawn them, the waveform stays out of the cached copy
+        self.canvas.restore_region(self._background)
+        animated = [artist for artist in self.ax.get_children()
+                    if artist.get_animated() and artist.get_visible() and artist is not self._trace]
+        for artist in sorted(animated, key=lambda artist: artist.get_zorder()):
+            self.ax.draw_artist(artist)
+        self._annotated = self.canvas.copy_from_bbox(self.ax.figure.bbox)
+
+    def _draw_trace(self):
+        if self._trace is not None:
+            self.ax.draw_artist(self._trace)
+
+    def render(self):
+        start = time.perf_counter()
+        try:
+            self._render()
+        finally:
+            self.timers['draw'].add(time.perf_counter() - start)
+
+    def _render(self):
+        layers, trace = self._layers_dirty, self._trace_dirty
+        self._layers_dirty = self._trace_dirty = False
+        if self._background is None:
+            if layers or trace:
+                self.canvas.draw()
+        elif layers:
+            # the x tick labels are outside the axes
+            self._draw_layers()
+            self._draw_trace()
+            self.canvas.blit(self.ax.figure.bbox)
+        elif trace:
+            self.canvas.restore_region(self._annotated)
+            self._draw_trace()
+            self.canvas.blit(self.ax.bbox)
+
+    def redraw(self):
+        self.setup_graph(self.snap.bit_data)
+        frames, stuff_pos = self.snap.get_frames()
+        self.draw_frame(self.snap.bit_data, frames, stuff_pos)
+        return frames
 
     def update(self, frame):
-        data = self.reader.read_data()
+        start = time.perf_counter()
+        try:
+            self._update()
+        finally:
+            self.timers['update'].add(time.perf_counter() - start)
+
+    def _update(self):
+        # decoding happens on the pipeline worker, only its newest snapshot is drawn here
+        snap = self.pipeline.latest() if self.pipeline else None
 
-        if data:
-            self.raw_data_log.append(data)
+        if snap:
+            self.snap = snap
 
-            self.decoder.decode_8byte_data(data)
+            if not snap.bit_data:
+                return
+
+            frames, stuff_pos = snap.get_frames()
+            layer_key = (snap.generation, snap.bit_base, snap.closed_frames, snap.closed_errors,
+                         repr(frames[-1]) if frames else None, len(stuff_pos))
 
-            if not self.decoder.bit_data:
+            if layer_key == self._layer_key:
+                # annotations are unchanged, only the waveform needs to be blitted
+                self._trace_dirty = True
+                if self.update_trace(self._trace_end_bit):
+                    # the view moved, lay out what scrolled into it
+                    self.redraw()
                 return
-            
-            self.setup_graph(self.decoder.bit_data)
-            bits, stuff_pos = self.decoder.remove_stuff_bits(self.decoder.bit_data)
-            frames = self.decoder.decode_frame_type(bits)
+
+            self._layer_key = layer_key
             frame = frames[0] if frames else None
             if frame:
-                if 'ID' in frame:
-                    can_id_bin = ''.join(str(b) for b in frame['ID'])
-                elif 'BASE ID' in frame:
-                    can_id_bin = ''.join(str(b) for b in frame['BASE ID'])
+                if frame.base_id == 0x650:
+                    self.app.disable_all_checkboxes()
                 else:
-                    can_id_bin = None
-
-                if can_id_bin:
-                    can_id = int(can_id_bin, 2)
-                    if can_id == 0x650:
-                        self.app.disable_all_checkboxes()
-                    else:
-                        self.app.enable_all_checkboxes()
-            self.draw_frame(self.decoder.bit_data, frames, stuff_pos)
-                    
\ No newline at end of file
+                    self.app.enable_all_checkboxes()
+            self.redraw()
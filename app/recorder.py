@@ -0,0 +1,175 @@
+import collections
+import os
+import queue
+import threading
+import time
+
+from capture import CaptureWriter
+from decoder import RecordStream
+
+
+class RawHistory:
+    # Most recent raw chunks for the UI, bounded by total size and/or age
+
+    def __init__(self, max_bytes=64 << 20, max_seconds=None):
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.total_bytes = 0
+        self.dropped_bytes = 0
+        self._chunks = collections.deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._chunks)
+
+    def append(self, data, now=None):
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            self._chunks.append((now, data))
+            self.total_bytes += len(data)
+            self._trim(now)
+
+    def _trim(self, now):
+        chunks = self._chunks
+        while len(chunks) > 1 and (
+                (self.max_bytes is not None and self.total_bytes > self.max_bytes) or
+                (self.max_seconds is not None and now - chunks[0][0] > self.max_seconds)):
+            _, data = chunks.popleft()
+            self.total_bytes -= len(data)
+            self.dropped_bytes += len(data)
+
+    def chunks(self):
+        with self._lock:
+            return [data for _, data in self._chunks]
+
+    def clear(self):
+        with self._lock:
+            self._chunks.clear()
+            self.total_bytes = 0
+
+
+class RotatingRecorder:
+    # Streams every raw chunk to capture files on its own thread, starting a new file once the
+    # current one reaches max_bytes or max_seconds. Chunks are only dropped when max_queued bytes are
+    # still waiting to be written, or after a write error (error), which ends the recording.
+    # bitrate goes into the header of every file opened from then on, 0 when unknown
+
+    def __init__(self, directory, prefix='capture', max_bytes=256 << 20, max_seconds=3600,
+                 tick_hz=10_000_000, bitrate=0, max_queued=64 << 20):
+        self.directory = directory
+        self.prefix = prefix
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.tick_hz = tick_hz
+        self.bitrate = bitrate
+        self.max_queued = max_queued
+
+        self.files = []
+        self.bytes_written = 0
+        self.records_written = 0
+        self.dropped_bytes = 0
+        self.error = None
+
+        self._stream = RecordStream()
+        self._writer = None
+        self._opened = 0
+        self._file_bytes = 0
+        self._queue = queue.Queue()
+        self._queued_bytes = 0
+        self._lock = threading.Lock()
+        self._thr = None
+
+    @property
+    def queued(self):
+        return self._queue.qsize()
+
+    @property
+    def queued_bytes(self):
+        return self._queued_bytes
+
+    @property
+    def running(self):
+        return self._thr is not None and self._thr.is_alive()
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._thr = threading.Thread(target=self._loop, daemon=True)
+        self._thr.start()
+
+    def append(self, data):
+        # False when the chunk was dropped
+        with self._lock:
+            if self.error is not None or self._queued_bytes + len(data) > self.max_queued:
+                self.dropped_bytes += len(data)
+                return False
+            self._queued_bytes += len(data)
+            self._queue.put(data)
+        return True
+
+    def stop(self):
+        # everything queued so far is still written before the last file is closed
+        if self.running:
+            self._queue.put(None)
+            self._thr.join()
+        self._thr = None
+
+    def _loop(self):
+        try:
+            while True:
+                data = self._queue.get()
+                if data is None:
+                    break
+                with self._lock:
+                    self._queued_bytes -= len(data)
+                self._write(data)
+        except OSError as e:
+            with self._lock:
+                self.error = e
+                self.dropped_bytes += len(data)
+            print(f"[RotatingRecorder] write error: {e}")
+            self._discard()
+        finally:
+            self._close()
+
+    def _discard(self):
+        # what is still queued after an error is never written
+        while True:
+            try:
+                data = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if data is not None:
+                with self._lock:
+                    self._queued_bytes -= len(data)
+                    self.dropped_bytes += len(data)
+
+    def _write(self, data):
+        records = self._stream.feed(data)
+        if not len(records):
+            return
+
+        if self._writer is None or self._due():
+            self._close()
+            self._open()
+
+        self._writer.write_records(records)
+        self._file_bytes += records.nbytes
+        self.bytes_written += records.nbytes
+        self.records_written += len(records)
+
+    def _due(self):
+        return (self.max_bytes is not None and self._file_bytes >= self.max_bytes) or \
+               (self.max_seconds is not None and time.monotonic() - self._opened >= self.max_seconds)
+
+    def _open(self):
+        stamp = time.strftime('%Y%m%d_%H%M%S')
+        path = os.path.join(self.directory, f"{self.prefix}_{stamp}_{len(self.files):03d}.cancap")
+        self._writer = CaptureWriter(path, self.tick_hz, self.bitrate)
+        self._opened = time.monotonic()
+        self._file_bytes = 0
+        self.files.append(path)
+
+    def _close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
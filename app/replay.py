@@ -0,0 +1,101 @@
+import queue
+import threading
+import time
+
+from capture import CaptureReader
+from decoder import RECORD_SIZE
+from timeline import SessionClock
+
+
+class ReplayReader:
+    # Drop-in for SerialReader that plays back EdgeRecord blocks, either at the
+    # recorded pace or as fast as the consumer takes them
+
+    def __init__(self, blocks, tick_hz=10_000_000, bitrate=0, realtime=True, speed=1.0, chunk_records=512,
+                 depth=64, on_close=None):
+        self.ser = None
+        self.tick_hz = tick_hz
+        self.bitrate = bitrate
+        self.realtime = realtime
+        self.speed = speed
+        self.chunk_records = chunk_records
+        self.on_close = on_close
+
+        self.bytes_read = 0
+        self.overruns = 0
+        self.overrun_bytes = 0
+        self.arrival = None     # replayed data has no host arrival time worth using
+        self.finished = False
+
+        self._buf = queue.Queue(maxsize=depth)
+        self._stop = threading.Event()
+        self._thr = threading.Thread(target=self._loop, args=(blocks,), daemon=True)
+        self._thr.start()
+
+    @property
+    def pending_bytes(self):
+        # blocks waiting in the queue, the last one may be short
+        return self._buf.qsize() * self.chunk_records * RECORD_SIZE
+
+    @classmethod
+    def from_capture(cls, path, **kwargs):
+        capture = CaptureReader(path)
+        return cls(capture.records(), capture.tick_hz, capture.bitrate, on_close=capture.close, **kwargs)
+
+    @classmethod
+    def from_synthetic(cls, bus, frames_per_block=64, **kwargs):
+        return cls(bus.blocks(frames_per_block), bus.tick_hz, bus.bitrate, **kwargs)
+
+    def _loop(self, blocks):
+        clock = SessionClock(self.tick_hz)
+        first = start = None
+
+        for records in blocks:
+            for i in range(0, len(records), self.chunk_records):
+                chunk = records[i:i + self.chunk_records]
+
+                if self.realtime:
+                    ticks = clock.unwrap(chunk['timestamp'], chunk['burst'])
+                    if first is None:
+                        first, start = int(ticks[0]), time.perf_counter()
+                    due = start + (int(ticks[-1]) - first) / self.tick_hz / self.speed
+                    if self._stop.wait(max(due - time.perf_counter(), 0)):
+                        return
+
+                # a full queue holds the replay back instead of dropping records
+                data = chunk.tobytes()
+                while True:
+                    try:
+                        self._buf.put(data, timeout=0.1)
+                        break
+                    except queue.Full:
+                        if self._stop.is_set():
+                            return
+                if self._stop.is_set():
+                    return
+
+        self.finished = True
+
+    def read_view(self, timeout=None):
+        try:
+            data = self._buf.get(timeout=timeout) if timeout else self._buf.get_nowait()
+        except queue.Empty:
+            return memoryview(b'')
+        self.bytes_read += len(data)
+        return memoryview(data)
+
+    def read_data(self, timeout=None):
+        parts = []
+        view = self.read_view(timeout)
+        while view:
+            parts.append(view.tobytes())
+            view = self.read_view()
+        return b''.join(parts)
+
+    def disconnect(self):
+        self._stop.set()
+        if self._thr.is_alive():
+            self._thr.join(timeout=1)
+        if self.on_close:
+            self.on_close()
+            self.on_close = None
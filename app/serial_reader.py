@@ -1,40 +1,96 @@
 import serial
 import threading
-import queue
 import time
 
 
 class SerialReader:
-    def __init__(self, port, baudrate=1152000, chunk_size=1024):
-        self.ser = serial.Serial(port, baudrate, timeout=1)
+    # Blocking reads straight into a preallocated ring, the consumer gets memoryviews of it
+
+    def __init__(self, port, baudrate=1152000, chunk_size=4096, capacity=1 << 20):
+        self.ser = serial.Serial(port, baudrate, timeout=0.1)
         self.chunk_size = chunk_size
-        self._buf = queue.Queue()
+
+        self._ring = bytearray(capacity)
+        self._view = memoryview(self._ring)
+        self._scratch = memoryview(bytearray(chunk_size))
+        self._head = 0          # total bytes written
+        self._tail = 0          # total bytes released by the consumer
+        self._served = 0        # total bytes handed out, released on the next read
+        self._cond = threading.Condition()
         self._stop = threading.Event()
 
+        self.bytes_read = 0
+        self.overruns = 0
+        self.overrun_bytes = 0
+        self.arrival = None     # time.monotonic() of the newest byte in the last read_view
+        self._arrived = None
+
         self._thr = threading.Thread(target=self._loop, daemon=True)
         self._thr.start()
 
+    @property
+    def pending_bytes(self):
+        return self._head - self._tail
+
     def _loop(self):
+        capacity = len(self._ring)
         while not self._stop.is_set():
+            with self._cond:
+                free = capacity - (self._head - self._tail)
+            start = self._head % capacity
+
             try:
-                if self.ser.in_waiting:
-                    data = self.ser.read(self.chunk_size)
-                    if data:
-                        self._buf.put(data)
-                else:
-                    time.sleep(0.01)
+                # block for the first byte, then take whatever else is already waiting
+                want = min(max(self.ser.in_waiting, 1), self.chunk_size)
+                if free == 0:
+                    # the consumer is a whole ring behind, the newest bytes are lost
+                    n = self.ser.readinto(self._scratch[:want])
+                    if n:
+                        self.overruns += 1
+                        self.overrun_bytes += n
+                    continue
+                n = self.ser.readinto(self._view[start:start + min(want, free, capacity - start)])
             except Exception as e:
                 print(f"[SerialReader] read error: {e}")
                 break
 
-    def read_data(self):
-        out = b''
-        while not self._buf.empty():
-            out += self._buf.get_nowait()
-        return out
+            if n:
+                with self._cond:
+                    self._head += n
+                    self._arrived = time.monotonic()
+                    self.bytes_read += n
+                    self._cond.notify()
+
+        with self._cond:
+            self._cond.notify_all()
+
+    def read_view(self, timeout=None):
+        # next contiguous region of the ring, valid until the following read_view/read_data call
+        capacity = len(self._ring)
+        with self._cond:
+            self._tail = self._served
+            if self._head == self._tail and timeout:
+                self._cond.wait_for(lambda: self._head != self._tail or self._stop.is_set(), timeout)
+
+            start = self._tail % capacity
+            n = min(self._head - self._tail, capacity - start)
+            self._served = self._tail + n
+            self.arrival = self._arrived
+        return self._view[start:start + n]
+
+    def read_data(self, timeout=None):
+        # everything buffered as one bytes object, timeout waits that long for the first byte
+        parts = []
+        view = self.read_view(timeout)
+        while view:
+            parts.append(view.tobytes())
+            view = self.read_view()
+        return b''.join(parts)
 
     def disconnect(self):
         self._stop.set()
+        with self._cond:
+            self._cond.notify_all()
         if self.ser and self.ser.is_open:
             try:
                 self.ser.close()
@@ -0,0 +1,199 @@
+import numpy as np
+import yaml
+
+from frames import FLAG_IDE, FLAG_RTR
+
+# Signal definitions in YAML, one entry per CAN ID (hex works, YAML reads 0x650 as a number):
+#
+#   messages:
+#     0x650:
+#       name: EngineData
+#       extended: false             # optional, IDs above 0x7ff are extended anyway
+#       signals:
+#         rpm:     {start: 0,  length: 16, byte_order: little, scale: 0.25, unit: rpm}
+#         coolant: {start: 23, length: 8,  byte_order: big, offset: -40, unit: degC}
+#         torque:  {start: 24, length: 12, signed: true, scale: 0.5, unit: Nm}
+#
+# start bit and byte order follow the DBC convention: little endian (Intel) signals start at their
+# least significant bit, big endian (Motorola) ones at their most significant bit, bit 0 being the
+# lowest bit of Data0 in both cases.
+
+BYTE_ORDERS = {'little': True, 'intel': True, 'little_endian': True,
+               'big': False, 'motorola': False, 'big_endian': False}
+
+
+class Signal:
+    __slots__ = ('name', 'start', 'length', 'little_endian', 'signed', 'scale', 'offset', 'unit',
+                 'shift', 'mask', 'min_dlc')
+
+    def __init__(self, name, start, length, little_endian=True, signed=False, scale=1.0, offset=0.0, unit=''):
+        self.name = name
+        self.start = start
+        self.length = length
+        self.little_endian = little_endian
+        self.signed = signed
+        self.scale = scale
+        self.offset = offset
+        self.unit = unit
+
+        if not 1 <= length <= 64 or not 0 <= start <= 63:
+            raise ValueError(f"{name}: start {start} / length {length} out of range")
+
+        # where the signal sits in the 8 data bytes read as one 64 bit integer, in that byte order
+        if little_endian:
+            lsb, last = start, start + length - 1
+            self.shift = lsb
+        else:
+            msb = (start // 8) * 8 + (7 - start % 8)
+            last = msb + length - 1
+            self.shift = 63 - last
+        if last > 63:
+            raise ValueError(f"{name}: runs past the end of the 8 data bytes")
+        self.mask = (1 << length) - 1
+        self.min_dlc = last // 8 + 1
+
+    def __repr__(self):
+        order = 'little' if self.little_endian else 'big'
+        return f"Signal({self.name}, start={self.start}, length={self.length}, {order}, unit={self.unit!r})"
+
+
+class Message:
+    # One CAN ID's signals, compiled into shift/mask tables once so a frame costs two int.from_bytes
+    # and a pass over the table, and a whole array of frames a handful of NumPy operations
+
+    def __init__(self, can_id, name, signals, extended=None):
+        self.can_id = can_id
+        self.name = name
+        self.extended = can_id > 0x7FF if extended is None else bool(extended)
+        self.signals = list(signals)
+
+        self._little = np.array([s.little_endian for s in self.signals], dtype=bool)
+        self._shifts = np.array([s.shift for s in self.signals], dtype=np.uint64)
+        self._masks = np.array([s.mask for s in self.signals], dtype=np.uint64)
+        self._sign_bits = np.array([s.length - 1 for s in self.signals], dtype=np.uint64)
+        self._ranges = np.exp2([s.length for s in self.signals])
+        self._signed = np.array([s.signed for s in self.signals], dtype=bool)
+        self._scales = np.array([s.scale for s in self.signals], dtype=np.float64)
+        self._offsets = np.array([s.offset for s in self.signals], dtype=np.float64)
+        self._min_dlc = np.array([s.min_dlc for s in self.signals], dtype=np.int64)
+        self._table = [(s.name, s.little_endian, s.shift, s.mask, s.length if s.signed else 0, s.scale,
+                        s.offset, s.unit, s.min_dlc) for s in self.signals]
+
+    @property
+    def key(self):
+        return self.can_id, int(self.extended)
+
+    def decode(self, data, dlc=None):
+        # [(name, value, unit)] for one frame's data bytes, signals past the DLC are left out
+        n = len(data) if dlc is None else min(dlc, len(data))
+        padded = bytes(data[:8]).ljust(8, b'\0')
+        data_le = int.from_bytes(padded, 'little')
+        data_be = int.from_bytes(padded, 'big')
+
+        out = []
+        for name, little, shift, mask, signed_len, scale, offset, unit, min_dlc in self._table:
+            if min_dlc > n:
+                continue
+            value = ((data_le if little else data_be) >> shift) & mask
+            if signed_len and value >> (signed_len - 1):
+                value -= 1 << signed_len
+            out.append((name, value * scale + offset, unit))
+        return out
+
+    def decode_array(self, data, dlc):
+        # (N, 8) uint8 data and N DLCs -> (N, signals) float64 values, NaN where the DLC is too short
+        data = np.ascontiguousarray(data, dtype=np.uint8).reshape(-1, 8)
+        data_le = data.view('<u8').ravel()
+        data_be = data.view('>u8').ravel().astype(np.uint64)
+
+        words = np.where(self._little, data_le[:, None], data_be[:, None])
+        raw = (words >> self._shifts) & self._masks
+        values = raw.astype(np.float64)
+
+        if self._signed.any():
+            negative = self._signed & (((raw >> self._sign_bits) & np.uint64(1)) != 0)
+            values -= negative * self._ranges
+
+        values = values * self._scales + self._offsets
+        values[np.asarray(dlc)[:, None] < self._min_dlc] = np.nan
+        return values
+
+
+class SignalDatabase:
+    # Messages by (can_id, ide), the one place frames are turned into engineering values
+
+    def __init__(self, messages=()):
+        self.messages = {}
+        for message in messages:
+            self.add(message)
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, message):
+        self.messages[message.key] = message
+
+    @classmethod
+    def from_dict(cls, doc, source='signals'):
+        db = cls()
+        entries = (doc or {}).get('messages') or {}
+        for can_id, entry in entries.items():
+            try:
+                can_id = int(can_id, 0) if isinstance(can_id, str) else int(can_id)
+                signals = [Signal(name,
+                                  start=int(spec['start']),
+                                  length=int(spec['length']),
+                                  little_endian=BYTE_ORDERS[str(spec.get('byte_order', 'little')).lower()],
+                                  signed=bool(spec.get('signed', False)),
+                                  scale=float(spec.get('scale', 1.0)),
+                                  offset=float(spec.get('offset', 0.0)),
+                                  unit=str(spec.get('unit', '')))
+                           for name, spec in (entry.get('signals') or {}).items()]
+                db.add(Message(can_id, str(entry.get('name', f"0x{can_id:x}")), signals, entry.get('extended')))
+            except (KeyError, TypeError, ValueError) as e:
+                raise ValueError(f"{source}: message {can_id}: {e!r}") from None
+        return db
+
+    @classmethod
+    def from_yaml(cls, path):
+        with open(path) as f:
+            try:
+                doc = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise ValueError(f"{path}: {e}") from None
+        return cls.from_dict(doc, path)
+
+    def message(self, can_id, ide=0):
+        return self.messages.get((can_id, int(bool(ide))))
+
+    def decode(self, frame):
+        # (message name, [(signal, value, unit)]) for a CANFrame, None for IDs without a definition
+        message = self.messages.get((frame.can_id, int(bool(frame.ide))))
+        if message is None or frame.rtr:
+            return None
+        return message.name, message.decode(frame.data, frame.dlc)
+
+    def decode_rows(self, rows):
+        # bulk decode of FrameStore rows: {message name: {'rows': row numbers, signal: values}}
+        out = {}
+        if not len(rows):
+            return out
+        can_id = rows['can_id']
+        ide = (rows['flags'] & FLAG_IDE) != 0
+        data_frame = (rows['flags'] & FLAG_RTR) == 0
+
+        for (mid, extended), message in self.messages.items():
+            picked = np.flatnonzero((can_id == mid) & (ide == bool(extended)) & data_frame)
+            if not len(picked):
+                continue
+            # signals live in the first 8 data bytes, CAN FD payloads past those are not mapped
+            values = message.decode_array(rows['data'][picked, :8], rows['dlc'][picked])
+            columns = {'rows': picked}
+            for i, signal in enumerate(message.signals):
+                columns[signal.name] = values[:, i]
+            out[message.name] = columns
+        return out
+
+
+def load_signals(path):
+    return SignalDatabase.from_yaml(path)
@@ -0,0 +1,265 @@
+import numpy as np
+
+from crc import crc15_from_int, crc_fd
+from decoder import EDGE_RECORD_DTYPE, RECORD_PIN, RECORD_START
+from frames import CANFrame, FD_DLC_LEN, TAIL_LEN
+from timeline import BURST_TICKS, RECORD_BITS
+
+
+def encode_frame(frame, stuff=True):
+    # wire bits SOF .. IFS with the CRC-15 filled in and, unless stuff is False, stuff bits inserted
+    if frame.fdf:
+        return encode_fd_frame(frame, stuff)[0]
+
+    value = nbits = 0
+    for name, width, field in frame.fields():
+        if name == 'IDLE ':
+            continue
+        if name == 'CRC':
+            break
+        value = (value << width) | field
+        nbits += width
+
+    value = (value << 15) | crc15_from_int(value, nbits)
+    nbits += 15
+
+    if not stuff:
+        return [(value >> i) & 1 for i in range(nbits - 1, -1, -1)] + \
+               [(frame.tail >> i) & 1 for i in range(TAIL_LEN - 1, -1, -1)]
+
+    bits = []
+    run_bit, run_len = None, 0
+    for i in range(nbits - 1, -1, -1):
+        if run_len == 5:
+            run_bit, run_len = 1 - run_bit, 1
+            bits.append(run_bit)
+
+        bit = (value >> i) & 1
+        if bit == run_bit:
+            run_len += 1
+        else:
+            run_bit, run_len = bit, 1
+        bits.append(bit)
+
+    # a run ending on the last CRC bit is still stuffed
+    if run_len == 5:
+        bits.append(1 - run_bit)
+
+    bits.extend((frame.tail >> i) & 1 for i in range(TAIL_LEN - 1, -1, -1))
+    return bits
+
+
+def encode_fd_frame(frame, stuff=True):
+    # CAN FD wire bits SOF .. IFS and the bits the data phase runs from and to (ESI .. last CRC bit,
+    # both None without BRS). Dynamic stuffing covers SOF .. data, the stuff count and CRC that follow
+    # carry a fixed stuff bit in front of every 4 bits instead
+    header = []
+    for name, width, field in frame.fields():
+        if name == 'IDLE ':
+            continue
+        if name == 'SC':
+            break
+        header.extend((field >> i) & 1 for i in range(width - 1, -1, -1))
+    brs_bit = 35 if frame.ide else 16
+
+    bits = []
+    count = 0
+    brs_at = None
+    run_bit, run_len = None, 0
+    for i, bit in enumerate(header):
+        # a run of five at the end of the data is broken by the first fixed stuff bit instead
+        if run_len == 5:
+            run_bit, run_len = 1 - run_bit, 1
+            bits.append(run_bit)
+            count += 1
+
+        if bit == run_bit:
+            run_len += 1
+        else:
+            run_bit, run_len = bit, 1
+        if i == brs_bit:
+            brs_at = len(bits)
+        bits.append(bit)
+
+    gray = (count % 8) ^ ((count % 8) >> 1)
+    sc = (gray << 1) | (bin(gray).count('1') & 1)
+    sc_bits = [(sc >> i) & 1 for i in range(3, -1, -1)]
+    width = frame.crc_len
+    crc = crc_fd(bits + sc_bits, width)
+    fixed = sc_bits + [(crc >> i) & 1 for i in range(width - 1, -1, -1)]
+
+    if not stuff:
+        return header + fixed + [(frame.tail >> i) & 1 for i in range(TAIL_LEN - 1, -1, -1)], None, None
+
+    for k in range(0, len(fixed), 4):
+        bits.append(1 - bits[-1])
+        bits.extend(fixed[k:k + 4])
+    crc_end = len(bits)
+    bits.extend((frame.tail >> i) & 1 for i in range(TAIL_LEN - 1, -1, -1))
+
+    if not frame.brs:
+        return bits, None, None
+    return bits, brs_at + 1, crc_end
+
+
+class SyntheticBus:
+    # Random traffic at a given bus load, reported in bursts the way the CAN_Reader board does:
+    # TIM2 starts at the first edge, the burst is sent once BURST_TICKS have passed, and with uart_baud
+    # set the edges that arrive while the DMA transfer is running are lost like on the real board
+
+    # fd is the share of CAN FD frames, brs the share of those that switch to data_bitrate. The bit rate
+    # switches at the sample point of BRS and back at that of the CRC delimiter, both sample points
+    # match BitTiming's switch_points. clock_error is how far off a sending node's oscillator may be, every
+    # frame's bits are stretched or squeezed by a random factor within 1 +- clock_error. The bus is
+    # driven dominant but only released to recessive, recessive_delay ticks is how much later the
+    # dominant to recessive edges are seen
+
+    def __init__(self, bitrate=500_000, tick_hz=10_000_000, load=0.3, ids=None, extended=0.25, remote=0.1,
+                 burst_ticks=BURST_TICKS, uart_baud=None, seed=None, fd=0.0, brs=1.0, data_bitrate=2_000_000,
+                 sample_point=0.8, data_sample_point=0.7, clock_error=0.0, recessive_delay=0.0):
+        self.bitrate = bitrate
+        self.clock_error = clock_error
+        self.recessive_delay = recessive_delay
+        self.fd = fd
+        self.brs = brs
+        self.data_bitrate = data_bitrate
+        self.sample_point = sample_point
+        self.data_sample_point = data_sample_point
+        self.tick_hz = tick_hz
+        self.load = load
+        self.ids = ids
+        self.extended = extended
+        self.remote = remote
+        self.burst_ticks = burst_ticks
+        self.uart_baud = uart_baud
+        self.rng = np.random.default_rng(seed)
+
+        self.frame_count = 0
+        self._time = 0.0            # tick the next bit starts at
+        self._level = 1
+        self._burst_start = None
+        self._burst_records = 0
+        self._burst_count = 0       # the firmware's 8 bit burst counter
+        self._resume = 0            # edges before this tick hit a disabled EXTI
+
+    @property
+    def bit_ticks(self):
+        return self.tick_hz / self.bitrate
+
+    @property
+    def data_bit_ticks(self):
+        return self.tick_hz / self.data_bitrate
+
+    def random_frame(self):
+        rng = self.rng
+        ide = int(rng.random() < self.extended)
+        rtr = int(rng.random() < self.remote)
+        if self.ids is not None:
+            can_id = int(rng.choice(self.ids))
+        else:
+            can_id = int(rng.integers(0, 1 << (29 if ide else 11)))
+        if self.fd and rng.random() < self.fd:
+            # no remote frames in CAN FD
+            dlc = int(rng.integers(0, 16))
+            return CANFrame(can_id, ide=ide, fdf=1, brs=int(rng.random() < self.brs), dlc=dlc,
+                            data=rng.bytes(FD_DLC_LEN[dlc]))
+        dlc = int(rng.integers(0, 9))
+        return CANFrame(can_id, ide=ide, rtr=rtr, dlc=dlc, data=b'' if rtr else rng.bytes(dlc))
+
+    def frames(self, n):
+        return [self.random_frame() for _ in range(n)]
+
+    def bus_bits(self, frames):
+        # idle gaps are drawn so that busy time / total time averages out at load.
+        # Also returns every bit's length in ticks
+        parts = []
+        widths = []
+        tn = self.bit_ticks
+        for frame in frames:
+            fast_from = fast_to = None
+            if frame.fdf:
+                bits, fast_from, fast_to = encode_fd_frame(frame)
+            else:
+                bits = encode_frame(frame)
+            if self.load < 1:
+                gap = int(round(self.rng.exponential(len(bits) * (1 - self.load) / self.load)))
+                parts.append(np.ones(gap, dtype=np.uint8))
+                widths.append(np.full(gap, tn))
+            parts.append(np.array(bits, dtype=np.uint8))
+
+            width = np.full(len(bits), tn)
+            if fast_from is not None:
+                td = self.data_bit_ticks
+                width[fast_from - 1] = self.sample_point * tn + (1 - self.data_sample_point) * td
+                width[fast_from:fast_to] = td
+                width[fast_to] = self.data_sample_point * td + (1 - self.sample_point) * tn
+            if self.clock_error:
+                width *= 1 + self.rng.uniform(-self.clock_error, self.clock_error)
+            widths.append(width)
+        self.frame_count += len(frames)
+        if not parts:
+            return np.empty(0, dtype=np.uint8), np.empty(0)
+        return np.concatenate(parts), np.concatenate(widths)
+
+    def records(self, n_frames=None, frames=None):
+        if frames is None:
+            frames = self.frames(n_frames)
+        bits, widths = self.bus_bits(frames)
+
+        prev = np.empty_like(bits)
+        prev[:1] = self._level
+        prev[1:] = bits[:-1]
+        edge = np.flatnonzero(bits != prev)
+
+        starts = self._time + np.cumsum(widths) - widths
+        levels = bits[edge]
+        ticks = np.round(starts[edge] + self.recessive_delay * levels).astype(np.int64)
+        self._time += float(widths.sum())
+        if len(bits):
+            self._level = int(bits[-1])
+
+        return self._bursts(ticks, levels)
+
+    def _bursts(self, ticks, levels):
+        keep = []
+        stamps = []
+        counters = []
+        i, n = 0, len(ticks)
+        while i < n:
+            if self._burst_start is None:
+                i += int(np.searchsorted(ticks[i:], self._resume))
+                if i >= n:
+                    break
+                self._burst_start = int(ticks[i])
+                self._burst_records = 0
+
+            end = i + int(np.searchsorted(ticks[i:], self._burst_start + self.burst_ticks))
+            keep.append(np.arange(i, end))
+            stamps.append(ticks[i:end] - self._burst_start)
+            counters.append(np.full(end - i, self._burst_count & 0xFF))
+            self._burst_records += end - i
+
+            if end < n:
+                dead = 0
+                if self.uart_baud:
+                    dead = self._burst_records * RECORD_BITS * self.tick_hz / self.uart_baud
+                self._resume = self._burst_start + self.burst_ticks + dead
+                self._burst_start = None
+                self._burst_count += 1
+            i = end
+
+        idx = np.concatenate(keep) if keep else np.empty(0, dtype=np.intp)
+        out = np.zeros(len(idx), dtype=EDGE_RECORD_DTYPE)
+        out['start'] = RECORD_START
+        out['level'] = levels[idx]
+        out['pin'] = RECORD_PIN
+        out['burst'] = np.concatenate(counters) if counters else 0
+        out['timestamp'] = np.concatenate(stamps) if stamps else 0
+        return out
+
+    def stream(self, n_frames=None, frames=None):
+        return self.records(n_frames, frames).tobytes()
+
+    def blocks(self, frames_per_block=64):
+        while True:
+            yield self.records(frames_per_block)
@@ -0,0 +1,96 @@
+import numpy as np
+
+BURST_TICKS = 15000     # FRAME_IDLE_THRESHOLD in the CAN_Reader firmware
+RECORD_BITS = 80        # one EdgeRecord on the UART, 8 bytes with start and stop bits
+
+
+class SessionClock:
+    # Stitches the per-burst TIM2 timestamps into one monotonic 64-bit session tick count.
+    #
+    # TIM2 restarts at the first edge of every burst and the burst is only sent once burst_ticks have
+    # passed, so the next burst starts at least burst_ticks (plus the UART transfer, when uart_baud is
+    # known) after the one before. That lower bound is all a capture file gives us. Firmware that fills
+    # in the burst counter also says how many bursts were lost on the way, and on a live port the host
+    # arrival time moves the timeline forward over idle stretches longer than host_slack seconds.
+
+    def __init__(self, tick_hz=10_000_000, burst_ticks=BURST_TICKS, uart_baud=None, host_slack=0.02):
+        self.tick_hz = tick_hz
+        self.burst_ticks = burst_ticks
+        self.uart_baud = uart_baud
+        self.host_slack = host_slack
+        self.reset()
+
+    def reset(self):
+        self.offset = 0             # session tick of TIM2 zero in the current burst
+        self.last = None            # raw timestamp of the last record
+        self.burst = None           # firmware burst counter of the last record
+        self.burst_records = 0      # records seen so far in the current burst
+        self.bursts = 0
+        self.lost_bursts = 0
+        self._latency = None        # smallest host arrival minus session tick seen, in ticks
+
+    @property
+    def host_offset(self):
+        # add to a session tick for host time.monotonic() in ticks, None until an arrival time was seen
+        return self._latency
+
+    def unwrap(self, timestamps, bursts=None, arrival=None):
+        # session ticks for one batch of records, arrival is the host time.monotonic() the batch came in
+        ts = np.asarray(timestamps, dtype=np.int64)
+        n = len(ts)
+        if not n:
+            return ts
+
+        prev = np.empty_like(ts)
+        prev[0] = ts[0] if self.last is None else self.last
+        prev[1:] = ts[:-1]
+        new = ts <= prev
+
+        if bursts is not None:
+            counter = np.asarray(bursts, dtype=np.int64)
+            prev_counter = np.empty_like(counter)
+            prev_counter[0] = counter[0] if self.burst is None else self.burst
+            prev_counter[1:] = counter[:-1]
+            new |= counter != prev_counter
+
+        if self.last is None:
+            new[0] = False
+
+        starts = np.flatnonzero(new)
+        offsets = np.full(n, self.offset, dtype=np.int64)
+        if len(starts):
+            gap = np.maximum(prev[starts] + 1, self.burst_ticks)
+            if self.uart_baud:
+                # EXTI stays off while the previous burst is on the UART
+                records = np.diff(np.r_[0, starts])
+                records[0] += self.burst_records
+                gap += records * RECORD_BITS * self.tick_hz // self.uart_baud
+            if bursts is not None:
+                skipped = counter[starts] - prev_counter[starts]
+                lost = np.where(skipped != 0, (skipped - 1) % 256, 0)
+                gap += lost * self.burst_ticks
+                self.lost_bursts += int(lost.sum())
+
+            step = np.zeros(n, dtype=np.int64)
+            step[starts] = gap
+            offsets += np.cumsum(step)
+            self.bursts += len(starts)
+
+        ticks = ts + offsets
+
+        if arrival is not None:
+            now = int(arrival * self.tick_hz)
+            if self._latency is not None and len(starts):
+                # the newest burst can not have started later than the best latency seen so far allows
+                ahead = now - self._latency - int(ticks[-1])
+                if ahead > self.host_slack * self.tick_hz:
+                    ticks[starts[-1]:] += ahead
+            latency = now - int(ticks[-1])
+            self._latency = latency if self._latency is None else min(self._latency, latency)
+
+        self.offset = int(ticks[-1] - ts[-1])
+        self.last = int(ts[-1])
+        if bursts is not None:
+            self.burst = int(counter[-1])
+        self.burst_records = n - int(starts[-1]) if len(starts) else self.burst_records + n
+        return ticks
@@ -0,0 +1,306 @@
+"""Throughput benchmarks for every decoding and rendering stage.
+
+Runs each stage over synthetic traces (app/synth.py) of several sizes and bus loads and
+reports records/s, frames/s, peak traced memory and, for the UI stage, ms per UI tick.
+Results can be stored as a baseline and later runs are compared against it:
+
+    python bench/bench_pipeline.py --save-baseline
+    python bench/bench_pipeline.py --frames 100 10000 --loads 1.0
+"""
+import argparse
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..', 'app'))
+
+from capture import unwrap_ticks                       # noqa: E402
+from decoder import CANDecoder, BitSampler, BitTiming  # noqa: E402
+from synth import SyntheticBus, encode_frame           # noqa: E402
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+FRAME_COUNTS = (1, 100, 10_000, 1_000_000)
+LOADS = (0.1, 0.5, 1.0)
+CHUNK_SIZE = 4096           # SerialReader.chunk_size
+UI_INTERVAL = 0.1           # READ_INTERVAL in app/main.py, seconds of bus time per UI tick
+
+
+class Trace:
+    # one synthetic capture plus the derived inputs the list based stages want
+
+    def __init__(self, n_frames, load, bitrate=500_000, seed=0):
+        self.n_frames = n_frames
+        self.load = load
+        self.bus = SyntheticBus(bitrate=bitrate, load=load, seed=seed)
+        self.frames = self.bus.frames(n_frames)
+        self.records = self.bus.records(frames=self.frames)
+        self.raw = self.records.tobytes()
+
+    def chunks(self, size=CHUNK_SIZE):
+        return [self.raw[i:i + size] for i in range(0, len(self.raw), size)]
+
+    def ui_ticks(self):
+        # raw bytes that arrive during each READ_INTERVAL of bus time
+        ticks, _, _ = unwrap_ticks(self.records['timestamp'])
+        per_tick = UI_INTERVAL * self.bus.tick_hz
+        cuts = np.flatnonzero(np.diff(ticks // per_tick)) + 1
+        bounds = np.r_[0, cuts, len(ticks)] * 8
+        return [self.raw[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+    def stuffed_bits(self):
+        return [bit for frame in self.frames for bit in encode_frame(frame)]
+
+    def unstuffed_bits(self):
+        return [bit for frame in self.frames for bit in encode_frame(frame, stuff=False)]
+
+    def step_timestamps(self):
+        ticks, _, _ = unwrap_ticks(self.records['timestamp'])
+        return np.repeat(ticks, 2)[1:].tolist()
+
+
+def bench_decode(trace):
+    chunks = trace.chunks()
+
+    def run():
+        decoder = CANDecoder()
+        for chunk in chunks:
+            decoder.decode_8byte_data(chunk)
+    return run
+
+
+def bench_remove_stuff_bits(trace):
+    bits = trace.stuffed_bits()
+    decoder = CANDecoder()
+    return lambda: decoder.remove_stuff_bits(bits)
+
+
+def bench_decode_frame_type(trace):
+    bits = trace.unstuffed_bits()
+    decoder = CANDecoder()
+
+    def run():
+        # the legacy decoder prints progress and pads its input in place
+        stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+        try:
+            decoder.decode_frame_type(bits[:])
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+    return run
+
+
+def bench_retrive_bit_timestamp(trace):
+    from plotter import Plotter
+
+    timestamps = trace.step_timestamps()
+    plotter = Plotter(HeadlessApp())
+    plotter.snap.timing = timing = BitTiming(trace.bus.bitrate)
+    # the decoder's first bit after every edge and where it starts, as CANDecoder works it out for classic frames
+    _, counts, starts = BitSampler(timing).sample(trace.records['level'], timestamps[0::2])
+    plotter.snap.edge_bit = tuple(np.cumsum(counts).tolist())
+    plotter.snap.edge_start = tuple(starts.tolist())
+    plotter.snap.switches = ()
+
+    def run():
+        plotter._ts_done = 0
+        plotter.plot_timestamp = []
+        plotter.retrive_bit_timestamp(timestamps)
+    return run
+
+
+class HeadlessApp:
+    # the bits of LogicAnalyzerApp the plotter reads, every display option switched on
+
+    class _Var:
+        def get(self):
+            return True
+
+    bit_chkbox = hex_chkbox = hili_chkbox = text_chkbox = frametype_chkbox = _Var()
+
+    def disable_all_checkboxes(self):
+        pass
+
+    def enable_all_checkboxes(self):
+        pass
+
+
+class InlinePipeline:
+    # stands in for DecodePipeline, decodes on the calling thread so a tick is measured end to end
+
+    def __init__(self, decoder):
+        self.decoder = decoder
+        self.data = None
+
+    def latest(self):
+        from pipeline import Snapshot
+
+        self.decoder.decode_8byte_data(self.data)
+        return Snapshot(self.decoder)
+
+
+def bench_ui_tick(trace, max_ticks):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    from plotter import Plotter
+
+    ticks = trace.ui_ticks()[:max_ticks]
+    durations = []
+
+    def run():
+        fig, ax = plt.subplots(figsize=(16, 7), dpi=100)
+        plotter = Plotter(HeadlessApp())
+        plotter.ax = ax
+        plotter.attach(fig.canvas)
+        plotter.pipeline = InlinePipeline(plotter.decoder)
+
+        # only the untraced pass counts towards ms per tick
+        timed = not tracemalloc.is_tracing()
+        for data in ticks:
+            start = time.perf_counter()
+            plotter.pipeline.data = data
+            plotter.update(None)
+            plotter.render()
+            if timed:
+                durations.append(time.perf_counter() - start)
+        plt.close(fig)
+
+    return run, durations
+
+
+def measure(run, memory):
+    gc.collect()
+    start = time.perf_counter()
+    run()
+    seconds = time.perf_counter() - start
+
+    peak = None
+    if memory:
+        # second pass, tracing slows Python code down too much to time it in the same run
+        gc.collect()
+        tracemalloc.start()
+        run()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return seconds, peak
+
+
+def run_benchmarks(frame_counts, loads, list_max, max_ticks, memory):
+    results = {}
+
+    def record(stage, trace, seconds, peak, records=None, extra=None, frames=True):
+        key = f"{stage}/{trace.n_frames}/{trace.load}"
+        row = {'seconds': seconds,
+               'frames_per_s': trace.n_frames / seconds if frames and seconds else None,
+               'records_per_s': records / seconds if records is not None and seconds else None,
+               'peak_mb': peak / 1e6 if peak is not None else None}
+        row.update(extra or {})
+        results[key] = row
+        print_row(key, row)
+
+    for n_frames in frame_counts:
+        for load in loads:
+            trace = Trace(n_frames, load)
+            n_records = len(trace.records)
+
+            record('decode_8byte_data', trace, *measure(bench_decode(trace), memory), records=n_records)
+
+            run, durations = bench_ui_tick(trace, max_ticks)
+            seconds, peak = measure(run, memory)
+            ms = np.array(durations) * 1000
+            record('ui_tick', trace, seconds, peak, frames=False,
+                   extra={'ticks': len(ms),
+                          'ms_per_tick': float(ms.mean()) if len(ms) else None,
+                          'ms_per_tick_p99': float(np.percentile(ms, 99)) if len(ms) else None})
+
+            if n_frames <= list_max:
+                record('retrive_bit_timestamp', trace, *measure(bench_retrive_bit_timestamp(trace), memory),
+                       records=n_records)
+
+            # destuffing and frame parsing only see frame bits, the bus load does not change them
+            if n_frames <= list_max and load == loads[-1]:
+                record('remove_stuff_bits', trace, *measure(bench_remove_stuff_bits(trace), memory))
+                record('decode_frame_type', trace, *measure(bench_decode_frame_type(trace), memory))
+
+            del trace
+    return results
+
+
+def print_row(key, row):
+    cells = [f"{key:<40}", f"{row['seconds'] * 1000:10.1f} ms"]
+    if row['records_per_s']:
+        cells.append(f"{row['records_per_s']:12,.0f} rec/s")
+    if row['frames_per_s']:
+        cells.append(f"{row['frames_per_s']:10,.0f} frm/s")
+    if row['peak_mb'] is not None:
+        cells.append(f"{row['peak_mb']:8.1f} MB")
+    if row.get('ms_per_tick') is not None:
+        cells.append(f"{row['ms_per_tick']:6.1f} ms/tick (p99 {row['ms_per_tick_p99']:.1f})")
+    print('  '.join(cells), flush=True)
+
+
+def compare(results, baseline, tolerance):
+    # throughput going down or tick time going up by more than tolerance counts as a regression
+    regressions = []
+    for key, row in results.items():
+        old = baseline.get(key)
+        if not old:
+            continue
+        for metric, higher_is_better in (('records_per_s', True), ('frames_per_s', True), ('ms_per_tick', False)):
+            if row.get(metric) is None or not old.get(metric):
+                continue
+            change = row[metric] / old[metric] - 1
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append((key, metric, old[metric], row[metric], change))
+
+    for key, metric, old, new, change in regressions:
+        print(f"REGRESSION {key} {metric}: {old:,.1f} -> {new:,.1f} ({change:+.0%})")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--frames', type=int, nargs='+', default=list(FRAME_COUNTS))
+    parser.add_argument('--loads', type=float, nargs='+', default=list(LOADS))
+    parser.add_argument('--list-max', type=int, default=10_000,
+                        help="largest trace for the list based stages, they need about 1 GB at 1M frames")
+    parser.add_argument('--ticks', type=int, default=100, help="UI ticks to time per trace")
+    parser.add_argument('--no-memory', action='store_true', help="skip the traced peak memory pass")
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(sorted(args.frames), sorted(args.loads), args.list_max, args.ticks,
+                             not args.no_memory)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+
+    if args.save_baseline:
+        # numbers only compare on the same machine, keep a note of which one it was
+        meta = {'python': sys.version.split()[0], 'numpy': np.__version__,
+                'platform': platform.platform(), 'cpu': platform.processor() or platform.machine()}
+        with open(args.baseline, 'w') as f:
+            json.dump(dict(results, _meta=meta), f, indent=1, sort_keys=True)
+        print(f"baseline saved to {args.baseline}")
+        return 0
+
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        return 1 if compare(results, baseline, args.tolerance) else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
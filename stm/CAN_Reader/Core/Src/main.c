@@ -30,6 +30,7 @@ typedef struct {
 	uint8_t start;
     uint8_t level;
     uint8_t pin;
+    uint8_t burst;
     uint32_t timestamp;
 } EdgeRecord;
 /* USER CODE END PTD */
@@ -59,6 +60,7 @@ volatile uint8_t dma_busy = 0;
 
 uint8_t timer_started = 0;
 uint8_t level = 0;
+uint8_t burst_count = 0;
 
 uint32_t now = 0;
 uint32_t current_time = 0;
@@ -104,6 +106,7 @@ void Read_Pin_Data(uint16_t GPIO_Pin)
 	record_buffer[record_index].start = 17;
 	record_buffer[record_index].level = level;
 	record_buffer[record_index].pin = GPIO_Pin;
+	record_buffer[record_index].burst = burst_count;
 	record_buffer[record_index].timestamp = now;
 	record_index++;
 }
@@ -164,6 +167,7 @@ int main(void)
 			  HAL_NVIC_DisableIRQ(EXTI0_IRQn);
 			  HAL_UART_Transmit_DMA(&huart2, (uint8_t*)record_buffer, sizeof(EdgeRecord) * record_index);
 			  record_index = 0;
+			  burst_count++;
 		  }
 	  }
 
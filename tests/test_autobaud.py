@@ -0,0 +1,75 @@
+from autobaud import BitrateEstimator
+from decoder import BitTiming, CANDecoder
+from export import estimate_bitrate, export
+from synth import SyntheticBus
+from timeline import SessionClock
+
+CHUNK = 4096
+
+
+def decode(raw, decoder):
+    for i in range(0, len(raw), CHUNK):
+        decoder.decode_8byte_data(raw[i:i + CHUNK])
+    frames = decoder.frame_decoder.frames
+    return [frames[k].can_id for k in range(len(frames))]
+
+
+def test_fd_traffic_estimates_nominal_bitrate():
+    # the BRS data phases are most of the short intervals, they must not win the estimate
+    raw = SyntheticBus(load=0.5, fd=0.2, seed=1).stream(600)
+    decoder = CANDecoder(BitTiming(250_000), auto_bitrate=True)
+    ids = decode(raw, decoder)
+
+    assert decoder.timing.bitrate == 500_000
+    assert decoder.autobaud.locked == 500_000
+    # one switch from the guess to the estimate, before anything was decoded
+    assert decoder.generation == 1
+    assert ids == decode(raw, CANDecoder(BitTiming(500_000)))
+
+
+def test_fast_data_phase_at_low_nominal_bitrate():
+    raw = SyntheticBus(bitrate=125_000, data_bitrate=2_000_000, load=0.5, fd=0.5, seed=2).stream(400)
+    decoder = CANDecoder(auto_bitrate=True)
+    decode(raw, decoder)
+    assert decoder.timing.bitrate == 125_000
+
+
+def test_single_id_bus():
+    # 0x7FF sends a one bit dominant, five bits recessive pattern after every SOF, which 1.2 bit
+    # times fit as well with a negative edge delay
+    for can_id in (0x7FF, 0x000, 0x333):
+        raw = SyntheticBus(ids=[can_id], extended=0, load=0.5, clock_error=0.01, seed=6).stream(200)
+        decoder = CANDecoder(auto_bitrate=True)
+        decode(raw, decoder)
+        assert decoder.autobaud.locked == 500_000, hex(can_id)
+
+
+def test_estimate_is_locked_once_confirmed():
+    estimator = BitrateEstimator()
+    clock = SessionClock()
+    for block in SyntheticBus(load=0.5, fd=0.3, seed=3).blocks(16):
+        estimator.add(clock.unwrap(block['timestamp'], block['burst']), block['level'])
+        if estimator.bitrate():
+            break
+    assert estimator.locked == 500_000
+
+    # traffic at another bitrate no longer moves it
+    bus = SyntheticBus(bitrate=250_000, load=0.5, seed=4)
+    for _ in range(20):
+        block = bus.records(64)
+        estimator.add(clock.unwrap(block['timestamp'], block['burst']), block['level'])
+    assert estimator.bitrate() == 500_000
+
+
+def test_export_fd_capture_without_bitrate(tmp_path):
+    raw = SyntheticBus(load=0.5, fd=0.2, seed=5).stream(300)
+    binary = tmp_path / 'fd.bin'
+    binary.write_bytes(raw)
+    text = tmp_path / 'fd.txt'
+    text.write_text(''.join(repr(raw[i:i + CHUNK]) + '\n' for i in range(0, len(raw), CHUNK)))
+
+    for path in (binary, text):
+        assert estimate_bitrate(str(path), 10_000_000) == 500_000
+        expected = export(str(path), str(tmp_path / 'fixed.csv'), 'csv', bitrate=500_000)
+        assert export(str(path), str(tmp_path / 'frames.csv'), 'csv') == expected
+        assert expected[0] > 250
@@ -0,0 +1,29 @@
+import numpy as np
+
+from frames import CANFrame, FrameStore
+
+
+def test_fd_payload_round_trip():
+    store = FrameStore(capacity=2)
+    sent = [CANFrame(0x100, dlc=8, data=bytes(range(8))),
+            CANFrame(0x200, dlc=15, data=bytes(range(64)), fdf=1, brs=1),
+            CANFrame(0x300, dlc=2, data=b'\x01\x02'),
+            CANFrame(0x400, dlc=9, data=bytes(range(100, 112)), fdf=1)]
+    for _ in range(20):
+        for frame in sent:
+            store.append(frame)
+
+    assert [(f.can_id, f.data) for f in store[:4]] == [(f.can_id, f.data) for f in sent]
+    assert store[-3].data == bytes(range(64))
+    assert store.payload(0) is None
+
+    data = store.data()
+    assert data.shape == (80, 64)
+    assert data[1].tobytes() == bytes(range(64))
+    assert data[3, :12].tobytes() == bytes(range(100, 112))
+    assert not data[3, 12:].any() and not data[2, 2:].any()
+    assert np.array_equal(store.data(6), data[:6])
+
+    store.clear()
+    store.append(sent[0])
+    assert store.payload(0) is None and store[0].data == sent[0].data
@@ -0,0 +1,37 @@
+import queue
+import threading
+import time
+
+import numpy as np
+
+from multiport import SYNTHETIC_PORT, CaptureManager, channel_worker
+
+
+def test_merged_times_never_decrease():
+    # two workers on threads instead of processes, feeding one manager
+    manager = CaptureManager([SYNTHETIC_PORT, SYNTHETIC_PORT], hold=0.1)
+    manager._out = queue.Queue()
+    manager._open = {0, 1}
+    stop = threading.Event()
+    workers = [threading.Thread(target=channel_worker, daemon=True,
+                                args=(channel, SYNTHETIC_PORT, 1152000, bitrate, manager._out, stop),
+                                kwargs={'hold': 0.1})
+               for channel, bitrate in ((0, 500_000), (1, None))]
+    for worker in workers:
+        worker.start()
+
+    merged = []
+    deadline = time.monotonic() + 3
+    while time.monotonic() < deadline:
+        merged.append(manager.poll())
+        time.sleep(0.05)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    manager._receive()
+    merged.append(manager._merge(None))
+
+    times = np.concatenate([rows['time'] for rows in merged])
+    assert len(times) and set(np.concatenate([rows['channel'] for rows in merged]).tolist()) == {0, 1}
+    assert (np.diff(times) >= 0).all()
+    assert manager.late_frames == 0
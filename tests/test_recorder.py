@@ -0,0 +1,49 @@
+from capture import CaptureReader
+from decoder import CANDecoder
+from pipeline import Snapshot
+from recorder import RotatingRecorder
+from synth import SyntheticBus
+
+
+def test_queue_is_bounded(tmp_path):
+    recorder = RotatingRecorder(str(tmp_path), max_queued=1000)
+    assert recorder.append(bytes(600))
+    assert not recorder.append(bytes(600))
+    assert recorder.queued_bytes == 600 and recorder.dropped_bytes == 600
+
+    recorder.start()
+    recorder.stop()
+    assert recorder.queued_bytes == 0
+
+
+def test_write_error_stops_recording(tmp_path):
+    directory = tmp_path / 'captures'
+    recorder = RotatingRecorder(str(directory))
+    recorder.start()
+    directory.rmdir()
+
+    raw = SyntheticBus(seed=1).stream(50)
+    recorder.append(raw)
+    recorder._thr.join(timeout=5)
+    assert isinstance(recorder.error, OSError)
+
+    # nothing piles up once the writer thread is gone
+    assert not recorder.append(raw)
+    assert recorder.queued_bytes == 0 and recorder.dropped_bytes == 2 * len(raw)
+
+
+def test_header_bitrate_unknown_until_detected(tmp_path):
+    decoder = CANDecoder(auto_bitrate=True)
+    assert Snapshot(decoder).bitrate == 0
+
+    raw = SyntheticBus(bitrate=250_000, seed=2).stream(200)
+    for i in range(0, len(raw), 4096):
+        decoder.decode_8byte_data(raw[i:i + 4096])
+    assert Snapshot(decoder).bitrate == 250_000
+
+    recorder = RotatingRecorder(str(tmp_path), bitrate=Snapshot(decoder).bitrate)
+    recorder.start()
+    recorder.append(raw)
+    recorder.stop()
+    with CaptureReader(recorder.files[0]) as reader:
+        assert reader.bitrate == 250_000